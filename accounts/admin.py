@@ -1,11 +1,18 @@
 from django.contrib import admin
 
 from django.contrib.auth.admin import UserAdmin
-from .models import CustomUser, Account, Position, Ledger, Stock, Trade
+from .models import CustomUser, Account, Position, Ledger, Stock, Trade, PortfolioSnapshot, Order, PriceTick, PriceBar, PositionLot, TradeEvent, AccountSnapshot
 
 admin.site.register(CustomUser)
 admin.site.register(Account)
 admin.site.register(Position)
 admin.site.register(Ledger)
 admin.site.register(Stock)
-admin.site.register(Trade)
\ No newline at end of file
+admin.site.register(Trade)
+admin.site.register(PortfolioSnapshot)
+admin.site.register(Order)
+admin.site.register(PriceTick)
+admin.site.register(PriceBar)
+admin.site.register(PositionLot)
+admin.site.register(TradeEvent)
+admin.site.register(AccountSnapshot)
\ No newline at end of file
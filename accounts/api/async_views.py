@@ -0,0 +1,211 @@
+from functools import wraps
+import math
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+from rest_framework.exceptions import ValidationError
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from accounts.models import Account, Position, Ledger, Stock, PortfolioSnapshot
+from accounts.api.serializers import AccountSerializer, PositionSerializer, LedgerSerializer, PortfolioSerializer
+from accounts.api.pagination import KeysetPagination
+from accounts.api import fastjson
+from accounts.api.portfolio import refresh_portfolios
+from accounts.api.price_cache import aget_quote, aget_quotes
+from accounts.api.views import parse_bound
+from core import db_router
+
+# Async twins of the read endpoints, mounted under /api/async/ and served by
+# core.asgi. They answer exactly like the DRF views (same JSON, statuses and
+# pagination) but never block a thread on Redis or Postgres, so one process
+# can hold thousands of concurrent quote and portfolio reads. DRF views are
+# synchronous, so these are plain Django views: JWT is checked here, and
+# serializers are only used to shape rows that are already loaded.
+
+
+def _replica_reads(view):
+    # As views.replica_reads; here the token check and account lookup are
+    # covered too.
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        with db_router.reads_from(await db_router.areplica_for(kwargs.get("account_id"))):
+            return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def _token_user_id(request):
+    # Returns (user_id, None) or (None, the 401 DRF would send).
+    from rest_framework_simplejwt.tokens import AccessToken
+    from rest_framework_simplejwt.exceptions import TokenError
+
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return None, _unauthorized({"detail": "Authentication credentials were not provided."})
+    try:
+        token = AccessToken(header.split(" ", 1)[1])
+    except TokenError as e:
+        return None, _unauthorized({
+            "detail": "Given token not valid for any token type",
+            "code": "token_not_valid",
+            "messages": [{"token_class": "AccessToken", "token_type": "access", "message": str(e)}],
+        })
+    return token.get(settings.SIMPLE_JWT.get("USER_ID_CLAIM", "user_id")), None
+
+
+def _unauthorized(body):
+    response = JsonResponse(body, status=401)
+    response["WWW-Authenticate"] = 'Bearer realm="api"'
+    return response
+
+
+async def _user_account(request, account_id=None):
+    # The caller's account (or `account_id`, if it is theirs) with its user,
+    # or (None, error response).
+    user_id, denied = _token_user_id(request)
+    if denied:
+        return None, denied
+    accounts = Account.objects.select_related("user").filter(user_id=user_id, user__is_active=True)
+    if account_id is not None:
+        accounts = accounts.filter(id=account_id)
+    return await accounts.afirst(), None
+
+
+@require_GET
+@_replica_reads
+async def stock_detail(request, symbol):
+    data = await aget_quote(symbol)
+    if data is None:
+        return JsonResponse({"detail": "No Stock matches the given query."}, status=404)
+    return JsonResponse(data)
+
+
+@require_GET
+@_replica_reads
+async def stock_list(request):
+    stocks = Stock.objects.order_by("id")
+    for field in ("symbol", "exchange"):
+        value = request.GET.get(field)
+        if value:
+            stocks = stocks.filter(**{field: value})
+    symbols = stocks.values_list("symbol", flat=True)
+
+    # PageNumberPagination's output, page size and errors.
+    size = settings.REST_FRAMEWORK.get("PAGE_SIZE")
+    if not size:
+        page = [symbol async for symbol in symbols]
+        quotes = await aget_quotes(page)
+        return _list_response(request, [quotes[symbol] for symbol in page if symbol in quotes])
+    count = await symbols.acount()
+    pages = max(1, math.ceil(count / size))
+    value = request.GET.get("page", 1)
+    try:
+        number = pages if value == "last" else int(value)
+        if not 1 <= number <= pages:
+            raise ValueError
+    except ValueError:
+        return JsonResponse({"detail": "Invalid page."}, status=404)
+    page = [symbol async for symbol in symbols[(number - 1) * size:number * size]]
+    quotes = await aget_quotes(page)
+
+    url = request.build_absolute_uri()
+    previous = None
+    if number > 1:
+        previous = remove_query_param(url, "page") if number == 2 else replace_query_param(url, "page", number - 1)
+    return _list_response(request, [quotes[symbol] for symbol in page if symbol in quotes], {
+        "count": count,
+        "next": replace_query_param(url, "page", number + 1) if number < pages else None,
+        "previous": previous,
+    })
+
+
+def _list_response(request, results, head=None):
+    if fastjson.enabled(request):
+        return fastjson.list_response(results, head=head, asynchronous=True)
+    if head is None:
+        return JsonResponse(results, safe=False)
+    return JsonResponse({**head, "results": results})
+
+
+@require_GET
+async def account_detail(request):
+    account, denied = await _user_account(request)
+    if denied:
+        return denied
+    if account is None:
+        return _unauthorized({"detail": "User not found", "code": "user_not_found"})
+    return JsonResponse({"username": account.user.username, "account": AccountSerializer(account).data})
+
+
+async def _keyset_page(request, queryset, time_field, serializer_class):
+    paginator = KeysetPagination(time_field)
+    lean = None
+    if fastjson.enabled(request):
+        lean = fastjson.LeanSerializer(serializer_class, extra=(time_field, "id"))
+        paginator.key = lean.key(time_field, "id")
+        queryset = lean.values_list(queryset)
+    try:
+        rows = await paginator.apaginate_queryset(queryset, request)
+    except ValidationError as e:
+        return JsonResponse(e.detail, status=400)
+    if lean is None:
+        return JsonResponse({"next": paginator.get_next_link(), "results": serializer_class(rows, many=True).data})
+    return fastjson.list_response(rows, lean.data, head={"next": paginator.get_next_link()}, asynchronous=True)
+
+
+@require_GET
+@_replica_reads
+async def account_positions(request, account_id):
+    account, denied = await _user_account(request, account_id)
+    if denied:
+        return denied
+    if account is None:
+        return JsonResponse({"error": "Account not found"}, status=404)
+
+    positions = Position.objects.filter(account_id=account.id)
+    if request.GET.get("closed") not in ("1", "true"):
+        positions = positions.exclude(quantity=0)
+    symbol = request.GET.get("symbol")
+    if symbol:
+        positions = positions.filter(symbol=symbol)
+    return await _keyset_page(request, positions, "created_at", PositionSerializer)
+
+
+@require_GET
+@_replica_reads
+async def account_ledger(request, account_id):
+    account, denied = await _user_account(request, account_id)
+    if denied:
+        return denied
+    if account is None:
+        return JsonResponse({"error message": "Account not found"}, status=404)
+
+    ledger = Ledger.objects.filter(account_id=account.id)
+    transaction_type = request.GET.get("transaction_type")
+    if transaction_type:
+        ledger = ledger.filter(transaction_type=transaction_type)
+    try:
+        start = parse_bound(request.GET.get("start"), "start")
+        end = parse_bound(request.GET.get("end"), "end")
+    except ValidationError as e:
+        return JsonResponse(e.detail, status=400)
+    if start:
+        ledger = ledger.filter(timestamp__gte=start)
+    if end:
+        ledger = ledger.filter(timestamp__lt=end)
+    return await _keyset_page(request, ledger, "timestamp", LedgerSerializer)
+
+
+@require_GET
+async def account_portfolio(request, account_id):
+    account, denied = await _user_account(request, account_id)
+    if denied:
+        return denied
+    if account is None:
+        return JsonResponse({"error": "Account not found"}, status=404)
+
+    snapshot = await PortfolioSnapshot.objects.filter(account_id=account.id).afirst()
+    if snapshot is None:
+        await sync_to_async(refresh_portfolios)([account.id])
+        snapshot = await PortfolioSnapshot.objects.aget(account_id=account.id)
+    return JsonResponse(PortfolioSerializer(snapshot).data)
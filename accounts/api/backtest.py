@@ -0,0 +1,188 @@
+from collections import namedtuple
+import logging
+
+from django.core.exceptions import ImproperlyConfigured
+from accounts.models import Account, Position, PriceBar
+
+logger = logging.getLogger("trade_logger")
+
+# Replays orders against historical prices with the same rules as
+# settle_orders / process_trade:
+#   buy:  rejected if balance < price * quantity, otherwise the balance drops
+#         by the cost and the position grows at its weighted average cost;
+#   sell: rejected without a position of at least `quantity`, otherwise the
+#         balance grows by the revenue and the sold share of the cost basis is
+#         booked against it as realized P&L.
+# Positions are always costed at weighted average (POSITION_COST_METHOD
+# "average"). Everything is kept in integers (prices, balances and costs in
+# cents, quantities in hundredths, notionals in 1/10000) and rounded half up
+# like the Postgres columns.
+
+BUY, SELL = 1, -1
+FILLED, INSUFFICIENT_BALANCE, NOT_ENOUGH_STOCK, NO_PRICE = 0, 1, 2, 3
+RESULTS = {
+    FILLED: "{side} order executed successfully",
+    INSUFFICIENT_BALANCE: "Insufficient balance.",
+    NOT_ENOUGH_STOCK: "Not enough stock to sell.",
+    NO_PRICE: "Trade failed.",
+}
+
+BacktestResult = namedtuple(
+    "BacktestResult", ["balances", "quantities", "average_prices", "cost_basis", "realized_pnl", "status"],
+)
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImproperlyConfigured("Backtesting needs numpy (pip install numpy).")
+    return numpy
+
+
+def to_hundredths(values):
+    # Decimal, str or float amounts with at most 2 decimal places.
+    np = _numpy()
+    return np.rint(np.asarray(values, dtype=np.float64) * 100).astype(np.int64)
+
+
+def _round(np, values, divisor):
+    # Integer division rounded half away from zero, like ROUND_HALF_UP.
+    return np.sign(values) * ((2 * np.abs(values) + divisor) // (2 * divisor))
+
+
+def run_backtest(prices, steps, accounts, symbols, sides, quantities, balances, positions=None, costs=None, realized=None):
+    # prices:     (T, S) int64 cents; 0 where a symbol has no price yet.
+    # steps, accounts, symbols, sides, quantities: one entry per order, in
+    #             submission order; `quantities` in hundredths.
+    # balances:   (A,) int64 cents; positions / costs / realized: optional
+    #             (A, S) starting quantities (hundredths), cost basis and
+    #             realized P&L (cents), as returned by load_accounts.
+    np = _numpy()
+    prices = np.asarray(prices, dtype=np.int64)
+    steps = np.asarray(steps, dtype=np.int64)
+    accounts = np.asarray(accounts, dtype=np.int64)
+    symbols = np.asarray(symbols, dtype=np.int64)
+    sides = np.asarray(sides, dtype=np.int8)
+    quantities = np.asarray(quantities, dtype=np.int64)
+
+    balance = np.array(balances, dtype=np.int64)
+    shape = (len(balance), prices.shape[1])
+    held = np.zeros(shape, dtype=np.int64) if positions is None else np.array(positions, dtype=np.int64)
+    cost_basis = np.zeros(shape, dtype=np.int64) if costs is None else np.array(costs, dtype=np.int64)
+    pnl = np.zeros(shape, dtype=np.int64) if realized is None else np.array(realized, dtype=np.int64)
+    status = np.full(len(steps), NO_PRICE, dtype=np.int8)
+    if not len(steps):
+        return BacktestResult(balance, held, _averages(np, held, cost_basis), cost_basis, pnl, status)
+
+    # Accounts never interact and prices do not depend on what anyone
+    # traded, so every account's k-th order (whatever its step) can be
+    # applied together: round k is one set of array operations over distinct
+    # accounts, and there are as many rounds as the busiest account has
+    # orders, however many steps the prices cover.
+    n = len(steps)
+    by_account = np.lexsort((np.arange(n), steps, accounts))
+    grouped = np.ones(n, dtype=bool)
+    grouped[1:] = accounts[by_account][1:] != accounts[by_account][:-1]
+    first = np.maximum.accumulate(np.where(grouped, np.arange(n), 0))
+    rank = np.arange(n) - first
+    ordered = by_account[np.argsort(rank, kind="stable")]
+    rounds = np.bincount(rank)
+    bounds = np.concatenate(([0], np.cumsum(rounds)))
+
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        index = ordered[a:b]
+        acc, sym, qty, side = accounts[index], symbols[index], quantities[index], sides[index]
+        price = prices[steps[index], sym]
+        cost = price * qty
+        funds = balance[acc] * 100
+        position = held[acc, sym]
+        priced = price > 0
+
+        buy = priced & (side == BUY)
+        sell = priced & (side == SELL)
+        buy_ok = buy & (funds >= cost)
+        sell_ok = sell & (position >= qty)
+
+        result = np.full(len(index), NO_PRICE, dtype=np.int8)
+        result[buy & ~buy_ok] = INSUFFICIENT_BALANCE
+        result[sell & ~sell_ok] = NOT_ENOUGH_STOCK
+        result[buy_ok | sell_ok] = FILLED
+        status[index] = result
+
+        if buy_ok.any():
+            acc_b, sym_b = acc[buy_ok], sym[buy_ok]
+            balance[acc_b] = (funds[buy_ok] - cost[buy_ok] + 50) // 100
+            held[acc_b, sym_b] = position[buy_ok] + qty[buy_ok]
+            cost_basis[acc_b, sym_b] += (cost[buy_ok] + 50) // 100
+        if sell_ok.any():
+            acc_s, sym_s = acc[sell_ok], sym[sell_ok]
+            balance[acc_s] = (funds[sell_ok] + cost[sell_ok] + 50) // 100
+            basis, before = cost_basis[acc_s, sym_s], position[sell_ok]
+            remaining = before - qty[sell_ok]
+            released = np.where(remaining == 0, basis, (2 * basis * qty[sell_ok] + before) // (2 * before))
+            held[acc_s, sym_s] = remaining
+            cost_basis[acc_s, sym_s] = basis - released
+            pnl[acc_s, sym_s] += _round(np, cost[sell_ok] - released * 100, 100)
+
+    logger.info(f"Backtest: {n} orders in {len(rounds)} rounds, {int((status == FILLED).sum())} filled")
+    return BacktestResult(balance, held, _averages(np, held, cost_basis), cost_basis, pnl, status)
+
+
+def _averages(np, held, cost_basis):
+    # average_price = cost_basis / quantity in cents, 0 for closed positions.
+    safe = np.where(held > 0, held, 1)
+    return np.where(held > 0, (200 * cost_basis + safe) // (2 * safe), 0)
+
+
+def equity(result, price_row):
+    # Per-account balance plus positions marked at `price_row`, in cents.
+    np = _numpy()
+    marked = (result.quantities * np.asarray(price_row, dtype=np.int64)).sum(axis=1)
+    return result.balances + (marked + 50) // 100
+
+
+def load_prices(symbols, interval="1m", start=None, end=None):
+    # Close prices from PriceBar as a (T, S) cents matrix over every bar start
+    # seen for any of `symbols`, carried forward over gaps.
+    np = _numpy()
+    column = {symbol: i for i, symbol in enumerate(symbols)}
+    bars = PriceBar.objects.filter(symbol__in=column, interval=interval)
+    if start is not None:
+        bars = bars.filter(start__gte=start)
+    if end is not None:
+        bars = bars.filter(start__lt=end)
+    rows = list(bars.order_by("start").values_list("start", "symbol", "close").iterator(chunk_size=10000))
+
+    times = sorted({row[0] for row in rows})
+    position = {moment: i for i, moment in enumerate(times)}
+    matrix = np.zeros((len(times), len(symbols)), dtype=np.int64)
+    if rows:
+        t = np.fromiter((position[row[0]] for row in rows), dtype=np.int64, count=len(rows))
+        s = np.fromiter((column[row[1]] for row in rows), dtype=np.int64, count=len(rows))
+        matrix[t, s] = to_hundredths([row[2] for row in rows])
+        seen = np.where(matrix > 0, np.arange(len(times))[:, None], 0)
+        matrix = matrix[np.maximum.accumulate(seen, axis=0), np.arange(len(symbols))]
+    return times, matrix
+
+
+def load_accounts(account_ids, symbols):
+    # Current balances and positions, as run_backtest's starting state.
+    np = _numpy()
+    row = {account_id: i for i, account_id in enumerate(account_ids)}
+    column = {symbol: i for i, symbol in enumerate(symbols)}
+    balances = np.zeros(len(account_ids), dtype=np.int64)
+    for account_id, balance in Account.objects.filter(id__in=row).values_list("id", "balance"):
+        balances[row[account_id]] = int(balance * 100)
+    held = np.zeros((len(account_ids), len(symbols)), dtype=np.int64)
+    costs = np.zeros_like(held)
+    realized = np.zeros_like(held)
+    positions = Position.objects.filter(account_id__in=row, symbol__in=column).values_list(
+        "account_id", "symbol", "quantity", "cost_basis", "realized_pnl",
+    )
+    for account_id, symbol, quantity, cost_basis, realized_pnl in positions:
+        i, j = row[account_id], column[symbol]
+        held[i, j] = int(quantity * 100)
+        costs[i, j] = int(cost_basis * 100)
+        realized[i, j] = int(realized_pnl * 100)
+    return balances, held, costs, realized
@@ -0,0 +1,112 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from accounts.models import PriceTick, PriceBar
+
+logger = logging.getLogger("trade_logger")
+
+INTERVALS = {"1m": 60, "5m": 300, "1h": 3600, "1d": 86400}
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def bucket_start(moment, seconds):
+    # Bars are aligned to UTC, so a 1d bar runs midnight to midnight UTC.
+    elapsed = int((moment - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=elapsed - elapsed % seconds)
+
+
+def record_ticks(prices, timestamp=None, volumes=None):
+    # Appends one tick per (symbol, price) and folds them into every bar
+    # interval. Only the bars these ticks fall into are read and written, so
+    # the cost depends on the batch, never on how much history exists.
+    timestamp = timestamp or timezone.now()
+    volumes = volumes or {}
+    ticks = [
+        PriceTick(symbol=symbol, price=price, volume=volumes.get(symbol, 0), timestamp=timestamp)
+        for symbol, price in prices.items()
+    ]
+    if not ticks:
+        return 0
+    with transaction.atomic():
+        PriceTick.objects.bulk_create(ticks, batch_size=1000)
+        for interval, seconds in INTERVALS.items():
+            roll_up(ticks, interval, seconds)
+    return len(ticks)
+
+
+def roll_up(ticks, interval, seconds):
+    buckets = defaultdict(list)
+    for tick in ticks:
+        buckets[(tick.symbol, bucket_start(tick.timestamp, seconds))].append(tick)
+    for group in buckets.values():
+        group.sort(key=lambda tick: tick.timestamp)
+
+    bars = _locked_bars(interval, buckets)
+    missing = [key for key in buckets if key not in bars]
+    if missing:
+        # Another writer may be opening the same bars: insert empty ones,
+        # letting theirs win, then lock whichever rows ended up stored.
+        PriceBar.objects.bulk_create([
+            PriceBar(
+                symbol=symbol, interval=interval, start=start,
+                open=buckets[(symbol, start)][0].price, high=buckets[(symbol, start)][0].price,
+                low=buckets[(symbol, start)][0].price, close=buckets[(symbol, start)][0].price,
+                volume=0, ticks=0, closed_at=EPOCH,
+            )
+            for symbol, start in missing
+        ], batch_size=1000, ignore_conflicts=True)
+        bars.update(_locked_bars(interval, {key: buckets[key] for key in missing}))
+
+    for key, group in buckets.items():
+        first, last = group[0], group[-1]
+        bar = bars[key]
+        if not bar.ticks:
+            bar.open = first.price
+        # A late tick can widen the range but must not move the close back.
+        if last.timestamp >= bar.closed_at:
+            bar.close = last.price
+            bar.closed_at = last.timestamp
+        bar.high = max(bar.high, max(tick.price for tick in group))
+        bar.low = min(bar.low, min(tick.price for tick in group))
+        bar.volume += sum(tick.volume for tick in group)
+        bar.ticks += len(group)
+    PriceBar.objects.bulk_update(
+        bars.values(), ["open", "high", "low", "close", "volume", "ticks", "closed_at"], batch_size=1000,
+    )
+
+
+def _locked_bars(interval, buckets):
+    return {
+        (bar.symbol, bar.start): bar
+        for bar in PriceBar.objects.select_for_update().filter(
+            interval=interval,
+            symbol__in={symbol for symbol, _ in buckets},
+            start__in={start for _, start in buckets},
+        )
+        if (bar.symbol, bar.start) in buckets
+    }
+
+
+def get_bars(symbol, interval, start=None, end=None, limit=None):
+    # Newest `limit` bars in [start, end), returned oldest first for charting.
+    limit = min(limit or settings.BAR_PAGE_SIZE, settings.BAR_MAX_PAGE_SIZE)
+    bars = PriceBar.objects.filter(symbol=symbol, interval=interval)
+    if start is not None:
+        bars = bars.filter(start__gte=start)
+    if end is not None:
+        bars = bars.filter(start__lt=end)
+    rows = bars.order_by("-start").values("start", "open", "high", "low", "close", "volume")[:limit]
+    return list(reversed(rows))
+
+
+def prune_ticks(days=None):
+    # Bars are the long-term history; raw ticks are kept for replays only.
+    days = settings.PRICE_TICK_RETENTION_DAYS if days is None else days
+    cutoff = timezone.now() - timedelta(days=days)
+    deleted, _ = PriceTick.objects.filter(timestamp__lt=cutoff).delete()
+    logger.info(f"Pruned {deleted} price ticks older than {days} days")
+    return deleted
@@ -0,0 +1,228 @@
+from collections import defaultdict
+from datetime import timedelta
+import json
+import logging
+import os
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Min
+from django.utils import timezone
+from accounts.models import Trade, Ledger, Position
+
+logger = logging.getLogger("trade_logger")
+
+STATE_FILE = "_state.json"
+
+
+def _arrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImproperlyConfigured("Analytics export needs pyarrow (pip install pyarrow).")
+    return pyarrow, pyarrow.parquet
+
+
+def _schemas(pa):
+    money = pa.decimal128(12, 2)
+    ts = pa.timestamp("us", tz="UTC")
+    return {
+        "trades": pa.schema([
+            ("id", pa.int64()),
+            ("account_id", pa.int64()),
+            ("symbol", pa.string()),
+            ("transaction_type", pa.string()),
+            ("price", pa.decimal128(10, 2)),
+            ("quantity", pa.decimal128(10, 2)),
+            ("realized_pnl", pa.decimal128(14, 2)),
+            ("timestamp", ts),
+        ]),
+        "ledger": pa.schema([
+            ("id", pa.int64()),
+            ("account_id", pa.int64()),
+            ("transaction_type", pa.string()),
+            ("amount", money),
+            ("timestamp", ts),
+        ]),
+        "positions": pa.schema([
+            ("id", pa.int64()),
+            ("account_id", pa.int64()),
+            ("symbol", pa.string()),
+            ("quantity", money),
+            ("average_price", money),
+            ("cost_basis", pa.decimal128(14, 2)),
+            ("realized_pnl", pa.decimal128(14, 2)),
+            ("created_at", ts),
+        ]),
+    }
+
+
+# dataset -> (model, partition columns derived from each row)
+INCREMENTAL = {
+    "trades": (Trade, lambda row: (("date", row[7].date().isoformat()), ("symbol", row[2]))),
+    "ledger": (Ledger, lambda row: (("date", row[4].date().isoformat()),)),
+}
+
+
+def export_dir():
+    return str(settings.EXPORT_DIR)
+
+
+def load_state():
+    path = os.path.join(export_dir(), STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state):
+    os.makedirs(export_dir(), exist_ok=True)
+    path = os.path.join(export_dir(), STATE_FILE)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def _table(pa, schema, rows):
+    columns = list(zip(*rows))
+    return pa.Table.from_arrays(
+        [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+        schema=schema,
+    )
+
+
+def _write(pa, pq, schema, rows, directory, name):
+    os.makedirs(directory, exist_ok=True)
+    pq.write_table(_table(pa, schema, rows), os.path.join(directory, name), compression="zstd")
+
+
+def export_incremental(dataset, batch_size=None):
+    # Appends rows with a primary key above the last exported one. Each batch
+    # is written as part-<first id>-<last id>.parquet inside its partitions.
+    # The files of a batch are recorded in the state before they are written
+    # and the batch is only marked done once all of them are, so a run that
+    # crashed part way is cleaned up by the next one instead of duplicating.
+    pa, pq = _arrow()
+    schema = _schemas(pa)[dataset]
+    model, partition_of = INCREMENTAL[dataset]
+    batch_size = batch_size or settings.EXPORT_BATCH_SIZE
+
+    state = load_state()
+    discard_unfinished(state, dataset)
+    last_id = state.get(dataset, 0)
+    # Stop at the first id still inside the lag window; it and every id after
+    # it wait for a later run. Ids do not follow timestamps (fills carry their
+    # match time, settlement stamps a batch before inserting it), so exporting
+    # older rows past it would move the watermark over it for good. The lag
+    # covers transactions still open at the cutoff, provided they commit
+    # within EXPORT_LAG_SECONDS of their rows' timestamps.
+    cutoff = timezone.now() - timedelta(seconds=settings.EXPORT_LAG_SECONDS)
+    unexported = model.objects.filter(id__gt=last_id)
+    first_recent = unexported.filter(timestamp__gte=cutoff).aggregate(first=Min("id"))["first"]
+    if first_recent is not None:
+        unexported = unexported.filter(id__lt=first_recent)
+    rows = (
+        unexported.order_by("id")
+        .values_list(*schema.names)
+        .iterator(chunk_size=batch_size)
+    )
+
+    exported = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            exported += _flush(pa, pq, schema, dataset, partition_of, batch, state)
+            batch = []
+    if batch:
+        exported += _flush(pa, pq, schema, dataset, partition_of, batch, state)
+    return exported
+
+
+def discard_unfinished(state, dataset):
+    # Files of a batch that was being written when an earlier run stopped.
+    # Their rows are above the saved id, so they are exported again.
+    paths = state.get("pending", {}).pop(dataset, [])
+    for path in paths:
+        try:
+            os.remove(os.path.join(export_dir(), path))
+        except FileNotFoundError:
+            pass
+    if paths:
+        logger.warning(f"Removed {len(paths)} {dataset} files left by an unfinished export")
+        save_state(state)
+
+
+def _flush(pa, pq, schema, dataset, partition_of, batch, state):
+    name = f"part-{batch[0][0]}-{batch[-1][0]}.parquet"
+    partitions = defaultdict(list)
+    for row in batch:
+        partitions[partition_of(row)].append(row)
+    directories = {
+        partition: os.path.join(dataset, *(f"{key}={value}" for key, value in partition))
+        for partition in partitions
+    }
+    state.setdefault("pending", {})[dataset] = [os.path.join(directory, name) for directory in directories.values()]
+    save_state(state)
+    for partition, rows in partitions.items():
+        _write(pa, pq, schema, rows, os.path.join(export_dir(), directories[partition]), name)
+    state[dataset] = batch[-1][0]
+    del state["pending"][dataset]
+    save_state(state)
+    return len(batch)
+
+
+def export_positions_snapshot():
+    # Positions are updated in place, so they are exported as a full snapshot
+    # per day rather than appended.
+    pa, pq = _arrow()
+    schema = _schemas(pa)["positions"]
+    batch_size = settings.EXPORT_BATCH_SIZE
+    directory = os.path.join(export_dir(), "positions", f"snapshot_date={timezone.localdate().isoformat()}")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "part-0.parquet")
+    # Readers skip files starting with "_", so a half-written snapshot is never seen.
+    tmp = os.path.join(directory, "_part-0.parquet.tmp")
+
+    exported = 0
+    batch = []
+    with pq.ParquetWriter(tmp, schema, compression="zstd") as writer:
+        for row in Position.objects.order_by("id").values_list(*schema.names).iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) == batch_size:
+                writer.write_table(_table(pa, schema, batch))
+                exported += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(_table(pa, schema, batch))
+            exported += len(batch)
+    os.replace(tmp, path)
+    return exported
+
+
+def export_all():
+    os.makedirs(export_dir(), exist_ok=True)
+    result = {dataset: export_incremental(dataset) for dataset in INCREMENTAL}
+    result["positions"] = export_positions_snapshot()
+    logger.info(f"Analytics export: {result}")
+    return result
+
+
+def read_dataset(dataset, filters=None, columns=None):
+    # Memory-mapped, partition-pruned read for analysts, e.g.
+    # read_dataset("trades", [("date", ">=", "2025-09-01"), ("symbol", "=", "AAPL")]).
+    pa, pq = _arrow()
+    import pyarrow.dataset as ds
+
+    keys = {"trades": ["date", "symbol"], "ledger": ["date"], "positions": ["snapshot_date"]}[dataset]
+    partitioning = ds.partitioning(pa.schema([(key, pa.string()) for key in keys]), flavor="hive")
+    return pq.read_table(
+        os.path.join(export_dir(), dataset),
+        columns=columns,
+        filters=filters,
+        partitioning=partitioning,
+        memory_map=True,
+    )
@@ -0,0 +1,217 @@
+import codecs
+import csv
+from decimal import Decimal, InvalidOperation
+import json
+import logging
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from accounts.models import Stock
+from accounts.api.bars import record_ticks
+from accounts.api.portfolio import refresh_portfolios_for_symbols
+from accounts.api.price_cache import set_quotes
+
+logger = logging.getLogger("trade_logger")
+
+MAX_LENGTH = {field: Stock._meta.get_field(field).max_length for field in ("symbol", "name", "exchange")}
+MAX_PRICE = Decimal(10) ** (Stock._meta.get_field("price").max_digits - 2)
+# JSON bodies are read this many characters at a time; one list item may be
+# at most JSON_MAX_ITEM characters long.
+JSON_CHUNK = 64 * 1024
+JSON_MAX_ITEM = 1024 * 1024
+
+
+class CSVStreamParser(BaseParser):
+    # Yields one dict per CSV row (header: symbol,name,exchange[,price]) while
+    # the body is still being read, so a full listing is never held in memory.
+    media_type = "text/csv"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if stream is None:
+            return iter(())
+        return csv.DictReader(codecs.getreader("utf-8")(stream))
+
+
+class NDJSONStreamParser(BaseParser):
+    # One JSON object per line.
+    media_type = "application/x-ndjson"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if stream is None:
+            return iter(())
+        return _json_lines(codecs.getreader("utf-8")(stream))
+
+
+class JSONArrayStreamParser(BaseParser):
+    # A JSON list is yielded one item at a time while the body is still being
+    # read, like NDJSON. Any other JSON value is returned as it is.
+    media_type = "application/json"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if stream is None:
+            return iter(())
+        reader = _JSONReader(codecs.getreader("utf-8")(stream))
+        if reader.peek() == "[":
+            reader.position += 1
+            return reader.items()
+        value = reader.value()
+        reader.end()
+        return value
+
+
+class _JSONReader:
+    # Decodes JSON values one at a time from a text stream read JSON_CHUNK
+    # characters at a time, so it holds one value plus a chunk in memory.
+    def __init__(self, stream):
+        self.stream = stream
+        self.text = ""
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        chunk = self.stream.read(JSON_CHUNK)
+        self.text = self.text[self.position:] + chunk
+        self.position = 0
+        return bool(chunk)
+
+    def peek(self):
+        # The next non-whitespace character, or None at the end of the body.
+        while True:
+            while self.position < len(self.text) and self.text[self.position] in " \t\n\r":
+                self.position += 1
+            if self.position < len(self.text):
+                return self.text[self.position]
+            if not self.fill():
+                return None
+
+    def value(self):
+        if self.peek() in (None, ",", "]"):
+            raise ParseError("JSON parse error - expecting a value")
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.position)
+            except ValueError as e:
+                # Most likely cut off at the end of the chunk: read on.
+                if len(self.text) - self.position > JSON_MAX_ITEM:
+                    raise ParseError(f"JSON parse error - item longer than {JSON_MAX_ITEM} characters")
+                if not self.fill():
+                    raise ParseError(f"JSON parse error - {e}")
+                continue
+            # A number ending the chunk may go on in the next one.
+            if end == len(self.text) and self.fill():
+                continue
+            self.position = end
+            return value
+
+    def items(self):
+        if self.peek() == "]":
+            self.position += 1
+        else:
+            while True:
+                yield self.value()
+                separator = self.peek()
+                self.position += 1
+                if separator == "]":
+                    break
+                if separator != ",":
+                    raise ParseError("JSON parse error - expecting ',' or ']' between list items")
+        self.end()
+
+    def end(self):
+        if self.peek() is not None:
+            raise ParseError("JSON parse error - extra data after the value")
+
+
+def _json_lines(lines):
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise ParseError(f"Line {number}: {e}")
+
+
+def clean_row(row):
+    # Returns (values, None) or (None, errors) with the same messages the
+    # StockSerializer would give, without building a serializer per row.
+    if not isinstance(row, dict):
+        return None, {"non_field_errors": ["Invalid data. Expected a dictionary."]}
+    values, errors = {}, {}
+    for field, max_length in MAX_LENGTH.items():
+        value = row.get(field)
+        value = "" if value is None else str(value).strip()
+        if not value:
+            errors[field] = ["This field is required."]
+        elif len(value) > max_length:
+            errors[field] = [f"Ensure this field has no more than {max_length} characters."]
+        values[field] = value
+
+    price = row.get("price")
+    if price is None or price == "":
+        # No price: keep whatever the row already has (0.00 for new symbols).
+        values["price"] = None
+    else:
+        try:
+            price = Decimal(str(price).strip())
+            if not price.is_finite():
+                raise InvalidOperation
+        except InvalidOperation:
+            errors["price"] = ["A valid number is required."]
+        else:
+            if price.as_tuple().exponent < -2:
+                errors["price"] = ["Ensure that there are no more than 2 decimal places."]
+            elif abs(price) >= MAX_PRICE:
+                errors["price"] = [f"Ensure that there are no more than {len(str(MAX_PRICE)) - 1} digits before the decimal point."]
+            values["price"] = price
+
+    if errors:
+        return None, errors
+    return values, None
+
+
+def upsert_stocks(rows, chunk_size=None):
+    # Inserts new symbols and updates existing ones in chunks, so loading the
+    # same listing twice leaves the table unchanged. Invalid rows are skipped
+    # and reported by their 0-based position in the input.
+    chunk_size = chunk_size or settings.STOCK_INGEST_CHUNK_SIZE
+    received, saved, errors = 0, 0, []
+    chunk = {}
+    for index, row in enumerate(rows):
+        received += 1
+        values, row_errors = clean_row(row)
+        if row_errors:
+            errors.append({"row": index, "errors": row_errors})
+            continue
+        # A symbol repeated within a chunk: the later row wins.
+        chunk[values["symbol"]] = values
+        if len(chunk) == chunk_size:
+            saved += _save_chunk(chunk)
+            chunk = {}
+    if chunk:
+        saved += _save_chunk(chunk)
+    logger.info(f"Stock ingest: {received} rows, {saved} upserted, {len(errors)} rejected")
+    return {"received": received, "upserted": saved, "errors": errors}
+
+
+def _save_chunk(chunk):
+    priced = [Stock(**values) for values in chunk.values() if values["price"] is not None]
+    unpriced = [
+        Stock(symbol=values["symbol"], name=values["name"], exchange=values["exchange"])
+        for values in chunk.values() if values["price"] is None
+    ]
+    if priced:
+        Stock.objects.bulk_create(
+            priced, update_conflicts=True, unique_fields=["symbol"], update_fields=["name", "exchange", "price"],
+        )
+    if unpriced:
+        Stock.objects.bulk_create(
+            unpriced, update_conflicts=True, unique_fields=["symbol"], update_fields=["name", "exchange"],
+        )
+    # Re-read so the cache gets the stored price of rows that did not send one.
+    set_quotes(Stock.objects.filter(symbol__in=list(chunk)).only("symbol", "name", "exchange", "price"))
+    if priced:
+        record_ticks({stock.symbol: stock.price for stock in priced})
+        refresh_portfolios_for_symbols([stock.symbol for stock in priced])
+    return len(chunk)
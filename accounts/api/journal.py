@@ -0,0 +1,286 @@
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from accounts.models import Account, Position, TradeEvent, AccountSnapshot
+
+logger = logging.getLogger("trade_logger")
+
+ZERO = Decimal("0.00")
+CENT = Decimal("0.01")
+
+# Accounts known to have a snapshot, so writers skip the lookup after the
+# first batch in each process.
+_snapshotted = set()
+
+
+def position_state(position):
+    if position is None:
+        return ZERO, ZERO, ZERO
+    return position.quantity, position.cost_basis, position.realized_pnl
+
+
+def trade_event(account, symbol, trade_type, quantity, price, cash, before, position, order_id=None, timestamp=None):
+    # `before` is position_state() taken just ahead of the fill; the event
+    # stores the differences so replay never has to redo the arithmetic.
+    quantity_after, cost_after, pnl_after = position_state(position)
+    return TradeEvent(
+        account=account,
+        order_id=order_id,
+        symbol=symbol,
+        transaction_type=trade_type,
+        quantity=quantity,
+        price=price,
+        cash_delta=cash,
+        quantity_delta=quantity_after - before[0],
+        cost_delta=cost_after - before[1],
+        pnl_delta=pnl_after - before[2],
+        timestamp=timestamp or timezone.now(),
+    )
+
+
+def live_snapshots(accounts, event_id):
+    # Snapshots of the accounts' live rows; they must be locked.
+    positions = defaultdict(dict)
+    rows = Position.objects.filter(account_id__in=[a.id for a in accounts])
+    for account_id, symbol, quantity, cost_basis, realized_pnl in rows.values_list(
+        "account_id", "symbol", "quantity", "cost_basis", "realized_pnl",
+    ):
+        positions[account_id][symbol] = [str(quantity), str(cost_basis), str(realized_pnl)]
+    return [
+        AccountSnapshot(account=account, event_id=event_id, balance=account.balance, positions=positions[account.id])
+        for account in accounts
+    ]
+
+
+def ensure_snapshots(accounts):
+    # Gives every account its starting snapshot before its first event is
+    # journaled. Call with the accounts locked and not yet modified.
+    pending = {account.id: account for account in accounts if account.id not in _snapshotted}
+    if not pending:
+        return
+    have = set(AccountSnapshot.objects.filter(account_id__in=pending).values_list("account_id", flat=True).distinct())
+    missing = [account for account_id, account in pending.items() if account_id not in have]
+    if missing:
+        AccountSnapshot.objects.bulk_create(live_snapshots(missing, 0))
+    # Only remember them once this transaction has committed.
+    ids = list(pending)
+    transaction.on_commit(lambda: _snapshotted.update(ids))
+
+
+class IncompleteJournal(Exception):
+    def __init__(self, account_ids):
+        self.account_ids = account_ids
+        super().__init__(f"Journal may be missing events for accounts {account_ids}")
+
+
+class AccountState:
+    __slots__ = ("account_id", "event_id", "balance", "positions", "complete")
+
+    def __init__(self, snapshot):
+        self.account_id = snapshot.account_id
+        self.event_id = snapshot.event_id
+        self.complete = snapshot.complete
+        self.balance = snapshot.balance
+        self.positions = {
+            symbol: [Decimal(quantity), Decimal(cost), Decimal(pnl)]
+            for symbol, (quantity, cost, pnl) in snapshot.positions.items()
+        }
+
+    def apply(self, event_id, symbol, cash, quantity, cost, pnl):
+        self.event_id = event_id
+        self.balance += cash
+        position = self.positions.setdefault(symbol, [ZERO, ZERO, ZERO])
+        position[0] += quantity
+        position[1] += cost
+        position[2] += pnl
+
+    def snapshot(self, event_id=None):
+        return AccountSnapshot(
+            account_id=self.account_id,
+            event_id=self.event_id if event_id is None else event_id,
+            balance=self.balance,
+            positions={symbol: [str(v) for v in values] for symbol, values in self.positions.items()},
+            complete=self.complete,
+        )
+
+
+def latest_snapshots(account_ids):
+    latest = {}
+    for snapshot in AccountSnapshot.objects.filter(account_id__in=account_ids).order_by("account_id", "-event_id", "-id"):
+        latest.setdefault(snapshot.account_id, snapshot)
+    return latest
+
+
+def replay(account_ids, until=None):
+    # Rebuilds each account from its latest snapshot plus the events after
+    # it (up to event id `until`): two queries for the whole chunk. Accounts
+    # that were never journaled are left out.
+    snapshots = latest_snapshots(account_ids)
+    states = {account_id: AccountState(snapshot) for account_id, snapshot in snapshots.items()}
+    if not states:
+        return states
+    start = min(state.event_id for state in states.values())
+    events = TradeEvent.objects.filter(account_id__in=states, id__gt=start)
+    if until is not None:
+        events = events.filter(id__lte=until)
+    events = (
+        events.order_by("id")
+        .values_list("id", "account_id", "symbol", "cash_delta", "quantity_delta", "cost_delta", "pnl_delta")
+        .iterator(chunk_size=settings.JOURNAL_CHUNK_SIZE)
+    )
+    for event_id, account_id, *change in events:
+        state = states[account_id]
+        if event_id > state.event_id:
+            state.apply(event_id, *change)
+    return states
+
+
+def _average(quantity, cost):
+    return (cost / quantity).quantize(CENT, rounding=ROUND_HALF_UP) if quantity > 0 else ZERO
+
+
+def reconcile(account_ids, repair=False):
+    # Compares the replayed journal with the live rows and returns one
+    # {"account_id", "field", "journal", "live"} dict per difference. With
+    # `repair` the rows are rewritten from the journal under the account lock,
+    # which raises IncompleteJournal if any of them has an incomplete snapshot.
+    mismatches = []
+    with transaction.atomic():
+        accounts = Account.objects.filter(id__in=account_ids).order_by("id")
+        if repair:
+            accounts = accounts.select_for_update()
+        accounts = {account.id: account for account in accounts}
+        states = replay(list(accounts))
+        if repair:
+            incomplete = sorted(account_id for account_id, state in states.items() if not state.complete)
+            if incomplete:
+                raise IncompleteJournal(incomplete)
+        live = defaultdict(dict)
+        for position in Position.objects.filter(account_id__in=states):
+            live[position.account_id][position.symbol] = position
+
+        changed_accounts, changed_positions, created_positions = [], [], []
+        for account_id, state in states.items():
+            account = accounts[account_id]
+            if account.balance != state.balance:
+                mismatches.append({"account_id": account_id, "field": "balance", "journal": state.balance, "live": account.balance})
+                account.balance = state.balance
+                changed_accounts.append(account)
+            held = live[account_id]
+            for symbol in sorted(set(state.positions) | set(held)):
+                quantity, cost, pnl = state.positions.get(symbol, (ZERO, ZERO, ZERO))
+                position = held.get(symbol)
+                found = position_state(position)
+                if found == (quantity, cost, pnl):
+                    continue
+                mismatches.append({
+                    "account_id": account_id,
+                    "field": f"position:{symbol}",
+                    "journal": [quantity, cost, pnl],
+                    "live": list(found) if position else None,
+                })
+                if position is None:
+                    created_positions.append(Position(
+                        account=account, symbol=symbol, quantity=quantity, cost_basis=cost,
+                        realized_pnl=pnl, average_price=_average(quantity, cost),
+                    ))
+                else:
+                    position.quantity, position.cost_basis, position.realized_pnl = quantity, cost, pnl
+                    position.average_price = _average(quantity, cost)
+                    changed_positions.append(position)
+
+        if repair:
+            if changed_accounts:
+                Account.objects.bulk_update(changed_accounts, ["balance"])
+            if changed_positions:
+                Position.objects.bulk_update(
+                    changed_positions, ["quantity", "average_price", "cost_basis", "realized_pnl"],
+                )
+            if created_positions:
+                Position.objects.bulk_create(created_positions)
+    return len(states), mismatches
+
+
+def journaled_accounts():
+    return AccountSnapshot.objects.values_list("account_id", flat=True).distinct().order_by("account_id")
+
+
+def incomplete_accounts(account_ids=None):
+    # Accounts whose latest snapshot may be missing events.
+    if account_ids is None:
+        account_ids = list(journaled_accounts())
+    return sorted(account_id for account_id, snapshot in latest_snapshots(account_ids).items() if not snapshot.complete)
+
+
+def _lock(account_ids):
+    return list(Account.objects.select_for_update().filter(id__in=account_ids).order_by("id"))
+
+
+def _high_water():
+    # Every event is written with its account locked, so once a set of
+    # accounts is locked none of their events is in flight: the highest id
+    # committed now covers all of theirs, and any they get later is higher.
+    return TradeEvent.objects.aggregate(last=Max("id"))["last"] or 0
+
+
+def _prune(account_ids):
+    seen = defaultdict(int)
+    stale = []
+    for account_id, snapshot_id in (
+        AccountSnapshot.objects.filter(account_id__in=account_ids)
+        .order_by("account_id", "-event_id", "-id")
+        .values_list("account_id", "id")
+    ):
+        seen[account_id] += 1
+        if seen[account_id] > 2:
+            stale.append(snapshot_id)
+    if stale:
+        AccountSnapshot.objects.filter(id__in=stale).delete()
+
+
+def snapshot_accounts(chunk_size=None):
+    # Periodic snapshots keep replay tails short. Each run snapshots the
+    # accounts with events since the previous run, one locked chunk at a time
+    # at the high-water mark read under the lock, then drops all but their two
+    # newest snapshots.
+    chunk_size = chunk_size or settings.JOURNAL_CHUNK_SIZE
+    high_water = _high_water()
+    if not high_water:
+        return 0
+    previous = AccountSnapshot.objects.aggregate(last=Max("event_id"))["last"] or 0
+    # An account whose events commit after this read is picked up by the
+    # next run it trades in; its replay tail just grows until then.
+    account_ids = list(
+        TradeEvent.objects.filter(id__gt=previous, id__lte=high_water)
+        .values_list("account_id", flat=True).distinct().order_by("account_id")
+    )
+
+    for i in range(0, len(account_ids), chunk_size):
+        chunk = account_ids[i:i + chunk_size]
+        with transaction.atomic():
+            _lock(chunk)
+            high_water = _high_water()
+            states = replay(chunk, until=high_water)
+            AccountSnapshot.objects.bulk_create([state.snapshot(high_water) for state in states.values()])
+        _prune(chunk)
+    logger.info(f"Snapshotted {len(account_ids)} accounts at event {high_water}")
+    return len(account_ids)
+
+
+def rebase(account_ids, chunk_size=None):
+    # Restarts the journal of the accounts from their live rows, taken as
+    # correct, with a complete snapshot. For accounts --repair refuses.
+    chunk_size = chunk_size or settings.JOURNAL_CHUNK_SIZE
+    for i in range(0, len(account_ids), chunk_size):
+        chunk = account_ids[i:i + chunk_size]
+        with transaction.atomic():
+            accounts = _lock(chunk)
+            AccountSnapshot.objects.bulk_create(live_snapshots(accounts, _high_water()))
+        _prune(chunk)
+    logger.info(f"Rebased the journal of {len(account_ids)} accounts on their live rows")
+    return len(account_ids)
@@ -0,0 +1,534 @@
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, deque, namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+import json
+import logging
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, transaction
+from django.utils import timezone
+from accounts.models import Account, Ledger, Trade, TradeEvent, Order as OrderRecord
+from accounts.api.settlement import PositionChanges, db_round, get_queue
+from accounts.api.portfolio import refresh_portfolios
+from accounts.api.streaming import publish_order_updates
+from accounts.api.journal import ensure_snapshots, position_state, trade_event
+from accounts.api import risk
+from core import db_router
+
+logger = logging.getLogger("trade_logger")
+
+BUY = "buy"
+SELL = "sell"
+
+CENT = Decimal("0.01")
+# Fills that kept failing to persist, as JSON, for someone to look at.
+QUARANTINE_KEY = "matching:quarantine"
+# Errors that say nothing about the fill itself.
+DATABASE_DOWN = (OperationalError, InterfaceError)
+
+# Prices are kept as integer cents and quantities as integer hundredths, so a
+# notional (price * quantity) is an integer in units of 1/10000. The limits
+# are the orders' own, None for market orders.
+Fill = namedtuple("Fill", [
+    "symbol", "price", "quantity",
+    "buy_order_id", "buy_account_id", "buy_limit",
+    "sell_order_id", "sell_account_id", "sell_limit",
+    "timestamp",
+])
+
+
+class OrderRejected(Exception):
+    pass
+
+
+def to_units(value):
+    return int((Decimal(value).quantize(CENT, rounding=ROUND_HALF_UP) * 100).to_integral_value())
+
+
+def from_units(units, places=2):
+    return Decimal(units).scaleb(-places)
+
+
+class Order:
+    __slots__ = ("id", "account_id", "symbol", "side", "price", "limit", "quantity", "remaining")
+
+    def __init__(self, id, account_id, symbol, side, price, quantity):
+        self.id = id
+        self.account_id = account_id
+        self.symbol = symbol
+        self.side = side
+        self.price = price
+        # Per-unit price the buyer's cash was reserved at; market buys reserve at the fill price.
+        self.limit = price
+        self.quantity = quantity
+        self.remaining = quantity
+
+
+class PriceLevels:
+    # One side of a book. Level keys live in a sorted array with the best level
+    # at the end, so taking and removing the top of book is O(1). Asks are keyed
+    # by the negated price so both sides sort the same way.
+
+    def __init__(self, side):
+        self.sign = 1 if side == BUY else -1
+        self.keys = array("q")
+        self.queues = {}
+
+    def __bool__(self):
+        return bool(self.keys)
+
+    def best_price(self):
+        return self.keys[-1] * self.sign if self.keys else None
+
+    def best_queue(self):
+        return self.queues[self.keys[-1]]
+
+    def pop_best(self):
+        del self.queues[self.keys.pop()]
+
+    def add(self, order):
+        key = order.price * self.sign
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            self.keys.insert(bisect_left(self.keys, key), key)
+        queue.append(order)
+
+    def remove(self, order):
+        key = order.price * self.sign
+        queue = self.queues[key]
+        queue.remove(order)
+        if not queue:
+            del self.queues[key]
+            del self.keys[bisect_left(self.keys, key)]
+
+    def levels(self, depth):
+        result = []
+        for key in reversed(self.keys[-depth:] if depth else self.keys):
+            result.append((key * self.sign, sum(o.remaining for o in self.queues[key])))
+        return result
+
+
+class OrderBook:
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.bids = PriceLevels(BUY)
+        self.asks = PriceLevels(SELL)
+
+    def crosses(self, order, best):
+        if order.price is None:
+            return True
+        return best <= order.price if order.side == BUY else best >= order.price
+
+    def sweep_cost(self, quantity, limit=None):
+        # Notional a buy of `quantity` would pay against the resting asks.
+        cost = 0
+        for key in reversed(self.asks.keys):
+            price = -key
+            if limit is not None and price > limit:
+                break
+            for resting in self.asks.queues[key]:
+                qty = min(quantity, resting.remaining)
+                cost += qty * price
+                quantity -= qty
+                if not quantity:
+                    return cost
+        return cost
+
+    def match(self, order):
+        fills = []
+        opposite = self.asks if order.side == BUY else self.bids
+        while order.remaining and opposite:
+            best = opposite.best_price()
+            if not self.crosses(order, best):
+                break
+            queue = opposite.best_queue()
+            resting = queue[0]
+            qty = min(order.remaining, resting.remaining)
+            order.remaining -= qty
+            resting.remaining -= qty
+            buy, sell = (order, resting) if order.side == BUY else (resting, order)
+            fills.append(Fill(
+                self.symbol, best, qty,
+                buy.id, buy.account_id, buy.limit,
+                sell.id, sell.account_id, sell.limit,
+                timezone.now(),
+            ))
+            if not resting.remaining:
+                queue.popleft()
+                if not queue:
+                    opposite.pop_best()
+        return fills
+
+    def rest(self, order):
+        (self.bids if order.side == BUY else self.asks).add(order)
+
+    def cancel(self, order):
+        (self.bids if order.side == BUY else self.asks).remove(order)
+
+    def depth(self, levels=10):
+        return {"bids": self.bids.levels(levels), "asks": self.asks.levels(levels)}
+
+
+class MatchingEngine:
+    # Keeps one price-time-priority book per symbol in memory. Orders are
+    # Order rows (the book uses their ids) and the books are rebuilt from the
+    # open ones by load(), so a restart loses nothing: fills that were matched
+    # but not yet written are simply matched again. Fills are queued in
+    # `pending` and written to the database in batches by `flush`. Cash and
+    # shares committed to open orders or unflushed fills stay reserved until
+    # the corresponding rows are persisted, so the pre-trade checks never rely
+    # on balances the database has not caught up with yet.
+
+    def __init__(self):
+        self.books = {}
+        self.orders = {}
+        self.pending = []
+        self.reserved_cash = defaultdict(int)
+        self.reserved_qty = defaultdict(int)
+        self.attempts = defaultdict(int)
+        self.loaded = False
+        # Orders put back by load(), whose submit_order task may still come.
+        self.rebuilt = set()
+
+    def book(self, symbol):
+        book = self.books.get(symbol)
+        if book is None:
+            book = self.books[symbol] = OrderBook(symbol)
+        return book
+
+    def load(self):
+        # Puts the open limit orders back on the books, oldest first, without
+        # the balance checks they passed when they were placed.
+        if self.loaded:
+            return
+        records = (
+            OrderRecord.objects.filter(status=OrderRecord.ACCEPTED, limit_price__isnull=False)
+            .order_by("id")
+            .values_list("id", "account_id", "symbol", "transaction_type", "limit_price", "quantity", "filled_quantity")
+        )
+        count = 0
+        for order_id, account_id, symbol, side, limit_price, quantity, filled in records.iterator():
+            remaining = to_units(quantity - filled)
+            if remaining <= 0 or order_id in self.orders:
+                continue
+            order = Order(order_id, account_id, symbol, side, to_units(limit_price), remaining)
+            self._reserve(order, remaining)
+            self._enter(order)
+            self.rebuilt.add(order_id)
+            count += 1
+        self.loaded = True
+        if count:
+            logger.info(f"Rebuilt the order books with {count} open orders")
+
+    def placed(self, order_id):
+        return order_id in self.orders or order_id in self.rebuilt
+
+    def place(self, order_id, account_id, symbol, side, quantity, price=None, balance=0, held=0):
+        # `balance` (1/10000 units) and `held` (hundredths) are the account's
+        # settled cash and position as last read from the database.
+        if side not in (BUY, SELL):
+            raise OrderRejected("Invalid trade type.")
+        if quantity <= 0 or (price is not None and price <= 0):
+            raise OrderRejected("Invalid order.")
+
+        book = self.book(symbol)
+        order = Order(order_id, account_id, symbol, side, price, quantity)
+
+        if side == BUY:
+            if price is None:
+                need = book.sweep_cost(quantity)
+            else:
+                need = price * quantity
+            if balance - self.reserved_cash[account_id] < need:
+                raise OrderRejected("Insufficient balance.")
+        else:
+            if held - self.reserved_qty[(account_id, symbol)] < quantity:
+                raise OrderRejected("Not enough stock to sell.")
+        self._reserve(order, quantity)
+        return order, self._enter(order)
+
+    def _reserve(self, order, quantity):
+        # Market buys reserve their cash fill by fill, in _enter().
+        if order.side == SELL:
+            self.reserved_qty[(order.account_id, order.symbol)] += quantity
+        elif order.limit is not None:
+            self.reserved_cash[order.account_id] += order.limit * quantity
+
+    def _enter(self, order):
+        book = self.book(order.symbol)
+        fills = book.match(order)
+        for fill in fills:
+            if fill.buy_order_id == order.id and order.limit is None:
+                self.reserved_cash[order.account_id] += fill.price * fill.quantity
+            resting_id = fill.sell_order_id if order.side == BUY else fill.buy_order_id
+            resting = self.orders.get(resting_id)
+            if resting is not None and not resting.remaining:
+                del self.orders[resting_id]
+        self.pending.extend(fills)
+
+        if order.remaining:
+            if order.price is None:
+                self._release(order)
+            else:
+                book.rest(order)
+                self.orders[order.id] = order
+        return fills
+
+    def cancel(self, order_id, account_id=None):
+        order = self.orders.get(order_id)
+        if order is None or (account_id is not None and order.account_id != account_id):
+            return None
+        self.book(order.symbol).cancel(order)
+        del self.orders[order_id]
+        self._release(order)
+        return order
+
+    def _release(self, order):
+        if order.side == BUY:
+            if order.limit is not None:
+                self.reserved_cash[order.account_id] -= order.remaining * order.limit
+        else:
+            self.reserved_qty[(order.account_id, order.symbol)] -= order.remaining
+        order.remaining = 0
+
+    def _restore(self, order_id, account_id, symbol, side, limit, quantity):
+        # Gives an order back the quantity of a fill that was turned down,
+        # putting it back on the book (and matching it again) if it had left.
+        order = self.orders.get(order_id)
+        if order is not None:
+            order.remaining += quantity
+            self._reserve(order, quantity)
+            return
+        order = Order(order_id, account_id, symbol, side, limit, quantity)
+        self._reserve(order, quantity)
+        self._enter(order)
+
+    def _unwind(self, fill, closed):
+        # Orders the database closed leave the book; the other side of the
+        # fill, if it is a limit order, gets its quantity back.
+        sides = (
+            (fill.buy_order_id, fill.buy_account_id, BUY, fill.buy_limit),
+            (fill.sell_order_id, fill.sell_account_id, SELL, fill.sell_limit),
+        )
+        for order_id, *_ in sides:
+            if order_id in closed:
+                self.cancel(order_id)
+        for order_id, account_id, side, limit in sides:
+            if order_id not in closed and limit is not None:
+                self._restore(order_id, account_id, fill.symbol, side, limit, fill.quantity)
+
+    def flush(self):
+        if not self.pending:
+            return 0
+        fills, self.pending = self.pending, []
+        try:
+            rejected = persist_fills(fills)
+        except DATABASE_DOWN:
+            self.pending[:0] = fills
+            raise
+        except Exception as e:
+            # Find the fill at fault instead of holding up every later one.
+            logger.error(f"Persisting {len(fills)} book fills failed, retrying them one by one: {e}")
+            rejected, retry = {}, []
+            for fill in fills:
+                try:
+                    rejected.update(persist_fills([fill]))
+                except DATABASE_DOWN:
+                    retry.append(fill)
+                except Exception as e:
+                    self.attempts[fill] += 1
+                    if self.attempts[fill] < settings.MATCHING_FILL_ATTEMPTS:
+                        retry.append(fill)
+                    else:
+                        rejected[fill] = quarantine(fill, e)
+            self.pending[:0] = retry
+            retrying = set(retry)
+            fills = [fill for fill in fills if fill not in retrying]
+        for fill in fills:
+            self.attempts.pop(fill, None)
+            buy_limit = fill.price if fill.buy_limit is None else fill.buy_limit
+            self.reserved_cash[fill.buy_account_id] -= fill.quantity * buy_limit
+            self.reserved_qty[(fill.sell_account_id, fill.symbol)] -= fill.quantity
+        for fill, closed in rejected.items():
+            self._unwind(fill, closed)
+        return len(fills)
+
+
+def quarantine(fill, error):
+    # Sets aside a fill that keeps failing and closes both of its orders, so
+    # it is neither retried nor matched again. Returns the closed order ids.
+    logger.error(f"Quarantining book fill {fill}: {error}")
+    closed = {fill.buy_order_id, fill.sell_order_id}
+    try:
+        OrderRecord.objects.filter(id__in=closed, status=OrderRecord.ACCEPTED).update(
+            status=OrderRecord.CANCELLED, reason="Fill could not be recorded.", updated_at=timezone.now(),
+        )
+    except Exception as e:
+        logger.error(f"Could not cancel the orders of quarantined fill {fill}: {e}")
+    try:
+        get_queue().rpush(QUARANTINE_KEY, json.dumps(
+            {**fill._asdict(), "timestamp": fill.timestamp.isoformat(), "error": str(error)},
+        ))
+    except Exception as e:
+        logger.error(f"Could not queue quarantined fill {fill}: {e}")
+    return closed
+
+
+def reject_order(order_id, reason):
+    # For a book order turned away before it reached the book.
+    record = OrderRecord.objects.filter(id=order_id).first()
+    if record is None or not OrderRecord.objects.filter(id=order_id, status=OrderRecord.ACCEPTED).update(
+        status=OrderRecord.REJECTED, reason=reason, updated_at=timezone.now(),
+    ):
+        return
+    risk.reconcile([record.account_id], [record.symbol])
+    publish_order_updates([(record.account_id, {
+        "type": "reject",
+        "order_id": order_id,
+        "symbol": record.symbol,
+        "side": record.transaction_type,
+        "quantity": str(record.quantity),
+        "reason": reason,
+    })])
+
+
+def _record_fill(record, quantity, price, now):
+    filled = record.filled_quantity + quantity
+    record.price = db_round(((record.price or 0) * record.filled_quantity + price * quantity) / filled)
+    record.filled_quantity = filled
+    if filled >= record.quantity:
+        record.status = OrderRecord.FILLED
+    record.updated_at = now
+
+
+@db_router.on_primary
+def persist_fills(fills):
+    # Writes the fills that still hold up under the account and order locks
+    # and returns {fill: ids of the orders it closed} for the others. A fill is
+    # turned down when either order is no longer open, when the buyer cannot
+    # pay or when the seller does not hold the shares; in the last two cases
+    # the order at fault is cancelled.
+    account_ids = {f.buy_account_id for f in fills} | {f.sell_account_id for f in fills}
+    order_ids = {f.buy_order_id for f in fills} | {f.sell_order_id for f in fills}
+    symbols = {f.symbol for f in fills}
+    rejected = {}
+    now = timezone.now()
+
+    with transaction.atomic():
+        # Lock in id order so concurrent writers cannot deadlock on each other.
+        accounts = {
+            a.id: a for a in Account.objects.select_for_update().filter(id__in=account_ids).order_by("id")
+        }
+        # A cancel waits on the order row, so it cannot slip in before the write.
+        records = {
+            r.id: r for r in OrderRecord.objects.select_for_update().filter(id__in=order_ids).order_by("id")
+        }
+        positions = PositionChanges.load(list(accounts), symbols)
+        ensure_snapshots(accounts.values())
+        ledger, trades, events, updates = [], [], [], []
+        changed = {}
+
+        for fill in fills:
+            price = from_units(fill.price)
+            quantity = from_units(fill.quantity)
+            amount = price * quantity
+
+            buyer = accounts.get(fill.buy_account_id)
+            seller = accounts.get(fill.sell_account_id)
+            buy = records.get(fill.buy_order_id)
+            sell = records.get(fill.sell_order_id)
+            closed = {
+                order_id for order_id, record in ((fill.buy_order_id, buy), (fill.sell_order_id, sell))
+                if record is None or record.status != OrderRecord.ACCEPTED
+            }
+            if not closed:
+                held = positions.get(seller.id, fill.symbol)
+                if buyer.balance < amount:
+                    at_fault, reason = buy, "Insufficient balance."
+                elif held is None or held.quantity < quantity:
+                    at_fault, reason = sell, "Not enough stock to sell."
+                else:
+                    at_fault = None
+                if at_fault is not None:
+                    logger.warning(f"Book fill on {fill.symbol} turned down, cancelling order {at_fault.id}: {reason}")
+                    at_fault.status, at_fault.reason, at_fault.updated_at = OrderRecord.CANCELLED, reason, now
+                    changed[at_fault.id] = at_fault
+                    closed = {at_fault.id}
+                    updates.append((at_fault.account_id, {
+                        "type": "cancel",
+                        "order_id": at_fault.id,
+                        "symbol": fill.symbol,
+                        "side": at_fault.transaction_type,
+                        "reason": reason,
+                    }))
+            if closed:
+                rejected[fill] = closed
+                continue
+
+            before = position_state(positions.get(buyer.id, fill.symbol))
+            buyer_cash = db_round(buyer.balance - amount) - buyer.balance
+            buyer.balance += buyer_cash
+            position = positions.buy(buyer, fill.symbol, quantity, price)
+            events.append(trade_event(
+                buyer, fill.symbol, BUY, quantity, price, buyer_cash, before, position,
+                order_id=buy.id, timestamp=fill.timestamp,
+            ))
+
+            position = positions.get(seller.id, fill.symbol)
+            before = position_state(position)
+            seller_cash = db_round(seller.balance + amount) - seller.balance
+            seller.balance += seller_cash
+            realized = positions.sell(position, quantity, price)
+            events.append(trade_event(
+                seller, fill.symbol, SELL, quantity, price, seller_cash, before, position,
+                order_id=sell.id, timestamp=fill.timestamp,
+            ))
+
+            for account, record, transaction_type, side, pnl in (
+                (buyer, buy, "withdraw", BUY, Decimal("0.00")),
+                (seller, sell, "deposit", SELL, realized),
+            ):
+                ledger.append(Ledger(account=account, transaction_type=transaction_type, amount=amount))
+                trades.append(Trade(
+                    account=account,
+                    symbol=fill.symbol,
+                    transaction_type=side,
+                    price=price,
+                    quantity=quantity,
+                    realized_pnl=pnl,
+                    timestamp=fill.timestamp,
+                ))
+                _record_fill(record, quantity, price, now)
+                changed[record.id] = record
+                updates.append((account.id, {
+                    "type": "fill",
+                    "order_id": record.id,
+                    "symbol": fill.symbol,
+                    "side": side,
+                    "quantity": str(quantity),
+                    "price": str(price),
+                }))
+
+        if trades:
+            Account.objects.bulk_update(accounts.values(), ["balance"])
+            positions.save()
+            Ledger.objects.bulk_create(ledger)
+            Trade.objects.bulk_create(trades)
+            TradeEvent.objects.bulk_create(events)
+            transaction.on_commit(lambda: refresh_portfolios(account_ids))
+            transaction.on_commit(lambda: db_router.stick_to_primary(account_ids))
+        if changed:
+            OrderRecord.objects.bulk_update(changed.values(), ["status", "price", "filled_quantity", "reason", "updated_at"])
+        transaction.on_commit(lambda: risk.reconcile(account_ids, symbols))
+        transaction.on_commit(lambda: publish_order_updates(updates))
+
+    logger.info(
+        f"Persisted {len(fills) - len(rejected)} book fills for {len(account_ids)} accounts, turned down {len(rejected)}"
+    )
+    return rejected
+
+
+# One engine per matching worker process; see CELERY_TASK_ROUTES.
+engine = MatchingEngine()
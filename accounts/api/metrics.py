@@ -0,0 +1,308 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import logging
+import os
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+
+logger = logging.getLogger("trade_logger")
+
+# Histograms and counters for the hot paths, rendered in the Prometheus text
+# format on /metrics. Recording is an in-process increment under a lock; a
+# background thread adds each process's changes to Redis hashes every
+# METRICS_FLUSH_INTERVAL seconds, so any web worker serves the totals of every
+# web and Celery process. Without Redis a process only reports its own.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = []
+_flusher_pid = None
+_flush_lock = threading.Lock()
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.flushed = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def size(self):
+        return 1
+
+    def _slot(self, labels):
+        # Call with self.lock held.
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        values = self.values.get(key)
+        if values is None:
+            values = self.values[key] = [0.0] * self.size()
+        return values
+
+    def snapshot(self):
+        with self.lock:
+            return {key: list(values) for key, values in self.values.items()}
+
+    def changes(self, snapshot):
+        # Hash fields "<slot>:<label values as JSON>" -> increment since the
+        # last successful flush.
+        fields = {}
+        for key, values in snapshot.items():
+            flushed = self.flushed.get(key) or [0.0] * len(values)
+            for index, (value, previous) in enumerate(zip(values, flushed)):
+                if value != previous:
+                    fields[f"{index}:{json.dumps(key)}"] = value - previous
+        return fields
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        _ensure_flusher()
+        with self.lock:
+            self._slot(labels)[0] += amount
+
+    def samples(self, key, values):
+        yield self.name, _labels(self.labelnames, key), values[0]
+
+
+class Histogram(Metric):
+    # Slots: one count per bucket (not cumulative), the +Inf overflow, the sum.
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def size(self):
+        return len(self.buckets) + 2
+
+    def observe(self, value, **labels):
+        _ensure_flusher()
+        with self.lock:
+            values = self._slot(labels)
+            values[bisect_left(self.buckets, value)] += 1
+            values[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self, key, values):
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), values):
+            total += count
+            yield f"{self.name}_bucket", _labels(self.labelnames + ("le",), key + (_number(bound),)), total
+        yield f"{self.name}_sum", _labels(self.labelnames, key), values[-1]
+        yield f"{self.name}_count", _labels(self.labelnames, key), total
+
+
+trade_stage_seconds = Histogram(
+    "trade_stage_seconds",
+    "Market order settlement time by stage: queue (per order, accepted to settling), "
+    "lock, settle and commit (per batch).",
+    ["stage"],
+)
+price_fetch_seconds = Histogram(
+    "price_fetch_seconds", "Time to fetch one symbol's price from the price source.", ["result"],
+)
+quote_cache_lookups_total = Counter(
+    "quote_cache_lookups_total", "Quote lookups by the layer that answered them (l1, redis or db).", ["layer"],
+)
+http_request_seconds = Histogram(
+    "http_request_seconds", "Request latency by route.", ["route", "method"],
+)
+http_request_queries = Histogram(
+    "http_request_queries", "Database queries per request by route.", ["route"], buckets=QUERY_BUCKETS,
+)
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if value != int(value) else f"{int(value)}.0"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _redis():
+    from accounts.api.price_cache import _redis
+    return _redis()
+
+
+def _hash_key(metric):
+    return f"metrics:{metric.name}"
+
+
+def flush(conn=None):
+    # Adds this process's changes since the last flush to the shared totals.
+    conn = conn or _redis()
+    if conn is None:
+        return
+    with _flush_lock:
+        snapshots = [(metric, metric.snapshot()) for metric in _registry]
+        pipe = conn.pipeline(transaction=False)
+        for metric, snapshot in snapshots:
+            for field, amount in metric.changes(snapshot).items():
+                pipe.hincrbyfloat(_hash_key(metric), field, amount)
+        pipe.execute()
+        for metric, snapshot in snapshots:
+            metric.flushed = snapshot
+
+
+def _flush_loop(conn):
+    while True:
+        time.sleep(settings.METRICS_FLUSH_INTERVAL)
+        try:
+            flush(conn)
+        except Exception as e:
+            logger.error(f"Metrics flush failed: {e}")
+
+
+def _ensure_flusher():
+    # One flusher per process, started on first use so forked web and Celery
+    # workers each get their own.
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+    for metric in _registry:
+        # Whatever was recorded before the fork belongs to the parent.
+        with metric.lock:
+            metric.values, metric.flushed = {}, {}
+    conn = _redis()
+    if conn is not None:
+        threading.Thread(target=_flush_loop, args=(conn,), name="metrics-flush", daemon=True).start()
+
+
+def collect():
+    conn = _redis()
+    if conn is None:
+        return {metric: metric.snapshot() for metric in _registry}
+    flush(conn)
+    pipe = conn.pipeline(transaction=False)
+    for metric in _registry:
+        pipe.hgetall(_hash_key(metric))
+    collected = {}
+    for metric, fields in zip(_registry, pipe.execute()):
+        values = collected[metric] = {}
+        for field, amount in fields.items():
+            index, key = (field.decode() if isinstance(field, bytes) else field).split(":", 1)
+            key = tuple(json.loads(key))
+            slots = values.setdefault(key, [0.0] * metric.size())
+            if int(index) < len(slots):
+                slots[int(index)] = float(amount)
+    return collected
+
+
+def render():
+    lines = []
+    for metric, values in collect().items():
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key in sorted(values):
+            for name, labels, value in metric.samples(key, values[key]):
+                lines.append(f"{name}{labels} {_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    token = settings.METRICS_TOKEN
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponse("Forbidden\n", status=403, content_type="text/plain")
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
+
+
+# Query counters open in the current context (nested count_queries() blocks
+# each get every query). Context variables follow the caller into
+# sync_to_async threads, so this also counts async ORM calls.
+_query_counters = ContextVar("query_counters", default=())
+
+
+def _count_query(execute, sql, params, many, context):
+    for counter in _query_counters.get():
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+@contextmanager
+def count_queries():
+    # with count_queries() as queries: ...; queries[0] is the count so far.
+    counter = [0]
+    token = _query_counters.set(_query_counters.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _query_counters.reset(token)
+
+
+def _install_query_counter(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        # First, so a caller's own execute_wrapper() block pops its wrapper, not ours.
+        connection.execute_wrappers.insert(0, _count_query)
+
+
+connection_created.connect(_install_query_counter)
+
+
+class RequestMetricsMiddleware:
+    # Latency and query count per request, labelled with the URL pattern (not
+    # the path) so the number of series stays bounded.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        with count_queries() as queries:
+            try:
+                return self.get_response(request)
+            finally:
+                self.record(request, started, queries[0])
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        with count_queries() as queries:
+            try:
+                return await self.get_response(request)
+            finally:
+                self.record(request, started, queries[0])
+
+    def record(self, request, started, queries):
+        match = getattr(request, "resolver_match", None)
+        route = match.route if match else "unmatched"
+        http_request_seconds.observe(time.perf_counter() - started, route=route, method=request.method)
+        http_request_queries.observe(queries, route=route)
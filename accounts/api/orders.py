@@ -0,0 +1,139 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, OperationalError, transaction
+from accounts.models import Order
+from accounts.api.settlement import settle_orders, enqueue_order
+from accounts.api.risk import RiskRejected, reserve, release
+
+logger = logging.getLogger("trade_logger")
+
+# Requests settling in this process right now; past the limit new orders go to
+# the queue instead of piling up on the database.
+_inflight = threading.BoundedSemaphore(settings.TRADE_SYNC_MAX_INFLIGHT)
+
+PENDING = "pending"
+
+
+class OrderInProgress(Exception):
+    pass
+
+
+class IdempotencyKeyReused(Exception):
+    pass
+
+
+def dedup_key(account_id, client_order_id):
+    return f"order:dedup:{account_id}:{client_order_id}"
+
+
+def dispatch(order, user_id):
+    from accounts.api.tasks import process_trade, submit_order
+
+    quantity = str(order.quantity)
+    if order.limit_price is not None:
+        submit_order.delay(order.id)
+    elif settings.TRADE_SETTLEMENT_MODE == "batch":
+        enqueue_order(order.id, user_id, order.symbol, quantity, order.transaction_type)
+    else:
+        process_trade.delay(user_id, order.symbol, quantity, order.transaction_type, order.id)
+
+
+def settle_now(order, user_id):
+    if not _inflight.acquire(blocking=False):
+        return False
+    try:
+        settle_orders(
+            [{
+                "order_id": order.id,
+                "user_id": user_id,
+                "symbol": order.symbol,
+                "quantity": order.quantity,
+                "trade_type": order.transaction_type,
+            }],
+            lock_timeout=settings.TRADE_SYNC_LOCK_TIMEOUT_MS,
+        )
+    except OperationalError as e:
+        logger.info(f"Order {order.id} missed the sync lock budget, queueing: {e}")
+        return False
+    except Exception as e:
+        # The order row is already committed. Settlement rolled back (or it
+        # did commit, and the worker sees the order is no longer accepted),
+        # so the queue gets it rather than the client getting a 500.
+        logger.error(f"Order {order.id} failed to settle in the request, queueing: {e}")
+        return False
+    finally:
+        _inflight.release()
+    order.refresh_from_db()
+    return True
+
+
+def find_duplicate(account, client_order_id):
+    # One SET NX against the cache decides the common case: a first
+    # submission claims the key without touching the database. Only a
+    # retry pays for a read, to return the order it already placed.
+    key = dedup_key(account.id, client_order_id)
+    if cache.add(key, PENDING, timeout=settings.ORDER_DEDUP_PENDING_TTL):
+        return None
+    value = cache.get(key)
+    if value is not None and value != PENDING:
+        order = Order.objects.filter(id=value, account=account).first()
+        if order is not None:
+            return order
+    order = Order.objects.filter(account=account, client_order_id=client_order_id).first()
+    if order is None and value == PENDING:
+        raise OrderInProgress(client_order_id)
+    return order
+
+
+def check_same(order, symbol, quantity, trade_type, limit_price=None):
+    if (order.symbol, order.quantity, order.transaction_type, order.limit_price) != (symbol, quantity, trade_type, limit_price):
+        raise IdempotencyKeyReused(order.client_order_id)
+    return order
+
+
+def place_order(account, user_id, symbol, quantity, trade_type, client_order_id=None, limit_price=None):
+    # Returns (order, replayed). With a client_order_id, resubmitting the same
+    # order returns the first one instead of placing it again: the cache
+    # catches retries inside ORDER_DEDUP_TTL and the unique constraint on
+    # (account, client_order_id) catches everything else.
+    # Raises RiskRejected for an order the pre-trade checks turn away.
+    # With a limit_price the order goes to the matching engine's book.
+    if client_order_id:
+        order = find_duplicate(account, client_order_id)
+        if order is not None:
+            return check_same(order, symbol, quantity, trade_type, limit_price), True
+    try:
+        reservation = reserve(account.id, symbol, quantity, trade_type, limit_price)
+    except RiskRejected:
+        if client_order_id:
+            # Nothing was placed: a retry should be checked again, not told to wait.
+            cache.delete(dedup_key(account.id, client_order_id))
+        raise
+    try:
+        with transaction.atomic():
+            order = Order.objects.create(
+                account=account,
+                symbol=symbol,
+                quantity=quantity,
+                transaction_type=trade_type,
+                limit_price=limit_price,
+                client_order_id=client_order_id or None,
+            )
+    except IntegrityError:
+        release(reservation)
+        if not client_order_id:
+            raise
+        order = Order.objects.get(account=account, client_order_id=client_order_id)
+        return check_same(order, symbol, quantity, trade_type, limit_price), True
+    except Exception:
+        release(reservation)
+        raise
+    if client_order_id:
+        cache.set(dedup_key(account.id, client_order_id), order.id, timeout=settings.ORDER_DEDUP_TTL)
+
+    if limit_price is not None or not (settings.TRADE_SYNC_MODE and settle_now(order, user_id)):
+        dispatch(order, user_id)
+    return order, False
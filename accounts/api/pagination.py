@@ -0,0 +1,88 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    # Newest-first pagination on (time_field, id) within one account. The
+    # cursor carries the last row's key, so every page is an index range scan
+    # on (account, time_field, id) no matter how deep the client pages.
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+
+    def __init__(self, time_field, key=None):
+        self.time_field = time_field
+        # row -> (time_field, id); rows from values_list() pass their own.
+        self.key = key or (lambda row: (getattr(row, time_field), row.id))
+        self.next_key = None
+
+    def get_page_size(self, params):
+        value = params.get(self.page_size_query_param)
+        if value is None:
+            return settings.ACCOUNT_PAGE_SIZE
+        try:
+            size = int(value)
+        except ValueError:
+            raise ValidationError({"page_size": "Must be an integer."})
+        if size < 1:
+            raise ValidationError({"page_size": "Must be positive."})
+        return min(size, settings.ACCOUNT_MAX_PAGE_SIZE)
+
+    def decode_cursor(self, value):
+        try:
+            timestamp, pk = json.loads(urlsafe_b64decode(value.encode()))
+            timestamp = parse_datetime(timestamp)
+            if timestamp is None:
+                raise ValueError
+            return timestamp, int(pk)
+        except (TypeError, ValueError):
+            raise ValidationError({"cursor": "Invalid cursor."})
+
+    def encode_cursor(self, timestamp, pk):
+        return urlsafe_b64encode(json.dumps([timestamp.isoformat(), pk]).encode()).decode()
+
+    def window(self, queryset, request):
+        # The page query (one row past the page, to tell if there is a next).
+        self.request = request
+        # A plain Django request (async views) has no query_params.
+        params = getattr(request, "query_params", request.GET)
+        self.size = self.get_page_size(params)
+        field = self.time_field
+
+        cursor = params.get(self.cursor_query_param)
+        if cursor:
+            timestamp, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(**{f"{field}__lt": timestamp}) | Q(**{field: timestamp, "id__lt": pk}),
+                **{f"{field}__lte": timestamp},
+            )
+        return queryset.order_by(f"-{field}", "-id")[:self.size + 1]
+
+    def page(self, rows):
+        self.next_key = None
+        if len(rows) > self.size:
+            rows = rows[:self.size]
+            self.next_key = self.key(rows[-1])
+        return rows
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.page(list(self.window(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request):
+        return self.page([row async for row in self.window(queryset, request)])
+
+    def get_next_link(self):
+        if self.next_key is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(*self.next_key))
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
@@ -0,0 +1,95 @@
+from datetime import date
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from accounts.models import Trade, Ledger
+
+logger = logging.getLogger("trade_logger")
+
+# On Postgres, Trade and Ledger are range-partitioned by month on timestamp
+# (migration 0016), with a <table>_default partition for rows no month takes.
+# ensure_partitions runs daily and keeps PARTITION_MONTHS_AHEAD months ready
+# ahead of now, so new rows always land in their month. Months with rows
+# stranded in the default partition get their partition too, and the rows are
+# moved into it. Old months can be detached or dropped whole.
+
+PARTITIONED = (Trade, Ledger)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def bound(month):
+    # Months are UTC, like the bars.
+    return f"{month.isoformat()} 00:00:00+00"
+
+
+def partition_name(table, month):
+    return f"{table}_{month:%Y_%m}"
+
+
+def is_partitioned(cursor, table):
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [table])
+    return cursor.fetchone() is not None
+
+
+def stranded_months(cursor, table):
+    cursor.execute(
+        f"SELECT DISTINCT date_trunc('month', \"timestamp\" AT TIME ZONE 'UTC')::date FROM {table}_default"
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+
+def create_partition(cursor, table, month):
+    # False if the month already has its partition.
+    name = partition_name(table, month)
+    cursor.execute("SELECT to_regclass(%s)", [name])
+    if cursor.fetchone()[0] is not None:
+        return False
+    start, end = bound(month), bound(add_months(month, 1))
+    values = f"FOR VALUES FROM ('{start}') TO ('{end}')"
+    with transaction.atomic():
+        cursor.execute(
+            f'SELECT EXISTS (SELECT 1 FROM {table}_default WHERE "timestamp" >= %s AND "timestamp" < %s)',
+            [start, end],
+        )
+        if not cursor.fetchone()[0]:
+            cursor.execute(f"CREATE TABLE {name} PARTITION OF {table} {values}")
+            return True
+        # Postgres refuses a new partition while the default one holds rows
+        # for its range: move them into a plain table and attach that.
+        cursor.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS)")
+        cursor.execute(
+            f'WITH moved AS (DELETE FROM {table}_default WHERE "timestamp" >= %s AND "timestamp" < %s RETURNING *) '
+            f"INSERT INTO {name} SELECT * FROM moved",
+            [start, end],
+        )
+        moved = cursor.rowcount
+        cursor.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} {values}")
+    logger.warning(f"Moved {moved} rows from {table}_default into {name}")
+    return True
+
+
+def ensure_partitions(months_ahead=None):
+    # Returns the names of the partitions created.
+    if connection.vendor != "postgresql":
+        return []
+    months_ahead = settings.PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    this_month = timezone.now().date().replace(day=1)
+    created = []
+    with connection.cursor() as cursor:
+        for model in PARTITIONED:
+            table = model._meta.db_table
+            if not is_partitioned(cursor, table):
+                logger.warning(f"{table} is not partitioned, skipping partition maintenance")
+                continue
+            months = {add_months(this_month, step) for step in range(months_ahead + 1)}
+            for month in sorted(months | stranded_months(cursor, table)):
+                if create_partition(cursor, table, month):
+                    created.append(partition_name(table, month))
+    logger.info(f"Created {len(created)} partitions{': ' + ', '.join(created) if created else ''}")
+    return created
@@ -0,0 +1,76 @@
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+import logging
+
+from accounts.models import Account, Position, PortfolioSnapshot
+from accounts.api.price_cache import get_quotes, quote_price
+
+logger = logging.getLogger("trade_logger")
+
+CENT = Decimal("0.01")
+CHUNK = 1000
+
+
+def refresh_portfolios(account_ids):
+    # Recomputes the snapshot of each given account from its balance and
+    # positions marked at the cached quote: two queries per chunk, however
+    # many accounts it holds.
+    account_ids = list(account_ids)
+    for i in range(0, len(account_ids), CHUNK):
+        _refresh(account_ids[i:i + CHUNK])
+    return len(account_ids)
+
+
+def _refresh(account_ids):
+    balances = dict(Account.objects.filter(id__in=account_ids).values_list("id", "balance"))
+    holdings = list(
+        Position.objects.filter(account_id__in=balances)
+        .values_list("account_id", "symbol", "quantity", "cost_basis", "realized_pnl")
+    )
+    quotes = get_quotes({row[1] for row in holdings if row[2]})
+    prices = {symbol: quote_price(quote) for symbol, quote in quotes.items()}
+
+    market_values = defaultdict(Decimal)
+    cost_bases = defaultdict(Decimal)
+    realized = defaultdict(Decimal)
+    for account_id, symbol, quantity, cost_basis, realized_pnl in holdings:
+        if quantity:
+            market_values[account_id] += quantity * prices.get(symbol, 0)
+        cost_bases[account_id] += cost_basis
+        realized[account_id] += realized_pnl
+
+    snapshots = []
+    for account_id, balance in balances.items():
+        market_value = market_values[account_id].quantize(CENT, rounding=ROUND_HALF_UP)
+        snapshots.append(PortfolioSnapshot(
+            account_id=account_id,
+            balance=balance,
+            market_value=market_value,
+            equity=balance + market_value,
+            realized_pnl=realized[account_id],
+            unrealized_pnl=market_value - cost_bases[account_id],
+        ))
+    PortfolioSnapshot.objects.bulk_create(
+        snapshots,
+        update_conflicts=True,
+        unique_fields=["account"],
+        update_fields=["balance", "market_value", "equity", "realized_pnl", "unrealized_pnl", "updated_at"],
+    )
+
+
+def refresh_portfolios_for_symbols(symbols):
+    symbols = list(symbols)
+    if not symbols:
+        return 0
+    holders = Position.objects.filter(symbol__in=symbols).exclude(quantity=0).values_list("account_id", flat=True).distinct()
+    count = refresh_portfolios(holders.iterator())
+    logger.info(f"Revalued {count} portfolios for {len(symbols)} repriced symbols")
+    return count
+
+
+def get_portfolio(account):
+    snapshot = PortfolioSnapshot.objects.filter(account=account).first()
+    if snapshot is None:
+        refresh_portfolios([account.id])
+        snapshot = PortfolioSnapshot.objects.get(account=account)
+    return snapshot
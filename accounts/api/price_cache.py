@@ -0,0 +1,357 @@
+from collections import OrderedDict
+from decimal import Decimal
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.core.cache import cache
+from accounts.models import Stock
+from accounts.api.metrics import quote_cache_lookups_total
+
+logger = logging.getLogger("trade_logger")
+
+# Every reader and writer of cached quotes goes through this module, so there
+# is one key scheme and one value shape: the StockSerializer representation,
+# {"symbol", "name", "exchange", "price"} with price as a 2dp string. Bump
+# PRICE_CACHE_VERSION whenever that shape changes.
+#
+# Reads are served from a small per-process LRU (L1) in front of Redis. Writers
+# publish the symbols they changed on a Redis channel and every process evicts
+# them from its L1; the short L1 TTL bounds staleness if a message is missed.
+
+QUOTE_FIELDS = ("symbol", "name", "exchange", "price")
+
+
+def quote_key(symbol):
+    return f"stock:v{settings.PRICE_CACHE_VERSION}:{symbol}"
+
+
+def to_quote(symbol, name, exchange, price):
+    return {"symbol": symbol, "name": name, "exchange": exchange, "price": f"{price:.2f}"}
+
+
+def quote_price(quote):
+    return Decimal(quote["price"])
+
+
+class LocalQuoteCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, symbol):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.data.get(symbol)
+            if entry is None or entry[0] < now:
+                self.misses += 1
+                return None
+            self.data.move_to_end(symbol)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, symbol, quote):
+        expires = time.monotonic() + self.ttl
+        with self.lock:
+            self.data[symbol] = (expires, quote)
+            self.data.move_to_end(symbol)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, symbols):
+        with self.lock:
+            for symbol in symbols:
+                if self.data.pop(symbol, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+local_quotes = LocalQuoteCache(settings.PRICE_L1_SIZE, settings.PRICE_L1_TTL)
+_listener_pid = None
+
+
+def invalidation_channel():
+    return f"stock:v{settings.PRICE_CACHE_VERSION}:invalidate"
+
+
+def _redis():
+    try:
+        from django_redis import get_redis_connection
+        return get_redis_connection("default")
+    except Exception:
+        # Not a django_redis cache (e.g. local memory in tests): the L1 TTL alone applies.
+        return None
+
+
+def _listen(conn):
+    pubsub = conn.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(invalidation_channel())
+    while True:
+        try:
+            for message in pubsub.listen():
+                local_quotes.discard(json.loads(message["data"]))
+        except Exception as e:
+            logger.error(f"Quote invalidation listener failed, resubscribing: {e}")
+            local_quotes.clear()
+            time.sleep(1)
+            pubsub = conn.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(invalidation_channel())
+
+
+def _ensure_listener():
+    # One listener thread per process, started on first use so forked web and
+    # Celery workers each get their own.
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    _listener_pid = os.getpid()
+    local_quotes.clear()
+    conn = _redis()
+    if conn is not None:
+        threading.Thread(target=_listen, args=(conn,), name="quote-invalidation", daemon=True).start()
+
+
+def publish_invalidation(symbols):
+    conn = _redis()
+    if conn is not None:
+        conn.publish(invalidation_channel(), json.dumps(list(symbols)))
+    else:
+        local_quotes.discard(symbols)
+
+
+def set_quotes(stocks):
+    # Write-through for anything that has just saved Stock rows.
+    quotes = {s.symbol: to_quote(s.symbol, s.name, s.exchange, s.price) for s in stocks}
+    cache.set_many({quote_key(symbol): q for symbol, q in quotes.items()}, timeout=settings.PRICE_CACHE_TIMEOUT)
+    publish_invalidation(quotes)
+    return quotes
+
+
+def _load(symbols):
+    # Misses are filled with add(), never set(): a row read before an ingest
+    # committed must not replace the quote that ingest has since written
+    # through. Where the add loses, the cached quote is the one returned.
+    rows = Stock.objects.filter(symbol__in=symbols).values_list(*QUOTE_FIELDS)
+    quotes = {row[0]: to_quote(*row) for row in rows}
+    for symbol, quote in quotes.items():
+        if not cache.add(quote_key(symbol), quote, timeout=settings.PRICE_CACHE_TIMEOUT):
+            quotes[symbol] = cache.get(quote_key(symbol)) or quote
+    return quotes
+
+
+def _load_single_flight(symbol):
+    # Only the caller that wins the lock recomputes a missing quote; the rest
+    # wait briefly for it to appear instead of all hitting the database.
+    key = quote_key(symbol)
+    lock = key + ":lock"
+    if cache.add(lock, 1, timeout=settings.PRICE_CACHE_LOCK_TIMEOUT):
+        try:
+            return _load([symbol]).get(symbol)
+        finally:
+            cache.delete(lock)
+
+    deadline = time.monotonic() + settings.PRICE_CACHE_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(0.01)
+        quote = cache.get(key)
+        if quote is not None:
+            return quote
+        if cache.get(lock) is None:
+            break
+    return _load([symbol]).get(symbol)
+
+
+def get_quote(symbol, local=True):
+    if local:
+        _ensure_listener()
+        quote = local_quotes.get(symbol)
+        if quote is not None:
+            quote_cache_lookups_total.inc(layer="l1")
+            return quote
+    quote = cache.get(quote_key(symbol))
+    if quote is None:
+        quote_cache_lookups_total.inc(layer="db")
+        quote = _load_single_flight(symbol)
+    else:
+        quote_cache_lookups_total.inc(layer="redis")
+    if local and quote is not None:
+        local_quotes.set(symbol, quote)
+    return quote
+
+
+def get_quotes(symbols, local=True):
+    # Pass local=False where a quote is used to price a trade, so fills never
+    # see an L1 entry that is waiting on its invalidation message.
+    quotes = {}
+    remaining = []
+    if local:
+        _ensure_listener()
+        for symbol in symbols:
+            quote = local_quotes.get(symbol)
+            if quote is None:
+                remaining.append(symbol)
+            else:
+                quotes[symbol] = quote
+    else:
+        remaining = list(symbols)
+    if quotes:
+        quote_cache_lookups_total.inc(len(quotes), layer="l1")
+    if not remaining:
+        return quotes
+
+    cached = cache.get_many([quote_key(s) for s in remaining])
+    found = {}
+    missing = []
+    for symbol in remaining:
+        quote = cached.get(quote_key(symbol))
+        if quote is None:
+            missing.append(symbol)
+        else:
+            found[symbol] = quote
+    if found:
+        quote_cache_lookups_total.inc(len(found), layer="redis")
+    if missing:
+        quote_cache_lookups_total.inc(len(missing), layer="db")
+    if len(missing) == 1:
+        quote = _load_single_flight(missing[0])
+        if quote is not None:
+            found[missing[0]] = quote
+    elif missing:
+        found.update(_load(missing))
+
+    if local:
+        for symbol, quote in found.items():
+            local_quotes.set(symbol, quote)
+    quotes.update(found)
+    return quotes
+
+
+# Async reads for the ASGI views: the same L1 and keys, but Redis is read with
+# redis.asyncio so a waiting request does not hold a thread. Values are
+# decoded with django_redis's own serializer; any other cache backend falls
+# back to Django's async cache API.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _async_redis():
+    client = getattr(cache, "client", None)
+    if client is None or not hasattr(client, "decode"):
+        return None
+    # A redis.asyncio client belongs to the event loop it was created on.
+    loop = asyncio.get_running_loop()
+    conn = _async_clients.get(loop)
+    if conn is None:
+        import redis.asyncio as aioredis
+
+        location = settings.CACHES["default"]["LOCATION"]
+        conn = aioredis.from_url(location[0] if isinstance(location, (list, tuple)) else location)
+        _async_clients[loop] = conn
+    return conn
+
+
+async def _aget_cached(symbols):
+    keys = {quote_key(symbol): symbol for symbol in symbols}
+    conn = _async_redis()
+    if conn is None:
+        found = await cache.aget_many(list(keys))
+    else:
+        values = await conn.mget([cache.client.make_key(key) for key in keys])
+        found = {key: cache.client.decode(value) for key, value in zip(keys, values) if value is not None}
+    return {keys[key]: quote for key, quote in found.items()}
+
+
+async def _aload(symbols):
+    # As _load.
+    rows = Stock.objects.filter(symbol__in=symbols).values_list(*QUOTE_FIELDS)
+    quotes = {row[0]: to_quote(*row) async for row in rows}
+    for symbol, quote in quotes.items():
+        if not await cache.aadd(quote_key(symbol), quote, timeout=settings.PRICE_CACHE_TIMEOUT):
+            quotes[symbol] = await cache.aget(quote_key(symbol)) or quote
+    return quotes
+
+
+async def _aload_single_flight(symbol):
+    # As _load_single_flight, on the same lock, so sync and async readers of a
+    # missing quote share one recompute. Waiters sleep without holding a thread.
+    key = quote_key(symbol)
+    lock = key + ":lock"
+    if await cache.aadd(lock, 1, timeout=settings.PRICE_CACHE_LOCK_TIMEOUT):
+        try:
+            return (await _aload([symbol])).get(symbol)
+        finally:
+            await cache.adelete(lock)
+
+    deadline = time.monotonic() + settings.PRICE_CACHE_LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+        quote = (await _aget_cached([symbol])).get(symbol)
+        if quote is not None:
+            return quote
+        if await cache.aget(lock) is None:
+            break
+    return (await _aload([symbol])).get(symbol)
+
+
+async def aget_quotes(symbols):
+    _ensure_listener()
+    quotes, remaining = {}, []
+    for symbol in symbols:
+        quote = local_quotes.get(symbol)
+        if quote is None:
+            remaining.append(symbol)
+        else:
+            quotes[symbol] = quote
+    if quotes:
+        quote_cache_lookups_total.inc(len(quotes), layer="l1")
+    if not remaining:
+        return quotes
+
+    found = await _aget_cached(remaining)
+    if found:
+        quote_cache_lookups_total.inc(len(found), layer="redis")
+    missing = [symbol for symbol in remaining if symbol not in found]
+    if missing:
+        quote_cache_lookups_total.inc(len(missing), layer="db")
+    if len(missing) == 1:
+        quote = await _aload_single_flight(missing[0])
+        if quote is not None:
+            found[missing[0]] = quote
+    elif missing:
+        found.update(await _aload(missing))
+    for symbol, quote in found.items():
+        local_quotes.set(symbol, quote)
+    quotes.update(found)
+    return quotes
+
+
+async def aget_quote(symbol):
+    return (await aget_quotes([symbol])).get(symbol)
@@ -0,0 +1,117 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from decimal import Decimal, ROUND_HALF_UP
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from accounts.models import Stock
+from accounts.api.bars import record_ticks
+from accounts.api.portfolio import refresh_portfolios_for_symbols
+from accounts.api.price_cache import set_quotes
+from accounts.api.metrics import price_fetch_seconds
+from accounts.api.streaming import publish_prices
+
+logger = logging.getLogger("trade_logger")
+
+CENT = Decimal("0.01")
+
+
+class PriceSource:
+    # Subclasses return the latest price for one symbol, or raise.
+    def fetch(self, symbol):
+        raise NotImplementedError
+
+
+class YFinanceSource(PriceSource):
+    def fetch(self, symbol):
+        import yfinance as yf
+        return yf.Ticker(symbol).history(period="1d")["Close"].iloc[-1]
+
+
+class FakePriceSource(PriceSource):
+    # Offline source for tests and local runs: fixed prices where given,
+    # otherwise a small deterministic walk around a per-symbol base price.
+    def __init__(self, prices=None, failures=()):
+        self.prices = dict(prices or {})
+        self.failures = set(failures)
+
+    def fetch(self, symbol):
+        if symbol in self.failures:
+            raise ValueError(f"no data for {symbol}")
+        if symbol in self.prices:
+            return self.prices[symbol]
+        base = random.Random(symbol).uniform(10, 500)
+        drift = random.Random(f"{symbol}:{int(time.time() // 60)}").uniform(-0.02, 0.02)
+        return base * (1 + drift)
+
+
+def get_price_source():
+    return import_string(settings.PRICE_SOURCE)()
+
+
+def _timed_fetch(source, symbol):
+    started = time.perf_counter()
+    try:
+        price = Decimal(str(source.fetch(symbol))).quantize(CENT, rounding=ROUND_HALF_UP)
+        error = None
+    except Exception as e:
+        price, error = None, str(e) or e.__class__.__name__
+    elapsed = time.perf_counter() - started
+    price_fetch_seconds.observe(elapsed, result="error" if error else "ok")
+    return symbol, price, elapsed * 1000, error
+
+
+def ingest_prices(source=None, symbols=None, workers=None, timeout=None):
+    source = source or get_price_source()
+    workers = workers or settings.PRICE_FETCH_WORKERS
+    timeout = settings.PRICE_FETCH_TIMEOUT if timeout is None else timeout
+    started = time.perf_counter()
+
+    stocks = Stock.objects.only("id", "symbol", "name", "exchange", "price")
+    if symbols is not None:
+        stocks = stocks.filter(symbol__in=symbols)
+    stocks = {stock.symbol: stock for stock in stocks}
+
+    latency, failed, changed, fetched = {}, {}, [], {}
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = [pool.submit(_timed_fetch, source, symbol) for symbol in stocks]
+    done, _ = wait(futures, timeout=timeout)
+    # Don't let one hung request hold the run past its deadline.
+    pool.shutdown(wait=False, cancel_futures=True)
+
+    for future in done:
+        symbol, price, elapsed, error = future.result()
+        latency[symbol] = round(elapsed, 1)
+        if error is not None:
+            failed[symbol] = error
+            continue
+        fetched[symbol] = price
+        stock = stocks[symbol]
+        if stock.price != price:
+            stock.price = price
+            changed.append(stock)
+    for symbol in set(stocks) - set(latency):
+        failed[symbol] = "timed out"
+
+    # Every fetched price is a tick, changed or not: it still closes the bar.
+    record_ticks(fetched)
+    if changed:
+        Stock.objects.bulk_update(changed, ["price"], batch_size=1000)
+        publish_prices(set_quotes(changed).values())
+        refresh_portfolios_for_symbols([stock.symbol for stock in changed])
+
+    report = {
+        "symbols": len(stocks),
+        "updated": len(changed),
+        "failed": failed,
+        "latency_ms": latency,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+    logger.info(
+        f"Price update: {len(stocks)} symbols, {len(changed)} changed, {len(failed)} failed in {report['elapsed_ms']}ms"
+    )
+    for symbol, error in failed.items():
+        logger.error(f"Failed to update {symbol}: {error}")
+    return report
@@ -0,0 +1,63 @@
+from datetime import date, datetime, time, timedelta
+import csv
+import gzip
+import os
+
+from django.conf import settings
+from django.utils import timezone
+from accounts.models import Trade
+
+# New columns go at the end: readers of these files index them by position.
+REPORT_HEADER = ["username", "symbol", "trade_type", "quantity", "price", "balance", "realized_pnl"]
+REPORT_COLUMNS = ("account__user__username", "symbol", "transaction_type", "quantity", "price", "account__balance", "realized_pnl")
+
+
+def parse_date(value):
+    if value is None or isinstance(value, date):
+        return value
+    return date.fromisoformat(value)
+
+
+def day_bounds(start, end):
+    # [start 00:00, day after end 00:00) so the timestamp index can be used,
+    # unlike a timestamp__date lookup.
+    tz = timezone.get_current_timezone()
+    return (
+        timezone.make_aware(datetime.combine(start, time.min), tz),
+        timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min), tz),
+    )
+
+
+def report_rows(start, end, chunk_size=None, account_ids=None):
+    lower, upper = day_bounds(start, end)
+    trades = Trade.objects.filter(timestamp__gte=lower, timestamp__lt=upper)
+    if account_ids is not None:
+        trades = trades.filter(account_id__in=account_ids)
+    return (
+        trades.order_by("id")
+        .values_list(*REPORT_COLUMNS)
+        .iterator(chunk_size=chunk_size or settings.REPORT_CHUNK_SIZE)
+    )
+
+
+def write_trade_report(start=None, end=None, compress=None):
+    start = parse_date(start) or timezone.localdate()
+    end = parse_date(end) or start
+    compress = settings.REPORT_COMPRESS if compress is None else compress
+
+    reports_dir = os.path.join(settings.BASE_DIR, "reports")
+    os.makedirs(reports_dir, exist_ok=True)
+
+    name = f"report_{start}" if start == end else f"report_{start}_{end}"
+    file_path = os.path.join(reports_dir, name + (".csv.gz" if compress else ".csv"))
+    opener = gzip.open if compress else open
+
+    rows = 0
+    with opener(file_path, mode="wt", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(REPORT_HEADER)
+        for row in report_rows(start, end):
+            writer.writerow(row)
+            rows += 1
+
+    return file_path, rows
@@ -0,0 +1,188 @@
+from collections import defaultdict
+from decimal import Decimal, ROUND_CEILING
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+from accounts.models import Account, Position, Order
+from accounts.api.price_cache import get_quote, get_quotes, quote_price
+
+logger = logging.getLogger("trade_logger")
+
+# Pre-trade checks run by place_order before an order is stored or queued, so
+# an order that would fail settlement never costs a queue slot, a worker or a
+# row lock. Per account the cache holds (as integers, so every change is one
+# atomic INCRBY):
+#   buying power:  balance minus the cost of accepted, unsettled buys and
+#                  open book buys at their limit (cents);
+#   sellable:      position minus accepted, unsettled and open book sells
+#                  (hundredths);
+#   long:          position plus accepted, unsettled and open book buys
+#                  (hundredths), for the per-symbol exposure limit;
+# plus a fixed-window order counter. Missing keys are rebuilt from the
+# database, and settle_orders rebuilds them for every account it touched once
+# it commits. The checks only filter: settle_orders still enforces the real
+# balance and position rules.
+
+
+class RiskRejected(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def buying_power_key(account_id):
+    return f"risk:bp:{account_id}"
+
+
+def sellable_key(account_id, symbol):
+    return f"risk:sellable:{account_id}:{symbol}"
+
+
+def long_key(account_id, symbol):
+    return f"risk:long:{account_id}:{symbol}"
+
+
+def to_cents(amount):
+    # Rounded up, so a reservation never understates the cost.
+    return int((amount * 100).to_integral_value(rounding=ROUND_CEILING))
+
+
+def to_hundredths(quantity):
+    return int(Decimal(quantity) * 100)
+
+
+def open_book_orders(account_ids):
+    # (account_id, symbol, trade_type, limit_price, remaining) for each limit
+    # order still open on the book.
+    for account_id, symbol, trade_type, limit_price, quantity, filled in (
+        Order.objects.filter(account_id__in=account_ids, status=Order.ACCEPTED, limit_price__isnull=False)
+        .values_list("account_id", "symbol", "transaction_type", "limit_price", "quantity", "filled_quantity")
+    ):
+        yield account_id, symbol, trade_type, limit_price, quantity - filled
+
+
+def book_reservations(account_ids):
+    # Cash per account and shares per (account, symbol) that open book orders
+    # hold back from settlement.
+    cash, shares = defaultdict(Decimal), defaultdict(Decimal)
+    for account_id, symbol, trade_type, limit_price, remaining in open_book_orders(account_ids):
+        if trade_type == "buy":
+            cash[account_id] += limit_price * remaining
+        else:
+            shares[(account_id, symbol)] += remaining
+    return cash, shares
+
+
+def load_state(account_ids, symbols):
+    # The cache values for `account_ids` x `symbols`, computed from the
+    # database: four queries however many accounts.
+    account_ids, symbols = list(account_ids), set(symbols)
+    balances = dict(Account.objects.filter(id__in=account_ids).values_list("id", "balance"))
+    held = {
+        (account_id, symbol): quantity
+        for account_id, symbol, quantity in Position.objects.filter(
+            account_id__in=account_ids, symbol__in=symbols,
+        ).values_list("account_id", "symbol", "quantity")
+    }
+
+    pending = defaultdict(Decimal)
+    for account_id, symbol, trade_type, total in (
+        Order.objects.filter(account_id__in=account_ids, status=Order.ACCEPTED, limit_price__isnull=True)
+        .values_list("account_id", "symbol", "transaction_type").annotate(total=Sum("quantity"))
+    ):
+        pending[(account_id, symbol, trade_type)] += total
+    quotes = get_quotes({symbol for _, symbol, trade_type in pending if trade_type == "buy"}, local=False)
+    reserved = defaultdict(int)
+    for (account_id, symbol, trade_type), total in pending.items():
+        if trade_type == "buy" and symbol in quotes:
+            reserved[account_id] += to_cents(quote_price(quotes[symbol]) * total)
+    # Book orders hold their limit price for whatever is still open.
+    for account_id, symbol, trade_type, limit_price, remaining in open_book_orders(account_ids):
+        pending[(account_id, symbol, trade_type)] += remaining
+        if trade_type == "buy":
+            reserved[account_id] += to_cents(limit_price * remaining)
+
+    state = {}
+    for account_id, balance in balances.items():
+        state[buying_power_key(account_id)] = to_cents(balance) - reserved[account_id]
+        for symbol in symbols:
+            quantity = held.get((account_id, symbol), Decimal("0"))
+            state[sellable_key(account_id, symbol)] = to_hundredths(quantity - pending[(account_id, symbol, "sell")])
+            state[long_key(account_id, symbol)] = to_hundredths(quantity + pending[(account_id, symbol, "buy")])
+    return state
+
+
+def reconcile(account_ids, symbols):
+    # Called after settlement commits. An order placed between the reads and
+    # the write can lose its reservation until the next rebuild; settlement
+    # still rejects it if it really does not fit.
+    if not settings.RISK_CHECKS or not account_ids:
+        return
+    cache.set_many(load_state(account_ids, symbols), timeout=settings.RISK_STATE_TTL)
+
+
+def _change(key, delta, account_id, symbol):
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Expired or never loaded: fill in whatever is missing, then retry.
+        for missing, value in load_state([account_id], [symbol]).items():
+            cache.add(missing, value, timeout=settings.RISK_STATE_TTL)
+        return cache.incr(key, delta)
+
+
+def check_rate(account_id):
+    window = settings.RISK_RATE_WINDOW
+    key = f"risk:rate:{account_id}:{int(time.time() // window)}"
+    cache.add(key, 0, timeout=int(window) + 1)
+    if cache.incr(key) > settings.RISK_MAX_ORDERS_PER_WINDOW:
+        raise RiskRejected("Too many orders, slow down.", status=429)
+
+
+def reserve(account_id, symbol, quantity, trade_type, limit_price=None):
+    # Returns the changes made, for release() if the order is not placed after
+    # all, or raises RiskRejected with the cache left as it was. Limit orders
+    # reserve at their limit price, market orders at the quote.
+    if not settings.RISK_CHECKS:
+        return []
+    check_rate(account_id)
+    quote = get_quote(symbol)
+    if quote is None:
+        raise RiskRejected("Stock not found.", status=404)
+    price = quote_price(quote) if limit_price is None else Decimal(limit_price)
+    units = to_hundredths(quantity)
+    changes = []
+
+    if trade_type == "buy":
+        cost = to_cents(price * Decimal(quantity))
+        key = buying_power_key(account_id)
+        changes.append((key, -cost))
+        if _change(key, -cost, account_id, symbol) < 0:
+            release(changes)
+            raise RiskRejected("Insufficient balance.")
+        key = long_key(account_id, symbol)
+        changes.append((key, units))
+        long = _change(key, units, account_id, symbol)
+        limit = settings.RISK_MAX_SYMBOL_EXPOSURE
+        if limit and price * long / 100 > limit:
+            release(changes)
+            raise RiskRejected(f"Order would take {symbol} exposure past {limit}.")
+    else:
+        key = sellable_key(account_id, symbol)
+        changes.append((key, -units))
+        if _change(key, -units, account_id, symbol) < 0:
+            release(changes)
+            raise RiskRejected("Not enough stock to sell.")
+    return changes
+
+
+def release(changes):
+    for key, delta in changes:
+        try:
+            cache.incr(key, -delta)
+        except ValueError:
+            # Gone already; the next load starts from the database.
+            pass
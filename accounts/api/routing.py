@@ -0,0 +1,42 @@
+from django.conf import settings
+
+SHARDED_TASKS = {"accounts.api.tasks.process_trade"}
+
+
+def jump_hash(key, buckets):
+    # Lamping & Veach jump consistent hash: growing from N to N+1 buckets only
+    # moves 1/(N+1) of the keys, and every moved key lands in the new bucket.
+    key &= 0xFFFFFFFFFFFFFFFF
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def shard_for(account_key, count=None):
+    # Orders are keyed by user id, which is one-to-one with the account, so the
+    # web tier can route without loading the Account row.
+    return jump_hash(int(account_key), count or settings.TRADE_SHARD_COUNT)
+
+
+def queue_name(shard):
+    return f"{settings.TRADE_QUEUE_PREFIX}.{shard}"
+
+
+def queue_for(account_key, count=None):
+    return queue_name(shard_for(account_key, count))
+
+
+def all_queues(count=None):
+    return [queue_name(shard) for shard in range(count or settings.TRADE_SHARD_COUNT)]
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    if name not in SHARDED_TASKS:
+        return None
+    user_id = args[0] if args else kwargs.get("user_id")
+    if user_id is None:
+        return None
+    return {"queue": queue_for(user_id)}
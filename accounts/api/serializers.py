@@ -1,5 +1,6 @@
+from decimal import Decimal
 from rest_framework import serializers
-from accounts.models import CustomUser, Account, Position, Ledger, Stock, Trade
+from accounts.models import CustomUser, Account, Position, Ledger, Stock, Trade, PortfolioSnapshot, Order, PriceBar
 
 class RegisterSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True)
@@ -25,7 +26,7 @@ class AccountSerializer(serializers.ModelSerializer):
 class PositionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Position
-        fields = ("symbol", "quantity", "average_price", "created_at")
+        fields = ("symbol", "quantity", "average_price", "cost_basis", "realized_pnl", "created_at")
     
 class LedgerSerializer(serializers.ModelSerializer):
     class Meta:
@@ -42,4 +43,26 @@ class TradeSerializer(serializers.ModelSerializer):
         model =  Trade
         fields = ("symbol", "transaction_type", "price", "timestamp")
 
+class PriceBarSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PriceBar
+        fields = ("start", "open", "high", "low", "close", "volume")
+
+class PortfolioSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PortfolioSnapshot
+        fields = ("balance", "market_value", "equity", "realized_pnl", "unrealized_pnl", "updated_at")
 
+class TradeRequestSerializer(serializers.Serializer):
+    symbol = serializers.CharField(max_length=10)
+    quantity = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal("0.01"))
+    trade_type = serializers.ChoiceField(choices=["buy", "sell"])
+    client_order_id = serializers.CharField(max_length=64, required=False, allow_blank=False)
+
+class LimitOrderRequestSerializer(TradeRequestSerializer):
+    limit_price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal("0.01"))
+
+class OrderSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Order
+        fields = ("id", "client_order_id", "symbol", "transaction_type", "quantity", "limit_price", "filled_quantity", "status", "price", "reason", "created_at", "updated_at")
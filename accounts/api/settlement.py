@@ -0,0 +1,484 @@
+from collections import defaultdict, deque
+from decimal import Decimal, ROUND_HALF_UP
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from accounts.models import Account, Stock, Position, PositionLot, Ledger, Trade, TradeEvent, Order
+from accounts.api.price_cache import get_quotes, quote_price
+from accounts.api.routing import shard_for
+from accounts.api.portfolio import refresh_portfolios
+from accounts.api.streaming import publish_order_updates
+from accounts.api.journal import ensure_snapshots, position_state, trade_event
+from accounts.api.metrics import trade_stage_seconds
+from accounts.api import risk
+from core import db_router
+
+logger = logging.getLogger("trade_logger")
+
+CENT = Decimal("0.01")
+QUEUE_KEY = "settlement:orders:{}"
+# Orders a settler has taken but not yet settled; one settler per shard.
+PROCESSING_KEY = "settlement:processing:{}"
+
+
+def db_round(value):
+    # What a DecimalField(decimal_places=2) column stores for `value` on Postgres.
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+class PositionChanges:
+    # Tracks the positions touched by a batch so they can be written back with
+    # one bulk_create and one bulk_update, and keeps their cost accounting:
+    # weighted average cost by default, or FIFO lots when POSITION_COST_METHOD
+    # is "fifo". Each fill costs O(1) (amortized over the lots it closes).
+
+    def __init__(self, positions, lots=None):
+        self.positions = {(position.account_id, position.symbol): position for position in positions}
+        self.created = {}
+        self.updated = {}
+        self.fifo = lots is not None
+        self.lots = defaultdict(deque)
+        by_id = {position.id: key for key, position in self.positions.items()}
+        for lot in lots or ():
+            if lot.position_id in by_id:
+                self.lots[by_id[lot.position_id]].append(lot)
+        self.new_lots = []
+        self.changed_lots = {}
+        self.deleted_lots = []
+
+    @classmethod
+    def load(cls, account_ids, symbols):
+        positions = list(Position.objects.filter(account_id__in=account_ids, symbol__in=symbols))
+        lots = None
+        if settings.POSITION_COST_METHOD == "fifo":
+            lots = PositionLot.objects.filter(position__in=[p.id for p in positions]).order_by("id")
+        return cls(positions, lots)
+
+    def get(self, account_id, symbol):
+        return self.positions.get((account_id, symbol))
+
+    def create(self, account, symbol, quantity, average_price):
+        key = (account.id, symbol)
+        position = Position(
+            account=account,
+            symbol=symbol,
+            quantity=quantity,
+            average_price=average_price,
+            cost_basis=db_round(quantity * average_price),
+            realized_pnl=Decimal("0.00"),
+        )
+        self._reprice(position)
+        self.positions[key] = self.created[key] = position
+        if self.fifo and quantity > 0:
+            self._add_lot(key, position, quantity, position.cost_basis)
+        return position
+
+    def changed(self, position):
+        key = (position.account_id, position.symbol)
+        if key not in self.created:
+            self.updated[key] = position
+
+    def buy(self, account, symbol, quantity, price):
+        # Adds `quantity` at `price` to the account's position, opening it if
+        # needed, and moves average_price to the new weighted average.
+        position = self.get(account.id, symbol)
+        if position is None:
+            return self.create(account, symbol, db_round(quantity), price)
+        cost = db_round(price * quantity)
+        if self.fifo:
+            self._sync_lots(position)
+            self._add_lot((account.id, symbol), position, quantity, cost)
+        position.quantity = db_round(position.quantity + quantity)
+        position.cost_basis += cost
+        self._reprice(position)
+        self.changed(position)
+        return position
+
+    def sell(self, position, quantity, price):
+        # Takes `quantity` out of `position` and returns the realized P&L of
+        # the part that was actually held. The position is kept at zero.
+        held = max(position.quantity, Decimal(0))
+        covered = min(quantity, held)
+        if covered == held:
+            released = position.cost_basis
+        elif self.fifo:
+            released = self._close_lots(position, covered)
+        else:
+            released = db_round(position.cost_basis * covered / held)
+        if self.fifo and covered == held:
+            self._clear_lots(position)
+        realized = db_round(price * covered - released)
+
+        position.quantity = db_round(position.quantity - quantity)
+        position.cost_basis -= released
+        position.realized_pnl += realized
+        self._reprice(position)
+        self.changed(position)
+        return realized
+
+    def _reprice(self, position):
+        if position.quantity > 0:
+            position.average_price = db_round(position.cost_basis / position.quantity)
+        else:
+            position.average_price = Decimal("0.00")
+
+    def _add_lot(self, key, position, quantity, cost):
+        lot = PositionLot(position=position, quantity=quantity, cost=cost)
+        self.lots[key].append(lot)
+        self.new_lots.append(lot)
+
+    def _sync_lots(self, position):
+        # Positions opened before FIFO was switched on have no (or stale) lots:
+        # start them off with one lot holding the current average cost.
+        key = (position.account_id, position.symbol)
+        lots = self.lots[key]
+        if sum((lot.quantity for lot in lots), Decimal(0)) == max(position.quantity, Decimal(0)):
+            return
+        self._clear_lots(position)
+        if position.quantity > 0:
+            self._add_lot(key, position, position.quantity, position.cost_basis)
+
+    def _clear_lots(self, position):
+        lots = self.lots.pop((position.account_id, position.symbol), ())
+        for lot in lots:
+            self._drop_lot(lot)
+
+    def _drop_lot(self, lot):
+        if lot.pk is None:
+            self.new_lots.remove(lot)
+        else:
+            self.changed_lots.pop(lot.pk, None)
+            self.deleted_lots.append(lot.pk)
+
+    def _close_lots(self, position, quantity):
+        self._sync_lots(position)
+        lots = self.lots[(position.account_id, position.symbol)]
+        released = Decimal(0)
+        while quantity > 0:
+            lot = lots[0]
+            if lot.quantity <= quantity:
+                lots.popleft()
+                self._drop_lot(lot)
+                released += lot.cost
+                quantity -= lot.quantity
+                continue
+            part = db_round(lot.cost * quantity / lot.quantity)
+            lot.quantity -= quantity
+            lot.cost -= part
+            released += part
+            if lot.pk is not None:
+                self.changed_lots[lot.pk] = lot
+            quantity = 0
+        return released
+
+    def save(self):
+        if self.updated:
+            Position.objects.bulk_update(
+                self.updated.values(), ["quantity", "average_price", "cost_basis", "realized_pnl"],
+            )
+        if self.created:
+            Position.objects.bulk_create(self.created.values())
+        if self.deleted_lots:
+            PositionLot.objects.filter(id__in=self.deleted_lots).delete()
+        if self.changed_lots:
+            PositionLot.objects.bulk_update(self.changed_lots.values(), ["quantity", "cost"])
+        if self.new_lots:
+            # Positions created above now have ids for the lots to point at.
+            PositionLot.objects.bulk_create(self.new_lots)
+
+
+@db_router.on_primary
+def settle_orders(orders, lock_timeout=None):
+    # Applies `orders` (dicts of user_id, symbol, quantity, trade_type and an
+    # optional order_id) in order with the same rules and results as settling
+    # them one at a time, but locks each account once and writes everything
+    # with bulk queries. With `lock_timeout` (ms, Postgres only) waiting on a
+    # busy account raises OperationalError instead of blocking.
+    user_ids = {order["user_id"] for order in orders}
+    symbols = {order["symbol"] for order in orders}
+    results = []
+    received = timezone.now()
+    started = time.perf_counter()
+
+    with transaction.atomic():
+        if lock_timeout is not None and connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT set_config('lock_timeout', %s, true)", [f"{int(lock_timeout)}ms"])
+        accounts = {
+            account.user_id: account
+            for account in Account.objects.select_for_update().filter(user_id__in=user_ids).order_by("id")
+        }
+        locked = time.perf_counter()
+        trade_stage_seconds.observe(locked - started, stage="lock")
+        # Prices come from the quote cache, which ingestion writes through.
+        quotes = get_quotes(symbols, local=False)
+        positions = PositionChanges.load([a.id for a in accounts.values()], symbols)
+        ensure_snapshots(accounts.values())
+        # Cash and shares held by open limit orders are not this batch's to spend.
+        book_cash, book_shares = risk.book_reservations([a.id for a in accounts.values()])
+        records = Order.objects.in_bulk([order["order_id"] for order in orders if order.get("order_id")])
+        changed_accounts = {}
+        ledger, trades, events = [], [], []
+        seen, replayed = {}, set()
+
+        for index, order in enumerate(orders):
+            # A redelivered task or a re-queued order must not fill twice.
+            order_id = order.get("order_id")
+            if order_id in seen:
+                replayed.add(index)
+                results.append(results[seen[order_id]])
+                continue
+            record = records.get(order_id)
+            if record is not None and record.status != Order.ACCEPTED:
+                logger.info(f"Order {order_id} is already {record.status}, not settling it again")
+                replayed.add(index)
+                results.append(previous_result(record))
+                continue
+            if order_id:
+                seen[order_id] = index
+            if record is not None:
+                trade_stage_seconds.observe((received - record.created_at).total_seconds(), stage="queue")
+
+            user_id, symbol, quantity, trade_type = order["user_id"], order["symbol"], order["quantity"], order["trade_type"]
+            logger.info(f"Starting{trade_type} trade for user={user_id}, symbol={symbol}, quantity={quantity}")
+            try:
+                account = accounts.get(user_id)
+                if account is None:
+                    raise Account.DoesNotExist("Account matching query does not exist.")
+                quote = quotes.get(symbol)
+                if quote is None:
+                    raise Stock.DoesNotExist("Stock matching query does not exist.")
+                price = quote_price(quote)
+                quantity = Decimal(quantity)
+                logger.info(f"Fetched account and stock for {symbol} at price={price}")
+
+                if trade_type == "buy":
+                    total_cost = price * quantity
+                    if account.balance - book_cash[account.id] < total_cost:
+                        results.append({"error": "Insufficient balance."})
+                        continue
+
+                    before = position_state(positions.get(account.id, symbol))
+                    cash = db_round(account.balance - total_cost) - account.balance
+                    account.balance += cash
+                    changed_accounts[account.id] = account
+                    position = positions.buy(account, symbol, quantity, price)
+                    realized = Decimal("0.00")
+
+                    ledger.append(Ledger(account=account, transaction_type="withdraw", amount=total_cost))
+
+                elif trade_type == "sell":
+                    total_revenue = price * quantity
+
+                    position = positions.get(account.id, symbol)
+                    if not position or position.quantity - book_shares[(account.id, symbol)] < quantity:
+                        results.append({"error": "Not enough stock to sell."})
+                        continue
+
+                    before = position_state(position)
+                    cash = db_round(account.balance + total_revenue) - account.balance
+                    account.balance += cash
+                    changed_accounts[account.id] = account
+                    realized = positions.sell(position, quantity, price)
+
+                    ledger.append(Ledger(account=account, transaction_type="deposit", amount=total_revenue))
+
+                else:
+                    results.append(None)
+                    continue
+
+                trades.append(Trade(
+                    account=account,
+                    symbol=symbol,
+                    transaction_type=trade_type,
+                    price=price,
+                    quantity=quantity,
+                    realized_pnl=realized,
+                    timestamp=timezone.now(),
+                ))
+                events.append(trade_event(
+                    account, symbol, trade_type, quantity, price, cash, before, position,
+                    order_id=order.get("order_id"), timestamp=trades[-1].timestamp,
+                ))
+                logger.info(f"Successfully completed {trade_type} trade for user={user_id}")
+                results.append({"message": f"{trade_type} order executed successfully"})
+
+            except Exception as e:
+                logger.error(f"Trade failed for user={user_id}, symbol={symbol}, error={str(e)}")
+                results.append(None)
+
+        if changed_accounts:
+            Account.objects.bulk_update(changed_accounts.values(), ["balance"])
+        positions.save()
+        if ledger:
+            Ledger.objects.bulk_create(ledger)
+        if trades:
+            Trade.objects.bulk_create(trades)
+            TradeEvent.objects.bulk_create(events)
+            filled = {trade.account_id for trade in trades}
+            transaction.on_commit(lambda: refresh_portfolios(filled))
+            transaction.on_commit(lambda: db_router.stick_to_primary(filled))
+        record_results(orders, results, quotes, records, replayed)
+        updates = order_updates(orders, results, accounts, quotes, replayed)
+        transaction.on_commit(lambda: publish_order_updates(updates))
+        # Settled or rejected, these orders no longer hold a reservation.
+        touched = [account.id for account in accounts.values()]
+        transaction.on_commit(lambda: risk.reconcile(touched, symbols))
+        settled = time.perf_counter()
+        trade_stage_seconds.observe(settled - locked, stage="settle")
+
+    # Includes the on_commit hooks (portfolio refresh, stream publish).
+    trade_stage_seconds.observe(time.perf_counter() - settled, stage="commit")
+    return results
+
+
+def previous_result(record):
+    # The result settle_orders returned when `record` was first settled.
+    if record.status == Order.FILLED:
+        return {"message": f"{record.transaction_type} order executed successfully"}
+    if record.reason in ("Insufficient balance.", "Not enough stock to sell."):
+        return {"error": record.reason}
+    return None
+
+
+def order_updates(orders, results, accounts, quotes, replayed=()):
+    updates = []
+    for index, (order, result) in enumerate(zip(orders, results)):
+        account = accounts.get(order["user_id"])
+        if account is None or index in replayed:
+            continue
+        update = {
+            "order_id": order.get("order_id"),
+            "symbol": order["symbol"],
+            "side": order["trade_type"],
+            "quantity": str(order["quantity"]),
+        }
+        if result and "message" in result:
+            update.update(type="fill", price=quotes[order["symbol"]]["price"])
+        else:
+            update.update(type="reject", reason=result["error"] if result else "Trade failed.")
+        updates.append((account.id, update))
+    return updates
+
+
+def record_results(orders, results, quotes, records, replayed=()):
+    if not records:
+        return
+    now = timezone.now()
+    settled = []
+    for index, (order, result) in enumerate(zip(orders, results)):
+        record = records.get(order.get("order_id"))
+        if record is None or index in replayed:
+            continue
+        if result and "message" in result:
+            record.status = Order.FILLED
+            record.price = quote_price(quotes[order["symbol"]])
+            record.filled_quantity = record.quantity
+        else:
+            record.status = Order.REJECTED
+            record.reason = result["error"] if result else "Trade failed."
+        record.updated_at = now
+        settled.append(record)
+    if settled:
+        Order.objects.bulk_update(settled, ["status", "price", "filled_quantity", "reason", "updated_at"])
+
+
+def get_queue():
+    from django_redis import get_redis_connection
+    return get_redis_connection("default")
+
+
+def enqueue_order(order_id, user_id, symbol, quantity, trade_type):
+    get_queue().rpush(QUEUE_KEY.format(shard_for(user_id)), json.dumps({
+        "order_id": order_id,
+        "user_id": user_id,
+        "symbol": symbol,
+        "quantity": quantity,
+        "trade_type": trade_type,
+    }))
+
+
+def next_batch(conn, key, processing, batch_size, interval, block=1):
+    # Waits up to `block` seconds for the first order, then keeps collecting
+    # until `batch_size` orders are in hand or `interval` seconds have passed.
+    # Orders are moved onto the `processing` list rather than popped, so a
+    # settler that dies mid-batch loses none; ack_batch() drops them once
+    # settled. Returns the raw items.
+    first = conn.blmove(key, processing, block, "LEFT", "RIGHT")
+    if first is None:
+        return []
+    batch = [first]
+    deadline = time.monotonic() + interval
+    while len(batch) < batch_size:
+        pipe = conn.pipeline(transaction=False)
+        for _ in range(batch_size - len(batch)):
+            pipe.lmove(key, processing, "LEFT", "RIGHT")
+        items = [item for item in pipe.execute() if item is not None]
+        if items:
+            batch.extend(items)
+            continue
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(remaining, 0.005))
+    return batch
+
+
+def ack_batch(conn, processing, batch):
+    pipe = conn.pipeline(transaction=False)
+    for item in batch:
+        pipe.lrem(processing, 1, item)
+    pipe.execute()
+
+
+def requeue_processing(conn, key, processing):
+    # Puts orders left over by a settler that died back at the head of the
+    # queue, in their original order. Orders it had already settled are no
+    # longer ACCEPTED, and settle_orders skips them.
+    count = 0
+    while conn.lmove(processing, key, "RIGHT", "LEFT") is not None:
+        count += 1
+    return count
+
+
+def settle_batch(batch):
+    try:
+        results = settle_orders(batch)
+    except Exception as e:
+        # One bad row must not take the whole batch down with it.
+        logger.error(f"Batch settlement of {len(batch)} orders failed, settling one by one: {e}")
+        results = []
+        for order in batch:
+            try:
+                results.extend(settle_orders([order]))
+            except Exception as e:
+                logger.error(f"Trade failed for user={order['user_id']}, symbol={order['symbol']}, error={str(e)}")
+                if order.get("order_id"):
+                    Order.objects.filter(id=order["order_id"], status=Order.ACCEPTED).update(
+                        status=Order.REJECTED, reason="Trade failed.", updated_at=timezone.now(),
+                    )
+                results.append(None)
+    return results
+
+
+def run(shard, batch_size=None, interval=None):
+    # Run exactly one settler per shard: that is what keeps each account's
+    # orders in submission order.
+    batch_size = batch_size or settings.SETTLEMENT_BATCH_SIZE
+    interval = settings.SETTLEMENT_BATCH_INTERVAL if interval is None else interval
+    key = QUEUE_KEY.format(shard)
+    processing = PROCESSING_KEY.format(shard)
+    conn = get_queue()
+    requeued = requeue_processing(conn, key, processing)
+    if requeued:
+        logger.warning(f"Requeued {requeued} unsettled orders on shard {shard}")
+    while True:
+        batch = next_batch(conn, key, processing, batch_size, interval)
+        if batch:
+            settle_batch([json.loads(item) for item in batch])
+            ack_batch(conn, processing, batch)
+            logger.info(f"Settled batch of {len(batch)} orders")
@@ -0,0 +1,284 @@
+from collections import OrderedDict, defaultdict, deque
+from contextlib import suppress
+import asyncio
+import json
+import logging
+import threading
+import weakref
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
+from accounts.models import Account
+from accounts.api.price_cache import _redis
+
+logger = logging.getLogger("trade_logger")
+
+# Price ticks are published on prices:<symbol> and order updates on
+# fills:<account id>. Each streaming connection gets an Outbox: ticks for the
+# same symbol overwrite each other until the client catches up, while order
+# updates are queued in full up to STREAM_MAX_PENDING, past which the client is
+# told to resync and disconnected. With Redis, all the streams of a process
+# share one subscription (RedisHub).
+
+
+def price_channel(symbol):
+    return f"prices:{symbol}"
+
+
+def fill_channel(account_id):
+    return f"fills:{account_id}"
+
+
+class Outbox:
+    def __init__(self, loop, max_pending):
+        self.loop = loop
+        self.max_pending = max_pending
+        self.latest = OrderedDict()
+        self.events = deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+
+    def deliver(self, channel, message):
+        # Called from broker threads; hand over to the connection's loop.
+        self.loop.call_soon_threadsafe(self._put, channel, message)
+
+    def _put(self, channel, message):
+        if channel.startswith("prices:"):
+            self.latest[channel] = message
+            self.latest.move_to_end(channel)
+        elif len(self.events) >= self.max_pending:
+            self.overflowed = True
+        else:
+            self.events.append(message)
+        self.ready.set()
+
+    async def drain(self):
+        await self.ready.wait()
+        self.ready.clear()
+        batch = list(self.latest.values())
+        batch.extend(self.events)
+        self.latest.clear()
+        self.events.clear()
+        return batch
+
+
+class InMemoryBroker:
+    # Process-local stand-in for tests and single-process development.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = defaultdict(set)
+
+    def publish_many(self, messages):
+        for channel, message in messages:
+            with self.lock:
+                outboxes = list(self.subscribers.get(channel, ()))
+            for outbox in outboxes:
+                outbox.deliver(channel, message)
+
+    async def listen(self, channels, outbox):
+        with self.lock:
+            for channel in channels:
+                self.subscribers[channel].add(outbox)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            with self.lock:
+                for channel in channels:
+                    self.subscribers[channel].discard(outbox)
+
+
+class RedisBroker:
+    def __init__(self, url):
+        self.url = url
+        self.hubs = weakref.WeakKeyDictionary()
+
+    def publish_many(self, messages):
+        conn = _redis()
+        if conn is None:
+            return
+        pipe = conn.pipeline(transaction=False)
+        for channel, message in messages:
+            pipe.publish(channel, json.dumps(message, cls=DjangoJSONEncoder))
+        pipe.execute()
+
+    async def listen(self, channels, outbox):
+        # A redis.asyncio connection belongs to the loop it was opened on.
+        loop = asyncio.get_running_loop()
+        hub = self.hubs.get(loop)
+        if hub is None:
+            hub = self.hubs[loop] = RedisHub(self.url)
+        await hub.listen(channels, outbox)
+
+
+class RedisHub:
+    # One Redis connection and subscription per event loop, however many
+    # streams it serves. A channel is subscribed while at least one stream
+    # wants it, each message is decoded once and handed to every interested
+    # outbox, and the connection is closed when the last stream goes. If the
+    # connection fails every stream on it ends, and clients reconnect.
+
+    def __init__(self, url):
+        self.url = url
+        self.subscribers = defaultdict(set)
+        self.lock = asyncio.Lock()
+        self.client = self.pubsub = self.reader = None
+
+    async def listen(self, channels, outbox):
+        reader = None
+        try:
+            async with self.lock:
+                if self.reader is not None and self.reader.done():
+                    await self._close()
+                new = [channel for channel in channels if not self.subscribers[channel]]
+                for channel in channels:
+                    self.subscribers[channel].add(outbox)
+                if self.pubsub is None:
+                    import redis.asyncio as aioredis
+
+                    self.client = aioredis.from_url(self.url)
+                    self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                if new:
+                    await self.pubsub.subscribe(*new)
+                if self.reader is None:
+                    self.reader = asyncio.create_task(self._read(self.pubsub))
+                reader = self.reader
+            # Shielded: one stream going away must not stop the others'.
+            await asyncio.shield(reader)
+        finally:
+            async with self.lock:
+                gone = []
+                for channel in channels:
+                    outboxes = self.subscribers.get(channel)
+                    if outboxes is None:
+                        continue
+                    outboxes.discard(outbox)
+                    if not outboxes:
+                        del self.subscribers[channel]
+                        gone.append(channel)
+                if reader is None or (reader is self.reader and not self.subscribers):
+                    # Setting up failed, or this was the last stream.
+                    await self._close()
+                elif gone and reader is self.reader and not reader.done():
+                    with suppress(Exception):
+                        await self.pubsub.unsubscribe(*gone)
+
+    async def _read(self, pubsub):
+        async for message in pubsub.listen():
+            channel = message["channel"].decode()
+            outboxes = self.subscribers.get(channel)
+            if not outboxes:
+                continue
+            data = json.loads(message["data"])
+            for outbox in list(outboxes):
+                # Same loop as the streams: no thread hand-over needed.
+                outbox._put(channel, data)
+
+    async def _close(self):
+        reader, client, pubsub = self.reader, self.client, self.pubsub
+        self.client = self.pubsub = self.reader = None
+        # Streams still registered belong to the connection that failed.
+        self.subscribers.clear()
+        if reader is not None and not reader.done():
+            reader.cancel()
+            with suppress(asyncio.CancelledError):
+                await reader
+        with suppress(Exception):
+            if pubsub is not None:
+                await pubsub.aclose()
+            if client is not None:
+                await client.aclose()
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        if settings.STREAM_BROKER == "memory":
+            _broker = InMemoryBroker()
+        else:
+            _broker = RedisBroker(settings.STREAM_REDIS_URL)
+    return _broker
+
+
+def publish(messages):
+    # `messages` is a list of (channel, payload) pairs. Publishing is best
+    # effort: a stream outage must never fail a trade or a price update.
+    if not messages:
+        return
+    try:
+        get_broker().publish_many(messages)
+    except Exception as e:
+        logger.error(f"Failed to publish {len(messages)} stream messages: {e}")
+
+
+def publish_prices(quotes):
+    publish([(price_channel(quote["symbol"]), dict(quote, type="price")) for quote in quotes])
+
+
+def publish_order_updates(updates):
+    # `updates` is a list of (account id, payload) pairs.
+    publish([(fill_channel(account_id), payload) for account_id, payload in updates])
+
+
+def format_event(message):
+    return f"event: {message.get('type', 'message')}\ndata: {json.dumps(message, cls=DjangoJSONEncoder)}\n\n"
+
+
+async def _authenticated_account_id(request):
+    from rest_framework_simplejwt.tokens import AccessToken
+    from rest_framework_simplejwt.exceptions import TokenError
+
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return None
+    try:
+        token = AccessToken(header.split(" ", 1)[1])
+    except TokenError:
+        return None
+    user_id = token.get(settings.SIMPLE_JWT.get("USER_ID_CLAIM", "user_id"))
+    return await Account.objects.filter(user_id=user_id).values_list("id", flat=True).afirst()
+
+
+async def stream(request):
+    # Server-sent events; needs the ASGI entry point (core.asgi).
+    symbols = list(dict.fromkeys(s for s in request.GET.get("symbols", "").split(",") if s))
+    if len(symbols) > settings.STREAM_MAX_SYMBOLS:
+        return HttpResponseBadRequest(f"Pass at most {settings.STREAM_MAX_SYMBOLS} symbols.")
+    channels = [price_channel(symbol) for symbol in symbols]
+    account_id = await _authenticated_account_id(request)
+    if account_id is not None:
+        channels.append(fill_channel(account_id))
+    if not channels:
+        return HttpResponseBadRequest("Pass ?symbols=... or an access token.")
+
+    async def events():
+        outbox = Outbox(asyncio.get_running_loop(), settings.STREAM_MAX_PENDING)
+        listener = asyncio.create_task(get_broker().listen(channels, outbox))
+        try:
+            yield ": connected\n\n"
+            while True:
+                try:
+                    batch = await asyncio.wait_for(outbox.drain(), timeout=settings.STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    if listener.done():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                # One write per drained batch; the server's send backpressure
+                # holds us here while ticks keep coalescing in the outbox.
+                yield "".join(format_event(message) for message in batch)
+                if outbox.overflowed:
+                    yield format_event({"type": "overflow"})
+                    break
+        finally:
+            listener.cancel()
+            with suppress(asyncio.CancelledError):
+                await listener
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
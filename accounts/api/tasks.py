@@ -1,107 +1,88 @@
 from celery import shared_task
-from decimal import Decimal
-from django.db import transaction
-from django.utils import timezone
-from accounts.models import Account, Stock, Position, Ledger, Trade
-from django.core.cache import cache
-import requests
-import yfinance as yf
-import csv
-import os
+from accounts.models import Account, Position, Order
 from django.conf import settings
+from django.db.models import Sum
+from accounts.api.matching import engine, OrderRejected, reject_order, to_units, from_units
+from accounts.api.settlement import settle_orders
+from accounts.api.prices import ingest_prices
+from accounts.api.reports import write_trade_report
+from accounts.api.exports import export_all
+from accounts.api.bars import prune_ticks
+from accounts.api.partitions import ensure_partitions
+from accounts.api.journal import snapshot_accounts
+from core import db_router
 
 
 import logging
 logger = logging.getLogger("trade_logger")
 
 
+# Safe to redeliver: settle_orders skips an order that is no longer accepted,
+# so a task re-run after a worker crash cannot fill twice.
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def process_trade(user_id, symbol, quantity, trade_type, order_id=None):
+    order = {"user_id": user_id, "symbol": symbol, "quantity": quantity, "trade_type": trade_type, "order_id": order_id}
+    return settle_orders([order])[0]
+
+@shared_task
+def submit_order(order_id):
+    # Puts a limit order, already stored and reserved by place_order, on the book.
+    engine.load()
+    record = Order.objects.filter(id=order_id).first()
+    if record is None or record.status != Order.ACCEPTED or engine.placed(order_id):
+        # Cancelled before it got here, or already put back by load().
+        return {"order_id": order_id, "status": record.status if record else None}
+    logger.info(
+        f"Book order {record.transaction_type} account={record.account_id}, symbol={record.symbol}, "
+        f"quantity={record.quantity}, limit={record.limit_price}"
+    )
+    try:
+        balance = Account.objects.values_list("balance", flat=True).get(id=record.account_id)
+        held = Position.objects.filter(account_id=record.account_id, symbol=record.symbol).aggregate(total=Sum("quantity"))["total"] or 0
+        order, fills = engine.place(
+            record.id,
+            record.account_id,
+            record.symbol,
+            record.transaction_type,
+            to_units(record.quantity),
+            price=to_units(record.limit_price),
+            balance=to_units(balance) * 100,
+            held=to_units(held),
+        )
+    except OrderRejected as e:
+        reject_order(order_id, str(e))
+        return {"error": str(e)}
+    except Exception as e:
+        logger.error(f"Book order {order_id} failed, symbol={record.symbol}, error={str(e)}")
+        reject_order(order_id, "Order could not be placed.")
+        return {"error": "Order could not be placed."}
+
+    if len(engine.pending) >= settings.MATCHING_FLUSH_SIZE:
+        engine.flush()
+
+    return {
+        "order_id": order.id,
+        "filled": str(from_units(sum(f.quantity for f in fills))),
+        "resting": str(from_units(order.remaining)),
+        "fills": [{"price": str(from_units(f.price)), "quantity": str(from_units(f.quantity))} for f in fills],
+    }
+
+@shared_task
+def cancel_order(order_id):
+    # The view has already cancelled the row; this takes it off the book.
+    engine.load()
+    order = engine.cancel(order_id)
+    if order is None:
+        return {"error": "Order not on the book."}
+    return {"message": f"Order {order_id} cancelled"}
+
 @shared_task
-def process_trade(user_id, symbol, quantity, trade_type):
-    logger.info(f"Starting{trade_type} trade for user={user_id}, symbol={symbol}, quantity={quantity}")
-    with transaction.atomic():
-        try:
-            account = Account.objects.select_for_update().get(user_id=user_id)
-            stock = Stock.objects.get(symbol=symbol)
-            quantity = Decimal(quantity)
-            logger.info(f"Fetched account and stock for {symbol} at price={stock.price}")
-
-
-            if trade_type == "buy":
-                total_cost = stock.price *quantity
-                if account.balance < total_cost:
-                    return {"error": "Insufficient balance."}
-                
-                account.balance -= total_cost
-                account.save(update_fields=["balance"])
-
-                position = account.positions.filter(symbol=symbol).first()
-                if position:
-                    position.quantity += quantity
-                    position.average_price = stock.price
-                    position.save(update_fields=["quantity", "average_price"])
-
-                else:
-                    Position.objects.create(
-                        account=account,
-                        symbol=symbol,
-                        quantity=quantity,
-                        average_price=stock.price
-                    )
-            
-                Ledger.objects.create(
-                    account=account,
-                    transaction_type="withdraw",
-                    amount=total_cost,
-                )
-
-                Trade.objects.create(
-                    account=account,
-                    symbol=symbol,
-                    transaction_type="buy",
-                    price = stock.price,
-                    quantity=quantity,
-                    timestamp=timezone.now()
-                )
-                logger.info(f"Successfully completed {trade_type} trade for user={user_id}")
-
-                return {"message": f"{trade_type} order executed successfully"}
-
-            elif trade_type == "sell":
-                total_revenue = stock.price * quantity
-
-                position = account.positions.filter(symbol=symbol).first()
-                if not position or position.quantity < quantity:
-                    return {"error": "Not enough stock to sell."}
-
-                account.balance+=total_revenue
-                account.save(update_fields=["balance"])
-
-                position.quantity-=quantity
-                if position.quantity == 0:
-                    position.delete()
-                else:
-                    position.save(update_fields=["quantity"])
-
-                Ledger.objects.create(
-                    account=account,
-                    transaction_type="deposit",
-                    amount=total_revenue,
-                )
-
-                Trade.objects.create(
-                    account=account,
-                    symbol=symbol,
-                    transaction_type="sell",
-                    price=stock.price,
-                    quantity=quantity,
-                    timestamp=timezone.now()
-                )
-
-                logger.info(f"Successfully completed {trade_type} trade for user={user_id}")
-
-                return {"message": f"{trade_type} order executed successfully"}
-        except Exception as e:
-            logger.error(f"Trade failed for user={user_id}, symbol={symbol}, error={str(e)}")
+def flush_fills():
+    engine.load()
+    count = engine.flush()
+    if count:
+        logger.info(f"Flushed {count} book fills")
+    return count
 
 @shared_task
 def test_beat_task():
@@ -111,50 +92,29 @@ def test_beat_task():
 @shared_task
 def update_stock_prices():
     logger.info("Starting stock price update task ...")
-
-    symbols = ["AAPL", "GOOGL", "TSLA"]
-
-    for symbol in symbols:
-        try:
-            ticker = yf.Ticker(symbol)
-            price = ticker.history(period="1d")["Close"].iloc[-1]
-
-            stock, created = Stock.objects.update_or_create(
-                symbol=symbol,
-                defaults={"price": price},
-            )
-
-            cache.set(f"stock:{symbol}", price, timeout=60*5)
-
-            logger.info(f"Updated {symbol} with price {price}")
-
-        except Exception as e:
-            logger.error(f"Failed to update {symbol}: {e}")
+    return ingest_prices()
 
 
 @shared_task
-def generate_daily_report():
-    reports_dir = os.path.join(settings.BASE_DIR, "reports")
-    os.makedirs(reports_dir, exist_ok=True)
-
-    today_str = timezone.now().strftime("%Y-%m-%d")
-    file_path = os.path.join(reports_dir, f"report_{today_str}.csv")
-
-    with open(file_path, mode="w", newline="") as csv_file:
-        writer = csv.writer(csv_file)
+def generate_daily_report(start_date=None, end_date=None, compress=None):
+    # A whole day of trades: read it from the replica when there is one.
+    with db_router.reads_from(db_router.REPLICA):
+        file_path, rows = write_trade_report(start_date, end_date, compress)
+    logger.info(f"Report created with {rows} trades: {file_path}")
+    return f"Report created: {file_path}"
 
-        writer.writerow(["username", "symbol", "trade_type", "quantity", "price", "balance"])
+@shared_task
+def export_analytics():
+    return export_all()
 
-        trades = Trade.objects.filter(timestamp__date=timezone.now().date())
+@shared_task
+def prune_price_ticks():
+    return prune_ticks()
 
-        for trade in trades:
-            writer.writerow([
-                trade.account.user.username,
-                trade.symbol,
-                trade.transaction_type,
-                trade.quantity,
-                trade.price,
-                trade.account.balance
-            ])
+@shared_task
+def maintain_partitions():
+    return ensure_partitions()
 
-    return f"Report created: {file_path}"
\ No newline at end of file
+@shared_task
+def snapshot_journal():
+    return snapshot_accounts()
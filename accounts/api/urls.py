@@ -1,5 +1,7 @@
 from django.urls import path
-from accounts.api.views import RegisterView , ProtectedAPIView, AccountPositionsView, AccountLedgerView, StockIngestView, StockListView, StockDetailView, TradeView
+from accounts.api.views import RegisterView , ProtectedAPIView, AccountPositionsView, AccountLedgerView, AccountPortfolioView, StockIngestView, StockListView, StockDetailView, StockBarsView, TradeView, OrderCancelView, OrderDetailView, QuoteCacheStatsView
+from accounts.api.streaming import stream
+from accounts.api import async_views
 from rest_framework_simplejwt.views import TokenObtainPairView , TokenRefreshView
 
 
@@ -10,8 +12,21 @@ urlpatterns = [
     path("auth/protect/", ProtectedAPIView.as_view(), name="protected_view"),
     path("auth/protect/<int:account_id>/positions/", AccountPositionsView.as_view(), name="positions_view"),
     path("auth/protect/<int:account_id>/ledger/", AccountLedgerView.as_view(), name="ledger_view"),
+    path("auth/protect/<int:account_id>/portfolio/", AccountPortfolioView.as_view(), name="portfolio_view"),
     path("stock/ingest/", StockIngestView.as_view(), name="stock_ingest"),
     path("stocks/", StockListView.as_view(), name="stock_list"),
+    path("stocks/cache/stats/", QuoteCacheStatsView.as_view(), name="quote_cache_stats"),
     path("stocks/<str:symbol>/", StockDetailView.as_view(), name="stock_detail"),
-    path("trade/", TradeView.as_view(), name="trade")
+    path("stocks/<str:symbol>/bars/", StockBarsView.as_view(), name="stock_bars"),
+    path("trade/", TradeView.as_view(), name="trade"),
+    path("trade/<int:order_id>/cancel/", OrderCancelView.as_view(), name="order_cancel"),
+    path("orders/<int:order_id>/", OrderDetailView.as_view(), name="order_detail"),
+    path("stream/", stream, name="stream"),
+    # Async versions of the read endpoints above, for the ASGI server.
+    path("async/auth/protect/", async_views.account_detail, name="async_protected_view"),
+    path("async/auth/protect/<int:account_id>/positions/", async_views.account_positions, name="async_positions_view"),
+    path("async/auth/protect/<int:account_id>/ledger/", async_views.account_ledger, name="async_ledger_view"),
+    path("async/auth/protect/<int:account_id>/portfolio/", async_views.account_portfolio, name="async_portfolio_view"),
+    path("async/stocks/", async_views.stock_list, name="async_stock_list"),
+    path("async/stocks/<str:symbol>/", async_views.stock_detail, name="async_stock_detail"),
 ]
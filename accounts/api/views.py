@@ -1,22 +1,76 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from .serializers import RegisterSerializer, AccountSerializer, PositionSerializer, LedgerSerializer, StockSerializer
+from .serializers import RegisterSerializer, AccountSerializer, PositionSerializer, LedgerSerializer, StockSerializer, PortfolioSerializer, PriceBarSerializer, TradeRequestSerializer, LimitOrderRequestSerializer, OrderSerializer
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
-from accounts.models import Account, Position, Ledger, Stock
+from accounts.models import Account, Position, Ledger, Stock, Order
 from rest_framework import generics
 from django_filters.rest_framework import DjangoFilterBackend
-from rest_framework.permissions import AllowAny
-from django.shortcuts import get_object_or_404
-from django.core.cache import cache
+from rest_framework.permissions import AllowAny, IsAdminUser
 from decimal import Decimal
-from accounts.api.tasks import process_trade
+from accounts.api.tasks import cancel_order
+from accounts.api.orders import place_order, OrderInProgress, IdempotencyKeyReused
+from accounts.api.risk import RiskRejected, reconcile as reconcile_risk
+from accounts.api.pagination import KeysetPagination
+from accounts.api import fastjson
+from accounts.api.portfolio import get_portfolio
+from accounts.api.price_cache import get_quote, get_quotes, local_quotes
+from accounts.api.bars import INTERVALS, get_bars
+from accounts.api.ingest import upsert_stocks, CSVStreamParser, JSONArrayStreamParser, NDJSONStreamParser
+from rest_framework.exceptions import ValidationError
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils import timezone
+from collections.abc import Iterator
+from datetime import datetime, time, timedelta
+from functools import wraps
+from core import db_router
+import os
+
+def parse_bound(value, name):
+    # Accepts an ISO date or datetime. A bare date as the upper bound includes
+    # that whole day.
+    if not value:
+        return None
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValidationError({name: "Use an ISO date or datetime."})
+        if name == "end":
+            day += timedelta(days=1)
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+def replica_reads(handler):
+    # Runs a GET handler's queries on the read replica (see core.db_router),
+    # unless the account in the URL has just traded. Authentication has
+    # already run on the primary by then.
+    @wraps(handler)
+    def wrapper(self, request, *args, **kwargs):
+        with db_router.reads_from(db_router.replica_for(kwargs.get("account_id"))):
+            return handler(self, request, *args, **kwargs)
+    return wrapper
+
+def keyset_response(request, view, queryset, time_field, serializer_class):
+    paginator = KeysetPagination(time_field)
+    if not fastjson.enabled(request):
+        page = paginator.paginate_queryset(queryset, request, view)
+        return paginator.get_paginated_response(serializer_class(page, many=True).data)
+    # Same body as above, straight from values_list() rows.
+    lean = fastjson.LeanSerializer(serializer_class, extra=(time_field, "id"))
+    paginator.key = lean.key(time_field, "id")
+    page = paginator.paginate_queryset(lean.values_list(queryset), request, view)
+    return fastjson.list_response(page, lean.data, head={"next": paginator.get_next_link()})
 
 class RegisterView(APIView):
     def post(self, request):
         serilaizer = RegisterSerializer(data = request.data)
         if serilaizer.is_valid():
-            serilaizer.save()
+            user = serilaizer.save()
+            # The new account is not on the replica yet.
+            db_router.stick_to_primary([user.account.id])
             return Response({"message":"User has been Registered Successfully"}, status=status.HTTP_201_CREATED)
         return Response(serilaizer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -34,6 +88,7 @@ class ProtectedAPIView(APIView):
 class AccountPositionsView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @replica_reads
     def get(self, request, account_id):
         try:
             account = Account.objects.get(id=account_id, user=request.user)
@@ -41,34 +96,75 @@ class AccountPositionsView(APIView):
             return Response({"error":"Account not found"}, status=status.HTTP_404_NOT_FOUND)
 
         positions = account.positions.all()
-        serializer = PositionSerializer(positions, many=True) 
-        return Response(serializer.data)
+        # Sold-out positions are kept for their realized P&L; ?closed=1 lists them too.
+        if request.query_params.get("closed") not in ("1", "true"):
+            positions = positions.exclude(quantity=0)
+        symbol = request.query_params.get("symbol")
+        if symbol:
+            positions = positions.filter(symbol=symbol)
+        return keyset_response(request, self, positions, "created_at", PositionSerializer)
 
 class AccountLedgerView(APIView):
     permission_classes = [IsAuthenticated]
 
+    @replica_reads
     def get(self, request, account_id):
         try:
             account = Account.objects.get(id=account_id, user=request.user)
         except Account.DoesNotExist:
             return Response({"error message":"Account not found"}, status=status.HTTP_404_NOT_FOUND)
-        
+
         ledger = account.ledger.all()
-        serializer = LedgerSerializer(ledger, many=True)
-        return Response(serializer.data)
+        transaction_type = request.query_params.get("transaction_type")
+        if transaction_type:
+            ledger = ledger.filter(transaction_type=transaction_type)
+        start = parse_bound(request.query_params.get("start"), "start")
+        if start:
+            ledger = ledger.filter(timestamp__gte=start)
+        end = parse_bound(request.query_params.get("end"), "end")
+        if end:
+            ledger = ledger.filter(timestamp__lt=end)
+        return keyset_response(request, self, ledger, "timestamp", LedgerSerializer)
         
 
-class StockIngestView(APIView):
+class AccountPortfolioView(APIView):
     permission_classes = [IsAuthenticated]
 
+    def get(self, request, account_id):
+        try:
+            account = Account.objects.get(id=account_id, user=request.user)
+        except Account.DoesNotExist:
+            return Response({"error":"Account not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        serializer = PortfolioSerializer(get_portfolio(account))
+        return Response(serializer.data)
+
+
+class StockIngestView(APIView):
+    # Staff only: an upsert rewrites the price trades settle at.
+    permission_classes = [IsAdminUser]
+    parser_classes = [JSONArrayStreamParser, NDJSONStreamParser, CSVStreamParser]
+
     def post(self, request):
-        serializer = StockSerializer(data = request.data, many=True)
-        if serializer.is_valid():
-            serializer.save()
-            return Response({"message":"Stock ingested Successfully"}, status=status.HTTP_201_CREATED)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        # Upserts by symbol, so the same listing can be loaded again safely.
+        # JSON takes a list; every body is read row by row, so the parsers
+        # hand over iterators.
+        rows = request.data
+        if not isinstance(rows, Iterator):
+            return Response(
+                {"non_field_errors": [f'Expected a list of items but got type "{type(rows).__name__}".']},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        result = upsert_stocks(rows)
+        if result["received"] and not result["upserted"]:
+            return Response(result, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"message":"Stock ingested Successfully", **result}, status=status.HTTP_201_CREATED)
     
 
+def quote_list(symbols):
+    quotes = get_quotes(symbols)
+    return [quotes[symbol] for symbol in symbols if symbol in quotes]
+
 class StockListView(generics.ListAPIView):
     queryset = Stock.objects.all().order_by("id")
     serializer_class = StockSerializer
@@ -76,30 +172,132 @@ class StockListView(generics.ListAPIView):
     filterset_fields = ["symbol", "exchange"]
     permission_classes = [AllowAny]
 
+    @replica_reads
+    def list(self, request, *args, **kwargs):
+        # The database only decides which symbols are on the page; the quotes
+        # themselves are read through the price cache.
+        symbols = self.filter_queryset(self.get_queryset()).values_list("symbol", flat=True)
+        page = self.paginate_queryset(symbols)
+        paginated = page is not None
+        if not paginated:
+            page = list(symbols)
+        if fastjson.enabled(request):
+            # Quotes are fetched a chunk at a time as a long list streams out.
+            head = self.get_paginated_response([]).data if paginated else None
+            return fastjson.list_response(page, quote_list, head=head)
+        data = quote_list(page)
+        if not paginated:
+            return Response(data)
+        return self.get_paginated_response(data)
+
 class StockDetailView(APIView):
     permission_classes = [AllowAny]
 
+    @replica_reads
     def get(self, request, symbol):
-        key = f"stock:{symbol}"
-        data = cache.get(key)
-
+        data = get_quote(symbol)
         if data is None:
-            stock = get_object_or_404(Stock, symbol=symbol)
-            serializer = StockSerializer(stock)
-            data = serializer.data
-            cache.set(key, data, timeout=600)
+            return Response({"detail": "No Stock matches the given query."}, status=status.HTTP_404_NOT_FOUND)
         return Response(data)
 
-class TradeView(APIView):
+class StockBarsView(APIView):
     permission_classes = [AllowAny]
 
+    @replica_reads
+    def get(self, request, symbol):
+        # Served from precomputed PriceBar rows; raw ticks are never scanned.
+        interval = request.query_params.get("interval", "1m")
+        if interval not in INTERVALS:
+            raise ValidationError({"interval": f"Use one of {', '.join(INTERVALS)}."})
+        try:
+            limit = int(request.query_params.get("limit", 0)) or None
+            if limit is not None and limit < 0:
+                raise ValueError
+        except ValueError:
+            raise ValidationError({"limit": "Use a positive whole number."})
+        bars = get_bars(
+            symbol,
+            interval,
+            start=parse_bound(request.query_params.get("start"), "start"),
+            end=parse_bound(request.query_params.get("end"), "end"),
+            limit=limit,
+        )
+        return Response({"symbol": symbol, "interval": interval, "bars": PriceBarSerializer(bars, many=True).data})
+
+class QuoteCacheStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        # Counters are per process: this is the worker that served the request.
+        return Response({"pid": os.getpid(), "l1": local_quotes.stats()})
+
+class TradeView(APIView):
+    permission_classes = [IsAuthenticated]
+
     def post(self, request):
-        symbol = request.data.get("symbol")
-        quantity = request.data.get("quantity")
-        trade_type = request.data.get("trade_type")
+        # Limit orders are stored like market orders and then go to the
+        # matching engine's book instead of settlement; the id in the
+        # response is the one to cancel them by.
+        limit = request.data.get("order_type") == "limit" or request.data.get("limit_price") is not None
+        data = request.data.copy()
+        key = request.headers.get("Idempotency-Key")
+        if key and not data.get("client_order_id"):
+            data["client_order_id"] = key
+        serializer = (LimitOrderRequestSerializer if limit else TradeRequestSerializer)(data=data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if limit and get_quote(serializer.validated_data["symbol"]) is None:
+            return Response({"error": "Stock not found."}, status=status.HTTP_404_NOT_FOUND)
 
-        process_trade.delay(request.user.id, symbol, quantity, trade_type)
-        return Response({"message": "Trade submitted for processing."})
+        try:
+            order, replayed = place_order(request.user.account, request.user.id, **serializer.validated_data)
+        except OrderInProgress:
+            return Response({"error": "An order with this client_order_id is still being placed."}, status=status.HTTP_409_CONFLICT)
+        except IdempotencyKeyReused:
+            return Response(
+                {"error": "client_order_id was already used for a different order."},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+        except RiskRejected as e:
+            return Response({"error": str(e)}, status=e.status)
+        data = OrderSerializer(order).data
+        headers = {"Idempotent-Replayed": "true"} if replayed else None
+        if order.status == Order.ACCEPTED:
+            data["message"] = "Order submitted to the book." if limit else "Trade submitted for processing."
+            return Response(data, status=status.HTTP_202_ACCEPTED, headers=headers)
+        return Response(data, headers=headers)
+
+class OrderDetailView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, order_id):
+        try:
+            order = Order.objects.get(id=order_id, account__user=request.user)
+        except Order.DoesNotExist:
+            return Response({"error":"Order not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(OrderSerializer(order).data)
+
+class OrderCancelView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, order_id):
+        # Only open limit orders can be cancelled. The row is what counts: the
+        # book drops the order, and turns down any fill of it not yet written.
+        cancelled = Order.objects.filter(
+            id=order_id, account__user=request.user, status=Order.ACCEPTED, limit_price__isnull=False,
+        ).update(status=Order.CANCELLED, reason="Cancelled by user.", updated_at=timezone.now())
+        try:
+            order = Order.objects.get(id=order_id, account__user=request.user)
+        except Order.DoesNotExist:
+            return Response({"error":"Order not found"}, status=status.HTTP_404_NOT_FOUND)
+        if not cancelled:
+            return Response(
+                {"error": "Only open limit orders can be cancelled.", **OrderSerializer(order).data},
+                status=status.HTTP_409_CONFLICT,
+            )
+        cancel_order.delay(order_id)
+        reconcile_risk([order.account_id], [order.symbol])
+        return Response(OrderSerializer(order).data)
 
 
 
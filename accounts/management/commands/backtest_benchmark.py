@@ -0,0 +1,52 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from accounts.api import backtest
+
+# A trading year of minute bars: 252 sessions of 390 minutes.
+YEAR_OF_MINUTES = 252 * 390
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the backtest over generated minute prices and orders (a year of minute bars across hundreds "
+        "of symbols by default) and fail if it takes longer than --budget seconds."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--minutes", type=int, default=YEAR_OF_MINUTES)
+        parser.add_argument("--symbols", type=int, default=300)
+        parser.add_argument("--accounts", type=int, default=500)
+        parser.add_argument("--orders", type=int, default=1000000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--budget", type=float, default=10.0, help="Seconds the backtest may take.")
+
+    def handle(self, *args, **options):
+        try:
+            import numpy as np
+        except ImportError:
+            raise CommandError("The backtest benchmark needs numpy (pip install numpy).")
+        rng = np.random.default_rng(options["seed"])
+        minutes, symbols, accounts, orders = options["minutes"], options["symbols"], options["accounts"], options["orders"]
+
+        # Random walks in cents starting at 100.00, never below 1.00.
+        prices = np.maximum(np.cumsum(rng.integers(-5, 6, size=(minutes, symbols)), axis=0) + 10000, 100)
+        steps = np.sort(rng.integers(0, minutes, orders))
+        owners = rng.integers(0, accounts, orders)
+        columns = rng.integers(0, symbols, orders)
+        sides = rng.choice([backtest.BUY, backtest.BUY, backtest.SELL], orders)
+        quantities = rng.integers(1, 1000, orders)
+        balances = np.full(accounts, 100000 * 100, dtype=np.int64)
+
+        started = time.perf_counter()
+        result = backtest.run_backtest(prices, steps, owners, columns, sides, quantities, balances)
+        elapsed = time.perf_counter() - started
+
+        counts = np.bincount(result.status, minlength=len(backtest.RESULTS))
+        self.stdout.write(
+            f"{orders} orders over {minutes} minutes x {symbols} symbols, {accounts} accounts: {elapsed:.2f}s "
+            f"({counts[backtest.FILLED]} filled, {counts[backtest.INSUFFICIENT_BALANCE]} short of cash, "
+            f"{counts[backtest.NOT_ENOUGH_STOCK]} short of stock)"
+        )
+        if elapsed > options["budget"]:
+            raise CommandError(f"Backtest took {elapsed:.2f}s, over the {options['budget']}s budget")
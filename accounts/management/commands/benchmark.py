@@ -0,0 +1,331 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from decimal import Decimal
+import json
+import math
+import os
+import random
+import secrets
+import threading
+import time
+
+from django.conf import settings
+from asgiref.sync import async_to_sync
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import AsyncClient, Client
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+from accounts.models import CustomUser, Account, Stock
+from accounts.api.price_cache import set_quotes, publish_invalidation, quote_key
+from accounts.api.reports import REPORT_HEADER, report_rows
+from accounts.api.metrics import count_queries
+
+PREFIX = "bench"
+EXCHANGE = "BENCH"
+# Flagged when the mean query count grows by more than this, whatever the
+# tolerance: query counts do not depend on the machine.
+QUERY_SLACK = 0.5
+
+
+def percentile(values, fraction):
+    # Nearest rank.
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def run(self, scenario, call):
+        started = time.perf_counter()
+        with count_queries() as queries:
+            try:
+                ok = call()
+            except Exception:
+                ok = False
+        self.add(scenario, time.perf_counter() - started, queries[0], ok)
+
+    async def arun(self, scenario, call):
+        started = time.perf_counter()
+        with count_queries() as queries:
+            try:
+                ok = await call()
+            except Exception:
+                ok = False
+        self.add(scenario, time.perf_counter() - started, queries[0], ok)
+
+    def add(self, scenario, elapsed, queries, ok):
+        with self.lock:
+            self.samples.setdefault(scenario, []).append((elapsed, queries, ok))
+
+    def summary(self, wall):
+        results = {}
+        for scenario, samples in sorted(self.samples.items()):
+            latency = [elapsed * 1000 for elapsed, _, _ in samples]
+            queries = [count for _, count, _ in samples]
+            results[scenario] = {
+                "requests": len(samples),
+                "errors": sum(1 for _, _, ok in samples if not ok),
+                "throughput": round(len(samples) / wall, 1),
+                "p50_ms": round(percentile(latency, 0.50), 2),
+                "p99_ms": round(percentile(latency, 0.99), 2),
+                "queries": round(sum(queries) / len(queries), 2),
+                "max_queries": max(queries),
+            }
+        return results
+
+
+def traded(response):
+    # A rejected order (no balance, nothing to sell, rate limit) is a normal
+    # answer: a 4xx with an "error". Any other 4xx (bad host, bad token) or a
+    # server error counts as a failure.
+    if response.status_code in (200, 202):
+        return True
+    return response.status_code < 500 and "error" in response.json()
+
+
+class HostAsyncClient(AsyncClient):
+    # AsyncClient always sends "host: testserver" and appends any Host given
+    # in headers= after it, so the request sees "testserver,<host>". Swap the
+    # header itself in the ASGI scope instead.
+    def __init__(self, host, **defaults):
+        super().__init__(**defaults)
+        self.host = host.encode("latin1")
+
+    def _base_scope(self, **request):
+        scope = super()._base_scope(**request)
+        scope["headers"] = [
+            (name, self.host if name == b"host" else value) for name, value in scope["headers"]
+        ]
+        return scope
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for scenario, expected in baseline.items():
+        found = results.get(scenario)
+        if found is None:
+            continue
+        if found["p99_ms"] > expected["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{scenario}: p99 {found['p99_ms']}ms vs {expected['p99_ms']}ms")
+        if found["throughput"] < expected["throughput"] * (1 - tolerance):
+            regressions.append(f"{scenario}: throughput {found['throughput']}/s vs {expected['throughput']}/s")
+        if found["queries"] > expected["queries"] + QUERY_SLACK:
+            regressions.append(f"{scenario}: {found['queries']} queries per call vs {expected['queries']}")
+        if found["errors"] > expected.get("errors", 0):
+            regressions.append(f"{scenario}: {found['errors']} errors vs {expected.get('errors', 0)}")
+    return regressions
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed benchmark accounts and symbols, drive a mixed workload of trades, quote and portfolio reads "
+        "and reports through the API, and report throughput, p50/p99 latency and queries per endpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--accounts", type=int, default=100)
+        parser.add_argument("--symbols", type=int, default=50)
+        parser.add_argument("--trades", type=int, default=1000)
+        parser.add_argument("--quotes", type=int, default=5000)
+        parser.add_argument("--portfolios", type=int, default=1000)
+        parser.add_argument("--reports", type=int, default=5)
+        parser.add_argument("--concurrency", type=int, default=8, help="Client threads (always 1 on SQLite).")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--queued", action="store_true",
+            help="Leave trades to running Celery workers instead of settling them in the request.",
+        )
+        parser.add_argument(
+            "--asgi", action="store_true",
+            help="Also run the quote and portfolio reads against the async endpoints (quote_async, portfolio_async).",
+        )
+        parser.add_argument("--asgi-concurrency", type=int, default=200, help="Concurrent async reads.")
+        parser.add_argument("--output", help="Write the results as JSON here.")
+        parser.add_argument("--baseline", help="Compare with this results file and fail on regressions.")
+        parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed latency/throughput drift.")
+        parser.add_argument("--keep", action="store_true", help="Leave the seeded rows in place.")
+
+    def handle(self, *args, **options):
+        concurrency = options["concurrency"]
+        if connection.vendor == "sqlite" and concurrency > 1:
+            self.stdout.write("SQLite allows one writer at a time: running with --concurrency 1")
+            concurrency = 1
+        if not options["queued"]:
+            from core.celery import app
+            app.conf.task_always_eager = True
+
+        # Every row this run seeds carries its id, and only those rows are
+        # removed afterwards, so real users named "bench-..." are never touched.
+        self.run_id = secrets.token_hex(4)
+        self.stdout.write(f"Benchmark run {self.run_id}")
+        try:
+            accounts, symbols = self.seed(options["accounts"], options["symbols"])
+            plan = self.plan(accounts, symbols, options)
+            recorder = Recorder()
+            started = time.perf_counter()
+            if concurrency == 1:
+                client = self.client()
+                for scenario, call in plan:
+                    recorder.run(scenario, lambda: call(client))
+            else:
+                local = threading.local()
+
+                def work(step):
+                    if not hasattr(local, "client"):
+                        local.client = self.client()
+                    scenario, call = step
+                    recorder.run(scenario, lambda: call(local.client))
+
+                with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                    list(pool.map(work, plan))
+            results = recorder.summary(time.perf_counter() - started)
+            if options["asgi"]:
+                results.update(async_to_sync(self.async_reads)(accounts, symbols, options))
+        finally:
+            if not options["keep"]:
+                self.cleanup()
+            else:
+                self.stdout.write(f"Kept the rows of run {self.run_id} (users {self.user_prefix()}*)")
+            connections.close_all()
+
+        for scenario, row in sorted(results.items()):
+            self.stdout.write(
+                f"{scenario:<16} {row['requests']:>6} calls {row['errors']:>4} errors {row['throughput']:>9}/s "
+                f"p50 {row['p50_ms']:>8}ms p99 {row['p99_ms']:>8}ms {row['queries']:>6} queries"
+            )
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        # A scenario that errored was not measured: its numbers are meaningless.
+        failed = [f"{scenario}: {row['errors']} of {row['requests']} calls failed"
+                  for scenario, row in sorted(results.items()) if row["errors"]]
+        if failed:
+            raise CommandError("Scenarios with errors:\n" + "\n".join(failed))
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                regressions = compare(results, json.load(f), options["tolerance"])
+            if regressions:
+                raise CommandError("Regressions against baseline:\n" + "\n".join(regressions))
+            self.stdout.write("No regressions against baseline")
+
+    def host(self):
+        hosts = [host for host in settings.ALLOWED_HOSTS if host != "*" and not host.startswith(".")]
+        return hosts[0] if hosts else "localhost"
+
+    def client(self):
+        return Client(HTTP_HOST=self.host())
+
+    async def async_reads(self, accounts, symbols, options):
+        # The read half of the workload through /api/async/ on one event loop
+        # (async_to_sync from the main thread, so the async ORM shares its
+        # database connection, as on SQLite it must).
+        rng = random.Random(options["seed"])
+        client = HostAsyncClient(self.host())
+        steps = [("quote_async", f"/api/async/stocks/{rng.choice(symbols)}/", {}) for _ in range(options["quotes"])]
+        for _ in range(options["portfolios"]):
+            token, account_id = rng.choice(accounts)
+            steps.append((
+                "portfolio_async",
+                f"/api/async/auth/protect/{account_id}/portfolio/",
+                {"Authorization": f"Bearer {token}"},
+            ))
+        rng.shuffle(steps)
+
+        recorder = Recorder()
+        limit = asyncio.Semaphore(options["asgi_concurrency"])
+
+        async def read(scenario, path, headers):
+            async with limit:
+                await recorder.arun(scenario, lambda: self.aget(client, path, headers))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(read(*step) for step in steps))
+        return recorder.summary(time.perf_counter() - started)
+
+    async def aget(self, client, path, headers):
+        return (await client.get(path, headers=headers)).status_code == 200
+
+    def user_prefix(self):
+        return f"{PREFIX}-{self.run_id}-"
+
+    def exchange(self):
+        return f"{EXCHANGE}-{self.run_id}"
+
+    def seed(self, account_count, symbol_count):
+        password = make_password(None)
+        prefix = self.user_prefix()
+        CustomUser.objects.bulk_create([
+            CustomUser(username=f"{prefix}{i}", email=f"{prefix}{i}@example.com", password=password)
+            for i in range(account_count)
+        ], batch_size=1000)
+        users = list(CustomUser.objects.filter(username__startswith=prefix).order_by("id"))
+        Account.objects.bulk_create(
+            [Account(user=user, balance=Decimal("1000000.00")) for user in users], batch_size=1000,
+        )
+        rng = random.Random(0)
+        stocks = Stock.objects.bulk_create([
+            # Symbols are at most 10 characters: a clash with an existing one
+            # fails the run, and cleanup goes by this run's exchange anyway.
+            Stock(symbol=f"B{self.run_id[:4]}{i}", name=f"Benchmark {i}", exchange=self.exchange(),
+                  price=Decimal(rng.randint(1000, 50000)) / 100)
+            for i in range(symbol_count)
+        ], batch_size=1000)
+        set_quotes(stocks)
+        accounts = dict(Account.objects.filter(user__in=users).values_list("user_id", "id"))
+        self.account_ids = list(accounts.values())
+        tokens = [(str(AccessToken.for_user(user)), accounts[user.id]) for user in users]
+        return tokens, [stock.symbol for stock in stocks]
+
+    def plan(self, accounts, symbols, options):
+        # The same seed always gives the same interleaving of calls.
+        rng = random.Random(options["seed"])
+        steps = []
+        for _ in range(options["trades"]):
+            body = {
+                "symbol": rng.choice(symbols),
+                "quantity": str(rng.randint(1, 10)),
+                "trade_type": "buy" if rng.random() < 0.7 else "sell",
+            }
+            headers = {"HTTP_AUTHORIZATION": f"Bearer {rng.choice(accounts)[0]}"}
+            steps.append(("trade", lambda c, body=body, headers=headers: traded(c.post(
+                "/api/trade/", body, content_type="application/json", **headers,
+            ))))
+        for _ in range(options["quotes"]):
+            symbol = rng.choice(symbols)
+            steps.append(("quote", lambda c, symbol=symbol: c.get(f"/api/stocks/{symbol}/").status_code == 200))
+        for _ in range(options["portfolios"]):
+            token, account_id = rng.choice(accounts)
+            steps.append(("portfolio", lambda c, token=token, account_id=account_id: c.get(
+                f"/api/auth/protect/{account_id}/portfolio/", HTTP_AUTHORIZATION=f"Bearer {token}",
+            ).status_code == 200))
+        steps.extend(("report", lambda c: self.report()) for _ in range(options["reports"]))
+        rng.shuffle(steps)
+        return steps
+
+    def report(self):
+        # What write_trade_report does for today, over this run's trades only
+        # and without touching the real report file.
+        today = timezone.localdate()
+        with open(os.devnull, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(REPORT_HEADER)
+            writer.writerows(report_rows(today, today, account_ids=self.account_ids))
+        return True
+
+    def cleanup(self):
+        # This run's rows only. Accounts, orders, trades and the rest cascade
+        # from the users.
+        CustomUser.objects.filter(username__startswith=self.user_prefix()).delete()
+        stocks = Stock.objects.filter(exchange=self.exchange())
+        symbols = list(stocks.values_list("symbol", flat=True))
+        if symbols:
+            stocks.delete()
+            cache.delete_many([quote_key(symbol) for symbol in symbols])
+            publish_invalidation(symbols)
@@ -0,0 +1,77 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from accounts.api.journal import (
+    incomplete_accounts, journaled_accounts, rebase, reconcile, snapshot_accounts,
+)
+
+
+def _reconcile_chunk(args):
+    account_ids, repair = args
+    return reconcile(account_ids, repair=repair)
+
+
+def _close_connections():
+    # Forked workers must not share the parent's database sockets.
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Rebuild balances and positions from the trade journal and compare them with the live rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=1, help="Processes replaying chunks of accounts in parallel.")
+        parser.add_argument("--chunk-size", type=int, default=settings.JOURNAL_CHUNK_SIZE)
+        parser.add_argument("--account", type=int, action="append", help="Only these account ids (repeatable).")
+        parser.add_argument("--repair", action="store_true", help="Rewrite mismatching rows from the journal.")
+        parser.add_argument(
+            "--rebase", action="store_true",
+            help="Restart the journal of accounts with incomplete snapshots from their live rows.",
+        )
+        parser.add_argument("--snapshot", action="store_true", help="Take fresh snapshots after replaying.")
+        parser.add_argument("--limit", type=int, default=50, help="Mismatches to print.")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        account_ids = options["account"] or list(journaled_accounts())
+        size = options["chunk_size"]
+        incomplete = incomplete_accounts(account_ids)
+        if incomplete and options["rebase"]:
+            self.stdout.write(f"Rebased {rebase(incomplete, size)} accounts on their live rows")
+        elif incomplete and options["repair"]:
+            # Their snapshots may be missing events, so the journal cannot be
+            # trusted over the live rows.
+            raise CommandError(
+                f"{len(incomplete)} accounts have snapshots that may be missing events "
+                f"(first: {incomplete[:10]}); refusing to repair. Check them, then run with --rebase."
+            )
+        chunks = [(account_ids[i:i + size], options["repair"]) for i in range(0, len(account_ids), size)]
+
+        if options["workers"] > 1 and len(chunks) > 1:
+            _close_connections()
+            with ProcessPoolExecutor(
+                max_workers=options["workers"],
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_close_connections,
+            ) as pool:
+                results = list(pool.map(_reconcile_chunk, chunks))
+        else:
+            results = [_reconcile_chunk(chunk) for chunk in chunks]
+
+        checked = sum(count for count, _ in results)
+        mismatches = [m for _, found in results for m in found]
+        for mismatch in mismatches[:options["limit"]]:
+            self.stdout.write(
+                f"account {mismatch['account_id']} {mismatch['field']}: journal={mismatch['journal']} live={mismatch['live']}"
+            )
+        verb = "repaired" if options["repair"] else "found"
+        self.stdout.write(
+            f"Replayed {checked} accounts in {time.monotonic() - started:.1f}s, {verb} {len(mismatches)} mismatches"
+        )
+
+        if options["snapshot"]:
+            self.stdout.write(f"Snapshotted {snapshot_accounts()} accounts")
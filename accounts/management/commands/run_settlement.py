@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from accounts.api import settlement
+
+
+class Command(BaseCommand):
+    help = "Drain one shard of queued trade orders and settle them in micro-batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shard", type=int, default=0)
+        parser.add_argument("--batch-size", type=int, default=settings.SETTLEMENT_BATCH_SIZE)
+        parser.add_argument("--interval", type=float, default=settings.SETTLEMENT_BATCH_INTERVAL)
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"Settling shard {options['shard']}: up to {options['batch_size']} orders every {options['interval']}s"
+        )
+        settlement.run(options["shard"], options["batch_size"], options["interval"])
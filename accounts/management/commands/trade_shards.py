@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from accounts.models import Account
+from accounts.api.routing import all_queues, shard_for
+
+
+class Command(BaseCommand):
+    help = "Show the trade queues for a shard count and which accounts move when it changes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=settings.TRADE_SHARD_COUNT)
+        parser.add_argument("--previous", type=int, help="Shard count currently in use, to plan a rebalance.")
+
+    def handle(self, *args, **options):
+        count, previous = options["count"], options["previous"]
+        self.stdout.write(f"Worker queues: -Q {','.join(all_queues(count))}")
+        if not previous or previous == count:
+            return
+
+        moved = {}
+        total = 0
+        for user_id in Account.objects.values_list("user_id", flat=True).iterator():
+            total += 1
+            old, new = shard_for(user_id, previous), shard_for(user_id, count)
+            if old != new:
+                moved[(old, new)] = moved.get((old, new), 0) + 1
+
+        self.stdout.write(f"{sum(moved.values())} of {total} accounts change shard going from {previous} to {count}:")
+        for (old, new), n in sorted(moved.items()):
+            self.stdout.write(f"  {settings.TRADE_QUEUE_PREFIX}.{old} -> {settings.TRADE_QUEUE_PREFIX}.{new}: {n}")
+        self.stdout.write(
+            "Start workers for the new queues, switch TRADE_SHARD_COUNT, and stop workers "
+            "for removed queues only once those queues are empty."
+        )
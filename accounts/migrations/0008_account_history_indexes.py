@@ -0,0 +1,21 @@
+# Generated by Django 5.2.6 on 2026-10-18 16:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_trade'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ledger',
+            index=models.Index(fields=['account', 'timestamp', 'id'], name='ledger_account_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='position',
+            index=models.Index(fields=['account', 'created_at', 'id'], name='position_account_created_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.6 on 2026-10-18 16:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_account_history_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortfolioSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.DecimalField(decimal_places=2, default=0.0, max_digits=12)),
+                ('market_value', models.DecimalField(decimal_places=2, default=0.0, max_digits=14)),
+                ('equity', models.DecimalField(decimal_places=2, default=0.0, max_digits=14)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='position',
+            index=models.Index(fields=['symbol', 'account'], name='position_symbol_account_idx'),
+        ),
+        migrations.AddField(
+            model_name='portfoliosnapshot',
+            name='account',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='portfolio', to='accounts.account'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.6 on 2026-10-18 17:04
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def seed_cost_basis(apps, schema_editor):
+    # Average price was the last fill price, so this is only an estimate for
+    # positions opened before cost tracking.
+    Position = apps.get_model("accounts", "Position")
+    Position.objects.update(cost_basis=models.F("quantity") * models.F("average_price"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_price_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='portfoliosnapshot',
+            name='realized_pnl',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='portfoliosnapshot',
+            name='unrealized_pnl',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='position',
+            name='cost_basis',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='position',
+            name='realized_pnl',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=14),
+        ),
+        migrations.AddField(
+            model_name='trade',
+            name='realized_pnl',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=14),
+        ),
+        migrations.CreateModel(
+            name='PositionLot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('cost', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('position', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lots', to='accounts.position')),
+            ],
+        ),
+        migrations.RunPython(seed_cost_basis, migrations.RunPython.noop),
+    ]
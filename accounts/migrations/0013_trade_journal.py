@@ -0,0 +1,48 @@
+# Generated by Django 5.2.6 on 2026-10-18 17:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0012_position_accounting'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.BigIntegerField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('positions', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='accounts.account')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['account', 'event_id'], name='snapshot_account_event_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TradeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order_id', models.BigIntegerField(blank=True, null=True)),
+                ('symbol', models.CharField(max_length=10)),
+                ('transaction_type', models.CharField(choices=[('buy', 'Buy'), ('sell', 'Sell')], max_length=4)),
+                ('quantity', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('cash_delta', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('quantity_delta', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('cost_delta', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('pnl_delta', models.DecimalField(decimal_places=2, max_digits=14)),
+                ('timestamp', models.DateTimeField()),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='accounts.account')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['account', 'id'], name='tradeevent_account_id_idx')],
+            },
+        ),
+    ]
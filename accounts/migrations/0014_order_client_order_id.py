@@ -0,0 +1,22 @@
+# Generated by Django 5.2.6 on 2026-10-18 17:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0013_trade_journal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='client_order_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(fields=('account', 'client_order_id'), name='order_account_client_id_uniq'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import migrations, models
+
+
+def merge_duplicate_positions(apps, schema_editor):
+    # Racing buys could open two rows for one (account, symbol). Fold the later
+    # rows (and their FIFO lots) into the lowest id, which settlement treats as
+    # the position, so the unique constraint can be added.
+    Position = apps.get_model("accounts", "Position")
+    PositionLot = apps.get_model("accounts", "PositionLot")
+    groups = list(
+        Position.objects.values("account_id", "symbol").annotate(rows=models.Count("id")).filter(rows__gt=1)
+    )
+    for group in groups:
+        keep, *extra = Position.objects.filter(account_id=group["account_id"], symbol=group["symbol"]).order_by("id")
+        for position in extra:
+            keep.quantity += position.quantity
+            keep.cost_basis += position.cost_basis
+            keep.realized_pnl += position.realized_pnl
+        if keep.quantity > 0:
+            keep.average_price = (keep.cost_basis / keep.quantity).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+        else:
+            keep.average_price = Decimal("0.00")
+        keep.save(update_fields=["quantity", "average_price", "cost_basis", "realized_pnl"])
+        PositionLot.objects.filter(position__in=extra).update(position=keep)
+        Position.objects.filter(id__in=[position.id for position in extra]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0014_order_client_order_id'),
+    ]
+
+    operations = [
+        # Its own migration (and transaction): Postgres will not alter a table
+        # with deferred constraint checks still pending from these deletes.
+        migrations.RunPython(merge_duplicate_positions, migrations.RunPython.noop),
+    ]
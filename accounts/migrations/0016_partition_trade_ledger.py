@@ -0,0 +1,92 @@
+from datetime import date
+
+from django.db import migrations
+from django.utils import timezone
+
+# On Postgres, Trade and Ledger become tables range-partitioned by month on
+# "timestamp", plus a default partition for rows outside the months created.
+# Postgres wants the partition key in the primary key, so it becomes
+# (id, timestamp) in the database; ids still come from one sequence, so the
+# models keep id as their primary key. Existing indexes and foreign keys are
+# recreated on the partitioned table. accounts.api.partitions adds months from
+# here on. Other databases are left as they are.
+#
+# The rows are copied in one transaction: on a large table, run this in a
+# maintenance window.
+
+TABLES = ("accounts_trade", "accounts_ledger")
+MONTHS_AHEAD = 3
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def bound(month):
+    return f"{month.isoformat()} 00:00:00+00"
+
+
+def partition_table(cursor, table):
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass", [table])
+    if cursor.fetchone():
+        return
+    cursor.execute(
+        "SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s "
+        "AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass)",
+        [table, table],
+    )
+    indexes = [row[0] for row in cursor.fetchall()]
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+        [table],
+    )
+    foreign_keys = cursor.fetchall()
+    cursor.execute(f'SELECT min("timestamp"), max("timestamp") FROM {table}')
+    first, last = cursor.fetchone()
+
+    old = f"{table}_unpartitioned"
+    cursor.execute(f"ALTER TABLE {table} RENAME TO {old}")
+    cursor.execute(f'CREATE TABLE {table} (LIKE {old}) PARTITION BY RANGE ("timestamp")')
+    cursor.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+    this_month = timezone.now().date().replace(day=1)
+    month = min(first.date(), this_month).replace(day=1) if first else this_month
+    end = add_months(max(last.date().replace(day=1), this_month) if last else this_month, MONTHS_AHEAD)
+    while month <= end:
+        cursor.execute(
+            f"CREATE TABLE {table}_{month:%Y_%m} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{bound(month)}') TO ('{bound(add_months(month, 1))}')"
+        )
+        month = add_months(month, 1)
+
+    cursor.execute(f"INSERT INTO {table} SELECT * FROM {old}")
+    # Takes the old identity sequence with it.
+    cursor.execute(f"DROP TABLE {old}")
+    cursor.execute(f"CREATE SEQUENCE {table}_id_seq OWNED BY {table}.id")
+    cursor.execute(f"SELECT setval('{table}_id_seq', COALESCE(MAX(id), 0) + 1, false) FROM {table}")
+    cursor.execute(f"ALTER TABLE {table} ALTER COLUMN id SET DEFAULT nextval('{table}_id_seq')")
+    cursor.execute(f'ALTER TABLE {table} ADD PRIMARY KEY (id, "timestamp")')
+    for definition in indexes:
+        cursor.execute(definition)
+    for name, definition in foreign_keys:
+        cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+
+
+def partition_tables(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table in TABLES:
+            partition_table(cursor, table)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0015_merge_duplicate_positions'),
+    ]
+
+    operations = [
+        # Not undone: the models work the same on partitioned tables.
+        migrations.RunPython(partition_tables, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+# Periodic snapshots used to be taken at the highest committed event id
+# without locking the accounts, so an event still in flight below that id
+# could be left out of them for good. Starting snapshots (event 0) were taken
+# under the account lock and are kept as complete.
+
+
+def mark_incomplete(apps, schema_editor):
+    AccountSnapshot = apps.get_model("accounts", "AccountSnapshot")
+    AccountSnapshot.objects.filter(event_id__gt=0).update(complete=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0017_trade_indexes_position_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountsnapshot',
+            name='complete',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.RunPython(mark_incomplete, migrations.RunPython.noop),
+    ]
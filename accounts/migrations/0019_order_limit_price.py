@@ -0,0 +1,32 @@
+# Generated by Django 5.2.6 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0018_accountsnapshot_complete'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='filled_quantity',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='limit_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('accepted', 'Accepted'), ('filled', 'Filled'), ('rejected', 'Rejected'), ('cancelled', 'Cancelled')], default='accepted', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('limit_price__isnull', False), ('status', 'accepted')), fields=['account'], name='order_open_limit_idx'),
+        ),
+    ]
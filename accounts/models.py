@@ -21,17 +21,49 @@ class Position(models.Model):
     symbol = models.CharField(max_length=10)
     quantity = models.DecimalField(max_digits=12, decimal_places=2)
     average_price = models.DecimalField(max_digits=12, decimal_places=2)
+    # Cost of the shares still held and profit booked by sells, maintained on
+    # every fill by accounts.api.settlement.PositionChanges. A position sold
+    # down to zero is kept (quantity 0) so its realized P&L is not lost.
+    cost_basis = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+    realized_pnl = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["account", "created_at", "id"], name="position_account_created_idx"),
+            # Symbol-to-holders lookup for revaluing portfolios when a price moves.
+            models.Index(fields=["symbol", "account"], name="position_symbol_account_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["account", "symbol"], name="position_account_symbol_uniq"),
+        ]
+
     def __str__(self):
         return f"{self.symbol} - {self.quantity} @ {self.average_price}"
 
+class PositionLot(models.Model):
+    # Open buy lots of a position, oldest first; only kept when
+    # POSITION_COST_METHOD is "fifo".
+    position = models.ForeignKey(Position, on_delete=models.CASCADE, related_name="lots")
+    quantity = models.DecimalField(max_digits=12, decimal_places=2)
+    cost = models.DecimalField(max_digits=14, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.position.symbol} lot {self.quantity} for {self.cost}"
+
 class Ledger(models.Model):
     account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name="ledger")
     transaction_type = models.CharField(max_length=10, choices = [("deposit","deposit"), ("withdraw", "withdraw")])
     amount = models.DecimalField(max_digits=12, decimal_places=2)
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # Partitioned by month on timestamp on Postgres, like Trade.
+        indexes = [
+            models.Index(fields=["account", "timestamp", "id"], name="ledger_account_ts_idx"),
+        ]
+
     def __str__(self):
         return f"{self.amount} {self.transaction_type} on {self.timestamp}"
     
@@ -52,4 +84,159 @@ class Trade(models.Model):
     transaction_type = models.CharField(max_length=4, choices=[("buy", "Buy"), ("sell", "Sell")])
     price = models.DecimalField(max_digits=10, decimal_places=2)
     quantity = models.DecimalField(max_digits=10, decimal_places=2)
-    timestamp = models.DateTimeField()    
\ No newline at end of file
+    # Profit booked by a sell against the position's cost; 0 for buys.
+    realized_pnl = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        # On Postgres the table is partitioned by month on timestamp (see
+        # accounts.api.partitions), so each of these is one index per month.
+        indexes = [
+            models.Index(fields=["account", "timestamp"], name="trade_account_ts_idx"),
+            models.Index(fields=["symbol", "timestamp"], name="trade_symbol_ts_idx"),
+            models.Index(fields=["timestamp"], name="trade_ts_idx"),
+        ]
+
+
+class Order(models.Model):
+    ACCEPTED = "accepted"
+    FILLED = "filled"
+    REJECTED = "rejected"
+    CANCELLED = "cancelled"
+
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name="orders")
+    symbol = models.CharField(max_length=10)
+    transaction_type = models.CharField(max_length=4, choices=[("buy", "Buy"), ("sell", "Sell")])
+    quantity = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(
+        max_length=10,
+        choices=[(ACCEPTED, "Accepted"), (FILLED, "Filled"), (REJECTED, "Rejected"), (CANCELLED, "Cancelled")],
+        default=ACCEPTED,
+    )
+    # Average fill price.
+    price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    # Set for limit orders, which rest on the book until filled or cancelled;
+    # while ACCEPTED, quantity - filled_quantity of them is still open.
+    limit_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    filled_quantity = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    reason = models.CharField(max_length=100, blank=True)
+    # Client-chosen id (or Idempotency-Key header) that makes resubmission safe.
+    client_order_id = models.CharField(max_length=64, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["account", "client_order_id"], name="order_account_client_id_uniq"),
+        ]
+        indexes = [
+            # Open book orders: rebuilding the book, and the cash and shares they reserve.
+            models.Index(
+                fields=["account"], name="order_open_limit_idx",
+                condition=models.Q(status="accepted", limit_price__isnull=False),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.transaction_type} {self.quantity} {self.symbol} ({self.status})"
+
+
+class TradeEvent(models.Model):
+    # Append-only journal of every fill, written in the same transaction as
+    # the balance and position changes it describes. The *_delta columns are
+    # the exact changes applied, so replaying them reproduces the rows.
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name="events")
+    order_id = models.BigIntegerField(null=True, blank=True)
+    symbol = models.CharField(max_length=10)
+    transaction_type = models.CharField(max_length=4, choices=[("buy", "Buy"), ("sell", "Sell")])
+    quantity = models.DecimalField(max_digits=10, decimal_places=2)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    cash_delta = models.DecimalField(max_digits=14, decimal_places=2)
+    quantity_delta = models.DecimalField(max_digits=12, decimal_places=2)
+    cost_delta = models.DecimalField(max_digits=14, decimal_places=2)
+    pnl_delta = models.DecimalField(max_digits=14, decimal_places=2)
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["account", "id"], name="tradeevent_account_id_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.transaction_type} {self.quantity} {self.symbol} for {self.account_id}"
+
+
+class AccountSnapshot(models.Model):
+    # Account state after applying every TradeEvent with id <= event_id.
+    # positions: {symbol: [quantity, cost_basis, realized_pnl]} as strings.
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name="snapshots")
+    event_id = models.BigIntegerField()
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+    positions = models.JSONField(default=dict)
+    # False when events up to event_id may have been missed: snapshots taken
+    # before snapshotting locked the accounts, and every one built on them.
+    complete = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["account", "event_id"], name="snapshot_account_event_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.account_id} at event {self.event_id}"
+
+
+class PortfolioSnapshot(models.Model):
+    # Materialized valuation, refreshed by accounts.api.portfolio whenever a
+    # fill or a price move touches the account.
+    account = models.OneToOneField(Account, on_delete=models.CASCADE, related_name="portfolio")
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
+    market_value = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+    equity = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+    realized_pnl = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+    unrealized_pnl = models.DecimalField(max_digits=14, decimal_places=2, default=0.00)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.account} equity {self.equity}"
+
+
+class PriceTick(models.Model):
+    # Append-only: every price ingestion writes one row per symbol fetched.
+    symbol = models.CharField(max_length=10)
+    price = models.DecimalField(max_digits=12, decimal_places=2)
+    volume = models.BigIntegerField(default=0)
+    timestamp = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["symbol", "timestamp"], name="pricetick_symbol_ts_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.symbol} @ {self.price} on {self.timestamp}"
+
+
+class PriceBar(models.Model):
+    # OHLCV rolled up from PriceTick by accounts.api.bars as ticks arrive.
+    INTERVALS = [("1m", "1 minute"), ("5m", "5 minutes"), ("1h", "1 hour"), ("1d", "1 day")]
+
+    symbol = models.CharField(max_length=10)
+    interval = models.CharField(max_length=3, choices=INTERVALS)
+    start = models.DateTimeField()
+    open = models.DecimalField(max_digits=12, decimal_places=2)
+    high = models.DecimalField(max_digits=12, decimal_places=2)
+    low = models.DecimalField(max_digits=12, decimal_places=2)
+    close = models.DecimalField(max_digits=12, decimal_places=2)
+    volume = models.BigIntegerField(default=0)
+    ticks = models.IntegerField(default=0)
+    closed_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["symbol", "interval", "start"], name="pricebar_symbol_interval_start_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.symbol} {self.interval} {self.start}"
@@ -1,3 +1,1336 @@
-from django.test import TestCase
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from importlib.util import find_spec
+from unittest import mock, skipIf, skipUnless
+import asyncio
+import contextlib
+import csv
+import gzip
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import warnings
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from accounts.models import (
+    Account, AccountSnapshot, CustomUser, Ledger, Order, PortfolioSnapshot, Position, PriceBar, PriceTick,
+    Stock, Trade,
+)
+from accounts.api import exports, fastjson, journal, metrics, partitions, price_cache, streaming
+from accounts.api.bars import record_ticks
+from accounts.api.ingest import JSON_CHUNK, JSONArrayStreamParser
+from accounts.api.matching import MatchingEngine, to_units
+from accounts.api.orders import PENDING, dedup_key, place_order
+from accounts.api.price_cache import (
+    LocalQuoteCache, aget_quote, get_quote, get_quotes, local_quotes, quote_key, set_quotes, to_quote,
+)
+from accounts.api.prices import FakePriceSource, PriceSource, ingest_prices
+from accounts.api.reports import REPORT_HEADER, write_trade_report
+from accounts.api.risk import RiskRejected, buying_power_key, reconcile, reserve
+from accounts.api.routing import all_queues, jump_hash, route_task
+from accounts.api.serializers import AccountSerializer, LedgerSerializer, PositionSerializer, StockSerializer
+from accounts.api.settlement import settle_batch, settle_orders
+from core import db_router
+
+PRICES = {"AAPL": "101.37", "TSLA": "13.11", "GOOG": "7.55"}
+
+
+class SettlementTestCase(TestCase):
+    # Each test gets groups of identical accounts, so the same orders can be
+    # settled different ways and the results compared side by side.
+
+    def setUp(self):
+        cache.clear()
+        for symbol, price in PRICES.items():
+            Stock.objects.create(symbol=symbol, name=symbol, exchange="NASDAQ", price=Decimal(price))
+        set_quotes(Stock.objects.all())
+
+    def make_users(self, group, count=5, balance="1000.00"):
+        users = []
+        for i in range(count):
+            user = CustomUser.objects.create_user(f"{group}{i}", f"{group}{i}@example.com")
+            Account.objects.create(user=user, balance=Decimal(balance))
+            users.append(user)
+        return users
+
+    def random_orders(self, count, seed=1):
+        # Indexes into a user group, including orders that must be rejected.
+        rng = random.Random(seed)
+        return [{
+            "user": rng.randrange(5),
+            "symbol": rng.choice(list(PRICES) + ["NOPE"]),
+            "quantity": rng.choice(["1", "2.4", "0.33", "3", "12"]),
+            "trade_type": rng.choice(["buy", "buy", "sell"]),
+        } for _ in range(count)]
+
+    def queue(self, orders, users):
+        # The order dicts the settler takes off the queue, with their Order rows.
+        queued = []
+        for order in orders:
+            user = users[order["user"]]
+            record = Order.objects.create(
+                account=user.account, symbol=order["symbol"], transaction_type=order["trade_type"],
+                quantity=Decimal(order["quantity"]),
+            )
+            queued.append({
+                "order_id": record.id, "user_id": user.id, "symbol": order["symbol"],
+                "quantity": order["quantity"], "trade_type": order["trade_type"],
+            })
+        return queued
+
+    def settle(self, user, symbol, quantity, trade_type):
+        # Queue and settle a single order, returning the result and its Order row.
+        queued = self.queue([{"user": 0, "symbol": symbol, "quantity": quantity, "trade_type": trade_type}], [user])
+        result = settle_orders(queued)[0]
+        return result, Order.objects.get(id=queued[0]["order_id"])
+
+    def state(self, users):
+        # Everything settlement writes, keyed by the user's place in its group.
+        index = {user.id: i for i, user in enumerate(users)}
+        accounts = Account.objects.filter(user__in=users)
+        return {
+            "balances": sorted((index[a.user_id], a.balance) for a in accounts),
+            "positions": sorted(
+                (index[p.account.user_id], p.symbol, p.quantity, p.average_price, p.cost_basis, p.realized_pnl)
+                for p in Position.objects.filter(account__in=accounts).select_related("account")
+            ),
+            "ledger": sorted(
+                (index[l.account.user_id], l.transaction_type, l.amount)
+                for l in Ledger.objects.filter(account__in=accounts).select_related("account")
+            ),
+            "trades": sorted(
+                (index[t.account.user_id], t.symbol, t.transaction_type, t.price, t.quantity, t.realized_pnl)
+                for t in Trade.objects.filter(account__in=accounts).select_related("account")
+            ),
+            "orders": [
+                (o.status, o.price, o.reason)
+                for o in Order.objects.filter(account__in=accounts).order_by("id")
+            ],
+        }
+
+
+class BatchSettlementTests(SettlementTestCase):
+
+    def test_batch_matches_one_order_at_a_time(self):
+        orders = self.random_orders(200)
+        batched, single = self.make_users("batch"), self.make_users("single")
+
+        batch_results = settle_batch(self.queue(orders, batched))
+        single_results = []
+        for order in self.queue(orders, single):
+            single_results.extend(settle_orders([order]))
+
+        self.assertEqual(batch_results, single_results)
+        self.assertEqual(self.state(batched), self.state(single))
+        self.assertTrue(any(r and "message" in r for r in batch_results))
+        self.assertTrue(any(r and "error" in r for r in batch_results))
+
+    def test_requeued_orders_do_not_settle_twice(self):
+        users = self.make_users("requeue")
+        queued = self.queue([{"user": 0, "symbol": "AAPL", "quantity": "2", "trade_type": "buy"}], users)
+        settle_batch(queued)
+        before = self.state(users)
+
+        # What a restarted settler does with a batch it had already committed.
+        self.assertEqual(settle_batch(queued), [{"message": "buy order executed successfully"}])
+        self.assertEqual(self.state(users), before)
+
+
+class RejectionTests(SettlementTestCase):
+
+    def test_insufficient_balance(self):
+        user = self.make_users("poor", count=1, balance="100.00")[0]
+        result, order = self.settle(user, "AAPL", "1", "buy")
+        self.assertEqual(result, {"error": "Insufficient balance."})
+        self.assertEqual((order.status, order.reason), (Order.REJECTED, "Insufficient balance."))
+        self.assertEqual(Account.objects.get(user=user).balance, Decimal("100.00"))
+
+    def test_not_enough_stock(self):
+        user = self.make_users("seller", count=1)[0]
+        self.settle(user, "TSLA", "2", "buy")
+        result, order = self.settle(user, "TSLA", "3", "sell")
+        self.assertEqual(result, {"error": "Not enough stock to sell."})
+        self.assertEqual(order.status, Order.REJECTED)
+        self.assertEqual(Position.objects.get(account=user.account, symbol="TSLA").quantity, Decimal("2.00"))
+
+    def test_unknown_stock(self):
+        user = self.make_users("lost", count=1)[0]
+        result, order = self.settle(user, "NOPE", "1", "buy")
+        self.assertIsNone(result)
+        self.assertEqual((order.status, order.reason), (Order.REJECTED, "Trade failed."))
+        self.assertFalse(Trade.objects.filter(account=user.account).exists())
+
+
+class BookFillTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.buyer, self.seller = self.make_users("book", count=2, balance="100.00")
+        settle_orders([{"user_id": self.seller.id, "symbol": "GOOG", "quantity": "10", "trade_type": "buy"}])
+
+    def open_order(self, user, side, quantity="10", price="10.00"):
+        return Order.objects.create(
+            account=user.account, symbol="GOOG", transaction_type=side,
+            quantity=Decimal(quantity), limit_price=Decimal(price),
+        )
+
+    def matched(self):
+        # The book as a restarted matching worker rebuilds it: the sell
+        # crosses the resting buy.
+        buy, sell = self.open_order(self.buyer, "buy"), self.open_order(self.seller, "sell", quantity="6")
+        engine = MatchingEngine()
+        engine.load()
+        self.assertEqual(len(engine.pending), 1)
+        return engine, buy, sell
+
+    def test_fill_is_written_to_both_orders(self):
+        engine, buy, sell = self.matched()
+        self.assertEqual(engine.flush(), 1)
+        buy.refresh_from_db()
+        sell.refresh_from_db()
+        self.assertEqual((buy.status, buy.filled_quantity, buy.price), (Order.ACCEPTED, Decimal("6.00"), Decimal("10.00")))
+        self.assertEqual((sell.status, sell.filled_quantity), (Order.FILLED, Decimal("6.00")))
+        self.assertEqual(Account.objects.get(user=self.buyer).balance, Decimal("40.00"))
+        self.assertEqual(engine.orders[buy.id].remaining, to_units("4"))
+
+    def test_fill_the_buyer_cannot_pay_is_turned_down(self):
+        engine, buy, sell = self.matched()
+        # Spent elsewhere before the fill is written.
+        Account.objects.filter(user=self.buyer).update(balance=Decimal("50.00"))
+        engine.flush()
+        buy.refresh_from_db()
+        sell.refresh_from_db()
+        self.assertEqual((buy.status, buy.reason), (Order.CANCELLED, "Insufficient balance."))
+        self.assertEqual((sell.status, sell.filled_quantity), (Order.ACCEPTED, 0))
+        self.assertEqual(Account.objects.get(user=self.buyer).balance, Decimal("50.00"))
+        # The sell is back on the book, whole.
+        self.assertNotIn(buy.id, engine.orders)
+        self.assertEqual(engine.orders[sell.id].remaining, to_units("6"))
+
+    def test_fill_of_a_cancelled_order_is_turned_down(self):
+        engine, buy, sell = self.matched()
+        Order.objects.filter(id=sell.id).update(status=Order.CANCELLED)
+        engine.flush()
+        self.assertFalse(Trade.objects.filter(symbol="GOOG", transaction_type="sell").exists())
+        self.assertEqual(engine.orders[buy.id].remaining, to_units("10"))
+        self.assertEqual(engine.reserved_cash[self.buyer.account.id], to_units("10") * to_units("10.00"))
+
+    def test_open_book_orders_hold_cash_and_shares(self):
+        user = self.make_users("holder", count=1, balance="1000.00")[0]
+        self.settle(user, "GOOG", "10", "buy")
+        Order.objects.create(account=user.account, symbol="AAPL", transaction_type="buy", quantity=Decimal("9"), limit_price=Decimal("100.00"))
+        Order.objects.create(account=user.account, symbol="GOOG", transaction_type="sell", quantity=Decimal("8"), limit_price=Decimal("9.00"))
+        # 924.50 left, 900.00 of it held by the limit buy.
+        self.assertEqual(self.settle(user, "GOOG", "4", "buy")[0], {"error": "Insufficient balance."})
+        self.assertEqual(self.settle(user, "GOOG", "3", "sell")[0], {"error": "Not enough stock to sell."})
+        self.assertIn("message", self.settle(user, "GOOG", "2", "sell")[0])
+
+    def test_settled_market_order_reads_back_filled(self):
+        result, order = self.settle(self.buyer, "GOOG", "4", "buy")
+        self.assertIn("message", result)
+        client = APIClient()
+        client.force_authenticate(self.buyer)
+        data = client.get(f"/api/orders/{order.id}/").json()
+        self.assertEqual(
+            (data["status"], data["quantity"], data["filled_quantity"], data["price"]),
+            (Order.FILLED, "4.00", "4.00", PRICES["GOOG"]),
+        )
+
+
+class OrderRequestTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_users("client", count=1)[0]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def buy(self, **headers):
+        return self.client.post("/api/trade/", {"symbol": "AAPL", "quantity": "2", "trade_type": "buy"}, format="json", headers=headers)
+
+    def test_limit_order_request_is_validated(self):
+        order = {"symbol": "AAPL", "quantity": "5", "trade_type": "buy", "limit_price": "10.00"}
+        for change, code in (
+            ({"quantity": "-5"}, 400),
+            ({"trade_type": "xx"}, 400),
+            ({"limit_price": "abc"}, 400),
+            ({"symbol": "NOPE"}, 404),
+        ):
+            response = self.client.post("/api/trade/", {**order, **change}, format="json")
+            self.assertEqual(response.status_code, code, change)
+        self.assertFalse(Order.objects.exists())
+
+    @override_settings(TRADE_SYNC_MODE=True)
+    def test_sync_mode_answers_with_the_fill(self):
+        response = self.buy()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            (response.data["status"], response.data["filled_quantity"], response.data["price"]),
+            (Order.FILLED, "2.00", PRICES["AAPL"]),
+        )
+
+    @override_settings(TRADE_SYNC_MODE=True)
+    def test_sync_mode_falls_back_to_the_queue(self):
+        # A lock wait past the budget, and anything else settlement can
+        # raise, leave the stored order to the queue instead of failing.
+        for error in (OperationalError("lock timeout"), ValueError("bad quote")):
+            with mock.patch("accounts.api.orders.settle_orders", side_effect=error):
+                response = self.buy()
+            self.assertEqual(response.status_code, 202, error)
+            self.assertEqual(Order.objects.get(id=response.data["id"]).status, Order.FILLED)
+        self.assertEqual(Position.objects.get(account=self.user.account, symbol="AAPL").quantity, Decimal("4.00"))
+
+    def test_failed_insert_releases_the_reservation(self):
+        account = self.user.account
+        reserve(account.id, "AAPL", "1", "buy")
+        before = cache.get(buying_power_key(account.id))
+        with mock.patch.object(Order.objects, "create", side_effect=IntegrityError("not null")):
+            with self.assertRaises(IntegrityError):
+                place_order(account, self.user.id, "AAPL", Decimal("2"), "buy")
+        self.assertEqual(cache.get(buying_power_key(account.id)), before)
+
+
+
+class IdempotencyTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_users("retry", count=1)[0]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def buy(self, quantity="2", key=None):
+        headers = {"Idempotency-Key": key} if key else None
+        return self.client.post(
+            "/api/trade/", {"symbol": "AAPL", "quantity": quantity, "trade_type": "buy"}, format="json", headers=headers,
+        )
+
+    def test_retry_returns_the_first_order(self):
+        first = self.buy(key="k1")
+        self.assertNotIn("Idempotent-Replayed", first.headers)
+        again = self.buy(key="k1")
+        # Past the cache entry only the unique constraint is left to catch it.
+        cache.delete(dedup_key(self.user.account.id, "k1"))
+        late = self.buy(key="k1")
+        for response in (again, late):
+            self.assertEqual(response.data["id"], first.data["id"])
+            self.assertEqual(response.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(Position.objects.get(account=self.user.account, symbol="AAPL").quantity, Decimal("2.00"))
+
+    def test_key_reused_for_another_order_is_refused(self):
+        self.buy(key="k1")
+        self.assertEqual(self.buy("3", key="k1").status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_key_still_being_placed_is_a_conflict(self):
+        cache.add(dedup_key(self.user.account.id, "k1"), PENDING)
+        self.assertEqual(self.buy(key="k1").status_code, 409)
+        self.assertFalse(Order.objects.exists())
+
+    def test_orders_without_a_key_are_not_deduplicated(self):
+        ids = {self.buy().data["id"], self.buy().data["id"]}
+        self.assertEqual(len(ids), 2)
+
+
+@skipUnless(find_spec("numpy"), "backtesting needs numpy")
+class BacktestParityTests(SettlementTestCase):
+
+    def test_backtest_matches_settle_orders(self):
+        from accounts.api import backtest
+
+        rng = random.Random(7)
+        users = self.make_users("live")
+        symbols = list(PRICES)
+        steps = [{s: Decimal(rng.randint(500, 15000)) / 100 for s in symbols} for _ in range(8)]
+        orders = [dict(order, step=rng.randrange(len(steps))) for order in self.random_orders(240, seed=7)]
+        orders.sort(key=lambda order: order["step"])
+        account_ids = [user.account.id for user in users]
+        balances, held, costs, realized = backtest.load_accounts(account_ids, symbols)
+
+        results = []
+        for step, prices in enumerate(steps):
+            for symbol, price in prices.items():
+                Stock.objects.filter(symbol=symbol).update(price=price)
+            set_quotes(Stock.objects.all())
+            results.extend(settle_orders([
+                {"user_id": users[o["user"]].id, "symbol": o["symbol"], "quantity": o["quantity"], "trade_type": o["trade_type"]}
+                for o in orders if o["step"] == step
+            ]))
+
+        # "NOPE" is a column that never has a price.
+        columns = symbols + ["NOPE"]
+        result = backtest.run_backtest(
+            [[int(prices[s] * 100) for s in symbols] + [0] for prices in steps],
+            [o["step"] for o in orders],
+            [o["user"] for o in orders],
+            [columns.index(o["symbol"]) for o in orders],
+            [backtest.BUY if o["trade_type"] == "buy" else backtest.SELL for o in orders],
+            backtest.to_hundredths([o["quantity"] for o in orders]),
+            balances,
+            [list(row) + [0] for row in held],
+            [list(row) + [0] for row in costs],
+            [list(row) + [0] for row in realized],
+        )
+
+        self.assertEqual(set(result.status), set(backtest.RESULTS))
+        expected = {
+            backtest.INSUFFICIENT_BALANCE: "Insufficient balance.",
+            backtest.NOT_ENOUGH_STOCK: "Not enough stock to sell.",
+        }
+        for status, outcome in zip(result.status, results):
+            if status == backtest.NO_PRICE:
+                self.assertIsNone(outcome)
+            elif status == backtest.FILLED:
+                self.assertIn("message", outcome)
+            else:
+                self.assertEqual(outcome, {"error": expected[status]})
+
+        accounts = {a.id: a for a in Account.objects.filter(id__in=account_ids)}
+        positions = {(p.account_id, p.symbol): p for p in Position.objects.filter(account_id__in=account_ids)}
+        for i, account_id in enumerate(account_ids):
+            self.assertEqual(result.balances[i], int(accounts[account_id].balance * 100))
+            for j, symbol in enumerate(symbols):
+                position = positions.get((account_id, symbol))
+                found = [result.quantities[i, j], result.cost_basis[i, j], result.realized_pnl[i, j], result.average_prices[i, j]]
+                if position is None:
+                    self.assertEqual(found, [0, 0, 0, 0])
+                    continue
+                self.assertEqual(found, [
+                    int(position.quantity * 100), int(position.cost_basis * 100),
+                    int(position.realized_pnl * 100), int(position.average_price * 100),
+                ])
+
+    def test_rounds_follow_orders_per_account_not_steps(self):
+        from accounts.api import backtest
+
+        # Two accounts buying every step of a long series: each account's
+        # k-th order goes in the same round, whatever its step.
+        steps = list(range(2000))
+        with self.assertLogs("trade_logger", "INFO") as logs:
+            result = backtest.run_backtest(
+                [[100]] * len(steps), steps, [step % 2 for step in steps], [0] * len(steps),
+                [backtest.BUY] * len(steps), [100] * len(steps), [1500, 150000],
+            )
+        self.assertIn("2000 orders in 1000 rounds", logs.output[-1])
+        self.assertEqual(list(result.balances), [0, 50000])
+        self.assertEqual(list(result.quantities[:, 0]), [1500, 100000])
+        self.assertEqual(int((result.status == backtest.INSUFFICIENT_BALANCE).sum()), 985)
+
+
+class CostAccountingTests(SettlementTestCase):
+
+    def trade(self, user, trade_type, quantity, price):
+        Stock.objects.filter(symbol="AAPL").update(price=Decimal(price))
+        set_quotes(Stock.objects.all())
+        return settle_orders([{"user_id": user.id, "symbol": "AAPL", "quantity": quantity, "trade_type": trade_type}])[0]
+
+    def sell_after_two_buys(self):
+        user = self.make_users("cost", count=1)[0]
+        self.trade(user, "buy", "10", "10.00")
+        self.trade(user, "buy", "10", "20.00")
+        self.assertIn("message", self.trade(user, "sell", "15", "30.00"))
+        return Position.objects.get(account=user.account, symbol="AAPL")
+
+    def test_average_cost(self):
+        position = self.sell_after_two_buys()
+        # 15 of 20 shares release 15/20 of the 300.00 basis.
+        self.assertEqual(position.quantity, Decimal("5.00"))
+        self.assertEqual(position.cost_basis, Decimal("75.00"))
+        self.assertEqual(position.average_price, Decimal("15.00"))
+        self.assertEqual(position.realized_pnl, Decimal("225.00"))
+
+    @override_settings(POSITION_COST_METHOD="fifo")
+    def test_fifo_cost(self):
+        position = self.sell_after_two_buys()
+        # The first lot (10 @ 10.00) closes, then 5 of the second (@ 20.00).
+        self.assertEqual(position.quantity, Decimal("5.00"))
+        self.assertEqual(position.cost_basis, Decimal("100.00"))
+        self.assertEqual(position.average_price, Decimal("20.00"))
+        self.assertEqual(position.realized_pnl, Decimal("250.00"))
+        self.assertEqual(list(position.lots.values_list("quantity", "cost")), [(Decimal("5.00"), Decimal("100.00"))])
+
+    @override_settings(POSITION_COST_METHOD="fifo")
+    def test_closed_position_keeps_realized_pnl(self):
+        user = self.make_users("closed", count=1)[0]
+        self.trade(user, "buy", "4", "10.00")
+        self.trade(user, "sell", "4", "12.50")
+        position = Position.objects.get(account=user.account, symbol="AAPL")
+        self.assertEqual((position.quantity, position.cost_basis, position.realized_pnl), (0, 0, Decimal("10.00")))
+        self.assertFalse(position.lots.exists())
+
+
+class RiskCheckTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_users("risk", count=1, balance="100.00")[0]
+        self.account = self.user.account
+
+    def place(self, symbol, quantity, trade_type, limit_price=None):
+        return place_order(self.account, self.user.id, symbol, Decimal(quantity), trade_type, limit_price=limit_price)
+
+    def test_orders_that_would_fail_are_not_placed(self):
+        # 101.37 a share against a 100.00 balance.
+        for symbol, quantity, trade_type, error in (
+            ("AAPL", "1", "buy", "Insufficient balance."),
+            ("TSLA", "1", "sell", "Not enough stock to sell."),
+            ("NOPE", "1", "buy", "Stock not found."),
+        ):
+            with self.assertRaisesMessage(RiskRejected, error):
+                self.place(symbol, quantity, trade_type)
+        self.assertFalse(Order.objects.exists())
+
+    @override_settings(TRADE_SETTLEMENT_MODE="batch")
+    def test_queued_orders_hold_buying_power(self):
+        # Queued for a settler that is not running: the first buy holds 78.66
+        # of the 100.00, so the second does not fit until it settles.
+        with mock.patch("accounts.api.orders.enqueue_order"):
+            self.place("TSLA", "6", "buy")
+            with self.assertRaisesMessage(RiskRejected, "Insufficient balance."):
+                self.place("TSLA", "2", "buy")
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_limit_orders_hold_their_limit_price(self):
+        self.place("GOOG", "9", "buy", limit_price=Decimal("10.00"))
+        with self.assertRaisesMessage(RiskRejected, "Insufficient balance."):
+            self.place("GOOG", "2", "buy")
+        # Cancelling it and rebuilding the state frees the 90.00 again.
+        Order.objects.filter(account=self.account).update(status=Order.CANCELLED)
+        reconcile([self.account.id], ["GOOG"])
+        order = self.place("GOOG", "2", "buy")[0]
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.FILLED)
+
+    @override_settings(RISK_MAX_ORDERS_PER_WINDOW=2, RISK_RATE_WINDOW=60)
+    def test_order_rate_is_limited(self):
+        self.place("GOOG", "1", "buy")
+        self.place("GOOG", "1", "buy")
+        with self.assertRaises(RiskRejected) as caught:
+            self.place("GOOG", "1", "buy")
+        self.assertEqual(caught.exception.status, 429)
+
+    @override_settings(RISK_MAX_SYMBOL_EXPOSURE=50)
+    def test_symbol_exposure_is_limited(self):
+        self.place("GOOG", "6", "buy")
+        with self.assertRaisesMessage(RiskRejected, "GOOG exposure past 50"):
+            self.place("GOOG", "1", "buy")
+
+
+class ShardRoutingTests(SimpleTestCase):
+
+    def test_shards_do_not_change_between_releases(self):
+        # Queued orders must keep landing on the same settler.
+        self.assertEqual([jump_hash(key, 4) for key in range(12)], [0, 0, 3, 3, 1, 1, 2, 0, 0, 2, 2, 2])
+        self.assertEqual([jump_hash(key, 1000) for key in (1, 42, 2**40, 2**64 - 1)], [549, 571, 145, 313])
+
+    def test_adding_a_shard_only_moves_accounts_onto_it(self):
+        for count in range(1, 16):
+            moved = [key for key in range(10000) if jump_hash(key, count) != jump_hash(key, count + 1)]
+            self.assertEqual({jump_hash(key, count + 1) for key in moved}, {count})
+            self.assertAlmostEqual(len(moved) / 10000, 1 / (count + 1), delta=0.02)
+
+    @override_settings(TRADE_SHARD_COUNT=8, TRADE_QUEUE_PREFIX="trades")
+    def test_trades_are_routed_by_user(self):
+        for user_id in range(50):
+            route = route_task("accounts.api.tasks.process_trade", (user_id, "AAPL", "1", "buy"), {}, {})
+            self.assertEqual(route, {"queue": f"trades.{jump_hash(user_id, 8)}"})
+        self.assertEqual(route_task("accounts.api.tasks.process_trade", (), {"user_id": 3}, {}), {"queue": "trades.3"})
+        self.assertIsNone(route_task("accounts.api.tasks.submit_order", (3,), {}, {}))
+        self.assertEqual(all_queues(), [f"trades.{shard}" for shard in range(8)])
+
+
+class PriceIngestTests(SettlementTestCase):
+
+    def test_prices_are_fetched_concurrently(self):
+        # Each fetch waits for the other two: fetched one after another they
+        # would all time out on the barrier.
+        barrier = threading.Barrier(3, timeout=5)
+
+        class Source(PriceSource):
+            def fetch(self, symbol):
+                barrier.wait()
+                return {"AAPL": 120.004, "TSLA": 14, "GOOG": "7.555"}[symbol]
+
+        report = ingest_prices(Source(), workers=3, timeout=10)
+        self.assertEqual((report["symbols"], report["updated"], report["failed"]), (3, 3, {}))
+        self.assertEqual(set(report["latency_ms"]), set(PRICES))
+        self.assertEqual(
+            dict(Stock.objects.values_list("symbol", "price")),
+            {"AAPL": Decimal("120.00"), "TSLA": Decimal("14.00"), "GOOG": Decimal("7.56")},
+        )
+        self.assertEqual(get_quote("AAPL")["price"], "120.00")
+
+    def test_failed_and_slow_symbols_are_reported(self):
+        release = threading.Event()
+
+        class Source(FakePriceSource):
+            def fetch(self, symbol):
+                if symbol == "GOOG":
+                    release.wait(5)
+                return super().fetch(symbol)
+
+        try:
+            report = ingest_prices(Source({"AAPL": 99.5}, failures={"TSLA"}), workers=3, timeout=0.5)
+        finally:
+            release.set()
+        self.assertEqual(report["failed"], {"TSLA": "no data for TSLA", "GOOG": "timed out"})
+        self.assertEqual(set(report["latency_ms"]), {"AAPL", "TSLA"})
+        self.assertEqual(report["updated"], 1)
+        self.assertEqual(Stock.objects.get(symbol="AAPL").price, Decimal("99.50"))
+        self.assertEqual(Stock.objects.get(symbol="GOOG").price, Decimal(PRICES["GOOG"]))
+
+
+class TradeReportTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        user = self.make_users("report", count=1)[0]
+        for i, moment in enumerate((
+            "2026-03-01 23:59:59", "2026-03-02 00:00:00", "2026-03-02 12:00:00",
+            "2026-03-03 23:59:59", "2026-03-04 00:00:00",
+        )):
+            Trade.objects.create(
+                account=user.account, symbol="AAPL", transaction_type="buy", price=Decimal("10.00"),
+                quantity=Decimal(i + 1), timestamp=datetime.fromisoformat(moment + "+00:00"),
+            )
+        self.reports = tempfile.TemporaryDirectory()
+        self.addCleanup(self.reports.cleanup)
+
+    def write(self, *args, **kwargs):
+        with override_settings(BASE_DIR=self.reports.name):
+            return write_trade_report(*args, **kwargs)
+
+    def test_report_covers_whole_days(self):
+        path, rows = self.write("2026-03-02", "2026-03-03", compress=False)
+        self.assertEqual((os.path.basename(path), rows), ("report_2026-03-02_2026-03-03.csv", 3))
+        with open(path, newline="") as f:
+            lines = list(csv.reader(f))
+        self.assertEqual(lines[0], REPORT_HEADER)
+        self.assertEqual([line[3] for line in lines[1:]], ["2.00", "3.00", "4.00"])
+        self.assertEqual(lines[1], ["report0", "AAPL", "buy", "2.00", "10.00", "1000.00", "0.00"])
+
+    def test_compressed_report_has_the_same_rows(self):
+        plain, _ = self.write("2026-03-02", compress=False)
+        packed, rows = self.write("2026-03-02", compress=True)
+        self.assertEqual((os.path.basename(packed), rows), ("report_2026-03-02.csv.gz", 2))
+        with gzip.open(packed, "rt", newline="") as f, open(plain, newline="") as g:
+            self.assertEqual(f.read(), g.read())
+
+
+@skipUnless(find_spec("pyarrow"), "the analytics export needs pyarrow")
+class ExportTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.account = self.make_users("export", count=1)[0].account
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        overrides = override_settings(EXPORT_DIR=directory.name, EXPORT_LAG_SECONDS=60)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def trade(self, symbol, age):
+        return Trade.objects.create(
+            account=self.account, symbol=symbol, transaction_type="buy", price=Decimal("10.00"),
+            quantity=Decimal("1.00"), timestamp=timezone.now() - timedelta(seconds=age),
+        ).id
+
+    def exported_ids(self):
+        return sorted(exports.read_dataset("trades", columns=["id"]).column("id").to_pylist())
+
+    def test_recent_row_holds_back_the_rows_after_it(self):
+        # The middle row is written with a fresh timestamp, the last with an
+        # old one: exporting the last would move the watermark past the middle.
+        ids = [self.trade("AAPL", 3600), self.trade("AAPL", 5), self.trade("TSLA", 3600)]
+        self.assertEqual(exports.export_incremental("trades"), 1)
+        self.assertEqual(exports.load_state()["trades"], ids[0])
+
+        Trade.objects.filter(id=ids[1]).update(timestamp=timezone.now() - timedelta(seconds=120))
+        self.assertEqual(exports.export_incremental("trades"), 2)
+        self.assertEqual(self.exported_ids(), ids)
+        self.assertEqual(exports.export_incremental("trades"), 0)
+
+    def test_unfinished_batch_is_exported_again(self):
+        ids = [self.trade(symbol, 3600) for symbol in ("AAPL", "TSLA", "AAPL")]
+        self.assertEqual(exports.export_incremental("trades", batch_size=2), 3)
+        # A run that stopped after writing the files of a batch but before
+        # marking it done.
+        state = exports.load_state()
+        state["trades"] = ids[1]
+        day = Trade.objects.get(id=ids[2]).timestamp.date()
+        path = os.path.join("trades", f"date={day}", "symbol=AAPL", f"part-{ids[2]}-{ids[2]}.parquet")
+        state["pending"] = {"trades": [path]}
+        exports.save_state(state)
+
+        self.assertEqual(exports.export_incremental("trades"), 1)
+        self.assertEqual(self.exported_ids(), ids)
+        self.assertNotIn("trades", exports.load_state()["pending"])
+
+
+class KeysetPaginationTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_users("pages", count=1)[0]
+        self.account = self.user.account
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_entries(self, count, timestamp):
+        ids = [Ledger.objects.create(account=self.account, transaction_type="deposit", amount=Decimal("1.00")).id for _ in range(count)]
+        # auto_now_add: the shared timestamp has to be set afterwards.
+        Ledger.objects.filter(id__in=ids).update(timestamp=timestamp)
+        return ids
+
+    def pages(self, url, between=None):
+        pages = []
+        while url:
+            data = self.client.get(url).json()
+            pages.append([row["id"] for row in data["results"]])
+            url = data["next"]
+            if between:
+                between()
+        return pages
+
+    def test_rows_with_equal_timestamps_are_each_listed_once(self):
+        now = timezone.now()
+        older = self.add_entries(3, now - timedelta(minutes=1))
+        same = self.add_entries(5, now)
+        url = f"/api/auth/protect/{self.account.id}/ledger/?page_size=2"
+        # Rows arriving mid-way are newer than every cursor: they neither
+        # shift later pages nor show up on them.
+        pages = self.pages(url, between=lambda: self.add_entries(1, timezone.now() + timedelta(minutes=1)))
+        self.assertEqual(pages, [same[:-3:-1], same[-3:-5:-1], [same[0], older[-1]], older[-2::-1]])
+
+    def test_bad_cursor_and_page_size_are_rejected(self):
+        url = f"/api/auth/protect/{self.account.id}/ledger/"
+        for query in ("?cursor=abc", "?page_size=0", "?page_size=x"):
+            self.assertEqual(self.client.get(url + query).status_code, 400, query)
+
+
+class PortfolioSnapshotTests(SettlementTestCase):
+
+    def portfolio(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        data = client.get(f"/api/auth/protect/{user.account.id}/portfolio/").json()
+        return [data[field] for field in ("balance", "market_value", "equity", "unrealized_pnl")]
+
+    def test_snapshot_follows_fills_and_price_moves(self):
+        holder, idle = self.make_users("folio", count=2)
+        # Built on first read.
+        self.assertEqual(self.portfolio(idle), ["1000.00", "0.00", "1000.00", "0.00"])
+        idle_updated = PortfolioSnapshot.objects.get(account=idle.account).updated_at
+
+        with self.captureOnCommitCallbacks(execute=True):
+            settle_orders([{"user_id": holder.id, "symbol": "AAPL", "quantity": "2", "trade_type": "buy"}])
+        self.assertEqual(self.portfolio(holder), ["797.26", "202.74", "1000.00", "0.00"])
+
+        ingest_prices(FakePriceSource({"AAPL": 110, "TSLA": 13.11, "GOOG": 7.55}))
+        self.assertEqual(self.portfolio(holder), ["797.26", "220.00", "1017.26", "17.26"])
+        # Accounts not holding a repriced symbol are not rewritten.
+        self.assertEqual(PortfolioSnapshot.objects.get(account=idle.account).updated_at, idle_updated)
+
+
+class QuoteCacheTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # A miss on AAPL in both cache layers.
+        cache.delete(quote_key("AAPL"))
+        local_quotes.clear()
+
+    def readers(self):
+        return [("sync", get_quote), ("async", async_to_sync(aget_quote))]
+
+    def test_writes_go_through_to_the_cache(self):
+        Stock.objects.filter(symbol="TSLA").update(price=Decimal("20.00"))
+        set_quotes(Stock.objects.filter(symbol="TSLA"))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_quote("TSLA", local=False)["price"], "20.00")
+
+    def test_miss_is_loaded_by_the_lock_holder(self):
+        for name, read in self.readers():
+            cache.delete(quote_key("AAPL"))
+            local_quotes.clear()
+            with self.assertNumQueries(1):
+                self.assertEqual(read("AAPL")["price"], PRICES["AAPL"], name)
+            self.assertEqual(cache.get(quote_key("AAPL"))["price"], PRICES["AAPL"])
+            self.assertIsNone(cache.get(quote_key("AAPL") + ":lock"))
+
+    def test_miss_waits_for_the_lock_holder(self):
+        # Another reader holds the lock and writes the quote shortly: this
+        # one waits for it instead of going to the database as well.
+        quote = to_quote("AAPL", "AAPL", "NASDAQ", Decimal("150.00"))
+        for name, read in self.readers():
+            cache.delete(quote_key("AAPL"))
+            local_quotes.clear()
+            cache.add(quote_key("AAPL") + ":lock", 1)
+            writer = threading.Timer(0.05, cache.set, (quote_key("AAPL"), quote))
+            writer.start()
+            with self.assertNumQueries(0):
+                self.assertEqual(read("AAPL")["price"], "150.00", name)
+            writer.join()
+            cache.delete(quote_key("AAPL") + ":lock")
+
+    def test_miss_does_not_replace_a_newer_quote(self):
+        # Written through by an ingest after this reader's row was read.
+        newer = to_quote("AAPL", "AAPL", "NASDAQ", Decimal("150.00"))
+        cache.set(quote_key("AAPL"), newer)
+        Stock.objects.filter(symbol="AAPL").update(price=Decimal("99.00"))
+        self.assertEqual(price_cache._load(["AAPL"])["AAPL"], newer)
+        self.assertEqual(cache.get(quote_key("AAPL")), newer)
+
+
+class LocalQuoteCacheTests(SettlementTestCase):
+
+    def test_repeat_reads_are_served_locally(self):
+        local_quotes.clear()
+        self.assertEqual(get_quote("AAPL")["price"], PRICES["AAPL"])
+        # Changed behind the module's back, without an invalidation: reads
+        # keep the local copy, trade pricing (local=False) does not.
+        cache.set(quote_key("AAPL"), to_quote("AAPL", "AAPL", "NASDAQ", Decimal("1.00")))
+        self.assertEqual(get_quote("AAPL")["price"], PRICES["AAPL"])
+        self.assertEqual(get_quote("AAPL", local=False)["price"], "1.00")
+        self.assertEqual(get_quotes(["AAPL"], local=False)["AAPL"]["price"], "1.00")
+
+    def test_writes_evict_the_local_copy(self):
+        get_quote("AAPL")
+        Stock.objects.filter(symbol="AAPL").update(price=Decimal("1.00"))
+        set_quotes(Stock.objects.filter(symbol="AAPL"))
+        self.assertEqual(get_quote("AAPL")["price"], "1.00")
+
+    def test_least_recently_used_and_expired_entries_go(self):
+        local = LocalQuoteCache(maxsize=2, ttl=60)
+        local.set("A", 1)
+        local.set("B", 2)
+        local.get("A")
+        local.set("C", 3)
+        self.assertEqual((local.get("A"), local.get("B"), local.get("C")), (1, None, 3))
+        short = LocalQuoteCache(maxsize=2, ttl=0.01)
+        short.set("A", 1)
+        time.sleep(0.02)
+        self.assertIsNone(short.get("A"))
+        self.assertEqual(
+            {key: local.stats()[key] for key in ("size", "hits", "misses", "evictions")},
+            {"size": 2, "hits": 3, "misses": 1, "evictions": 1},
+        )
+
+    def test_stats_are_for_staff(self):
+        staff, user = self.make_users("stats", count=2)
+        CustomUser.objects.filter(id=staff.id).update(is_staff=True)
+        client = APIClient()
+        client.force_authenticate(user)
+        self.assertEqual(client.get("/api/stocks/cache/stats/").status_code, 403)
+        client.force_authenticate(CustomUser.objects.get(id=staff.id))
+        self.assertEqual(set(client.get("/api/stocks/cache/stats/").json()["l1"]), set(local_quotes.stats()))
+
+
+@override_settings(STREAM_BROKER="memory", STREAM_MAX_PENDING=2, STREAM_HEARTBEAT=5)
+class StreamTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        streaming._broker = None
+        self.addCleanup(setattr, streaming, "_broker", None)
+
+    def test_ticks_coalesce_and_order_updates_queue(self):
+        async def run():
+            outbox = streaming.Outbox(asyncio.get_running_loop(), max_pending=2)
+            for price in ("1.00", "2.00"):
+                outbox.deliver("prices:AAPL", {"symbol": "AAPL", "price": price})
+            outbox.deliver("prices:TSLA", {"symbol": "TSLA", "price": "3.00"})
+            outbox.deliver("fills:1", {"order": 1})
+            outbox.deliver("fills:1", {"order": 2})
+            batch = await outbox.drain()
+            self.assertFalse(outbox.overflowed)
+            outbox.deliver("fills:1", {"order": 3})
+            return batch, await outbox.drain()
+
+        first, second = async_to_sync(run)()
+        self.assertEqual(first, [
+            {"symbol": "AAPL", "price": "2.00"}, {"symbol": "TSLA", "price": "3.00"}, {"order": 1}, {"order": 2},
+        ])
+        self.assertEqual(second, [{"order": 3}])
+
+    def test_client_that_falls_behind_is_told_to_resync(self):
+        user = self.make_users("stream", count=1)[0]
+        request = RequestFactory().get(
+            "/api/stream/?symbols=AAPL", headers={"Authorization": f"Bearer {AccessToken.for_user(user)}"},
+        )
+
+        async def run():
+            response = await streaming.stream(request)
+            chunks = aiter(response.streaming_content)
+            received = [await anext(chunks)]
+            await asyncio.sleep(0.01)  # let the stream subscribe
+            streaming.publish_prices([{"symbol": "AAPL", "price": "1.00"}, {"symbol": "AAPL", "price": "2.00"}])
+            streaming.publish_order_updates([(user.account.id, {"type": "order", "id": i}) for i in range(3)])
+            received += [chunk async for chunk in chunks]
+            return b"".join(received).decode()
+
+        body = async_to_sync(run)()
+        self.assertEqual(body.count("event: price"), 1)
+        self.assertIn('"price": "2.00"', body)
+        self.assertEqual(body.count("event: order"), 2)
+        self.assertTrue(body.endswith("event: overflow\ndata: {\"type\": \"overflow\"}\n\n"))
+
+    def test_stream_needs_symbols_or_a_token(self):
+        for query in ("", "?symbols=" + ",".join(f"S{i}" for i in range(51))):
+            response = async_to_sync(streaming.stream)(RequestFactory().get("/api/stream/" + query))
+            self.assertEqual(response.status_code, 400, query)
+
+
+class StockIngestTests(SettlementTestCase):
+    # One invalid row, one without a price.
+    ROWS = [
+        {"symbol": "AAPL", "name": "Apple", "exchange": "NASDAQ", "price": 150.25},
+        {"symbol": "MSFT", "name": "Microsoft", "exchange": "NASDAQ", "price": "410.5"},
+        {"symbol": "BAD", "name": "", "exchange": "NASDAQ", "price": "1.234"},
+        {"symbol": "NEW", "name": "New listing", "exchange": "NYSE"},
+    ]
+
+    def setUp(self):
+        super().setUp()
+        staff = self.make_users("ingest", count=1)[0]
+        CustomUser.objects.filter(id=staff.id).update(is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(CustomUser.objects.get(id=staff.id))
+
+    def post(self, body, content_type):
+        return self.client.post("/api/stock/ingest/", body, content_type=content_type)
+
+    def bodies(self):
+        lines = [",".join(["symbol", "name", "exchange", "price"])] + [
+            ",".join(str(row.get(field, "")) for field in ("symbol", "name", "exchange", "price")) for row in self.ROWS
+        ]
+        return [
+            (json.dumps(self.ROWS, indent=1), "application/json"),
+            ("\n".join(json.dumps(row) for row in self.ROWS), "application/x-ndjson"),
+            ("\n".join(lines), "text/csv"),
+        ]
+
+    def test_every_format_upserts_and_reports_bad_rows(self):
+        # A tiny read size puts items, strings and numbers across chunk ends.
+        with mock.patch("accounts.api.ingest.JSON_CHUNK", 7):
+            for body, content_type in self.bodies():
+                for _ in range(2):
+                    response = self.post(body, content_type)
+                    self.assertEqual(response.status_code, 201, content_type)
+                    self.assertEqual((response.data["received"], response.data["upserted"]), (4, 3), content_type)
+                    self.assertEqual(response.data["errors"], [{"row": 2, "errors": {
+                        "name": ["This field is required."],
+                        "price": ["Ensure that there are no more than 2 decimal places."],
+                    }}])
+                self.assertEqual(
+                    dict(Stock.objects.filter(symbol__in=["AAPL", "MSFT", "NEW"]).values_list("symbol", "price")),
+                    {"AAPL": Decimal("150.25"), "MSFT": Decimal("410.50"), "NEW": Decimal("0.00")},
+                )
+                self.assertEqual(get_quote("MSFT", local=False)["price"], "410.50")
+        self.assertEqual(Stock.objects.count(), len(PRICES) + 2)
+
+    def test_json_list_is_read_as_it_is_consumed(self):
+        class Body(io.BytesIO):
+            read_sizes = []
+
+            def read(self, size=-1):
+                self.read_sizes.append(size)
+                return super().read(size)
+
+        body = Body(json.dumps([{"symbol": f"S{i}", "name": "x" * 100} for i in range(5000)]).encode())
+        rows = JSONArrayStreamParser().parse(body)
+        self.assertEqual(next(rows)["symbol"], "S0")
+        self.assertLess(body.tell(), 2 * JSON_CHUNK)
+        self.assertNotIn(-1, Body.read_sizes)
+        self.assertEqual(sum(1 for _ in rows), 4999)
+
+    def test_bodies_that_are_not_lists_are_rejected(self):
+        for body, content_type, code in (
+            ('{"symbol": "AAPL"}', "application/json", 400),
+            ("42", "application/json", 400),
+            ('[{"symbol": "AAPL"} {"symbol": "MSFT"}]', "application/json", 400),
+            ('[{"symbol": "AAPL"},]', "application/json", 400),
+            ('[{"symbol": "AAPL"}] []', "application/json", 400),
+            ("[]", "application/json", 201),
+        ):
+            self.assertEqual(self.post(body, content_type).status_code, code, body)
+        self.assertIn('got type "dict"', str(self.post('{"symbol": "AAPL"}', "application/json").data))
+
+
+class PriceBarTests(SettlementTestCase):
+
+    def at(self, clock):
+        return datetime.fromisoformat(f"2026-03-02T{clock}+00:00")
+
+    def bar(self, interval, clock):
+        bar = PriceBar.objects.get(symbol="AAPL", interval=interval, start=self.at(clock))
+        return (bar.open, bar.high, bar.low, bar.close, bar.volume, bar.ticks)
+
+    def test_batches_and_late_ticks_merge_into_bars(self):
+        record_ticks({"AAPL": Decimal("100"), "TSLA": Decimal("20")}, self.at("10:00:10"), volumes={"AAPL": 5})
+        record_ticks({"AAPL": Decimal("105")}, self.at("10:00:40"), volumes={"AAPL": 1})
+        record_ticks({"AAPL": Decimal("98")}, self.at("10:01:05"))
+        # Late: widens the range, but the close stays with the latest tick.
+        record_ticks({"AAPL": Decimal("110")}, self.at("10:00:20"), volumes={"AAPL": 2})
+
+        self.assertEqual(self.bar("1m", "10:00:00"), (100, 110, 100, 105, 8, 3))
+        self.assertEqual(self.bar("1m", "10:01:00"), (98, 98, 98, 98, 0, 1))
+        for interval, start in (("5m", "10:00:00"), ("1h", "10:00:00"), ("1d", "00:00:00")):
+            self.assertEqual(self.bar(interval, start), (100, 110, 98, 98, 8, 4), interval)
+        self.assertEqual(PriceBar.objects.filter(symbol="TSLA").count(), 4)
+        self.assertEqual(PriceTick.objects.filter(symbol="AAPL").count(), 4)
+
+    def test_bars_endpoint(self):
+        for minute in range(3):
+            record_ticks({"AAPL": Decimal(100 + minute)}, self.at(f"10:0{minute}:00"))
+        client = APIClient()
+        response = client.get("/api/stocks/AAPL/bars/?interval=1m&limit=2")
+        self.assertEqual([bar["close"] for bar in response.json()["bars"]], ["101.00", "102.00"])
+        response = client.get("/api/stocks/AAPL/bars/?interval=1m&start=2026-03-02T10:00:00Z&end=2026-03-02T10:01:00Z")
+        self.assertEqual([bar["close"] for bar in response.json()["bars"]], ["100.00"])
+        self.assertEqual(client.get("/api/stocks/AAPL/bars/?interval=2m").status_code, 400)
+
+
+class JournalTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        journal._snapshotted.clear()
+        self.users = self.make_users("journal")
+        with self.captureOnCommitCallbacks(execute=True):
+            settle_orders(self.queue(self.random_orders(60), self.users))
+        self.ids = [user.account.id for user in self.users]
+
+    def replay_journal(self, *args):
+        out = io.StringIO()
+        call_command("replay_journal", *args, stdout=out)
+        return out.getvalue()
+
+    def test_replay_matches_the_live_rows_across_snapshots(self):
+        self.assertEqual(journal.reconcile(self.ids), (5, []))
+        self.assertEqual(journal.snapshot_accounts(), 5)
+        with self.captureOnCommitCallbacks(execute=True):
+            settle_orders(self.queue(self.random_orders(30, seed=2), self.users))
+        self.assertEqual(journal.reconcile(self.ids), (5, []))
+        self.assertIn("found 0 mismatches", self.replay_journal("--chunk-size", "2"))
+
+    def test_repair_rewrites_the_live_rows(self):
+        before = self.state(self.users)
+        account = self.users[0].account
+        Account.objects.filter(id=account.id).update(balance=Decimal("1.00"))
+        Position.objects.filter(account=account).delete()
+        found = {m["field"] for m in journal.reconcile(self.ids)[1]}
+        self.assertIn("balance", found)
+        self.assertTrue(any(field.startswith("position:") for field in found))
+
+        self.assertIn(f"repaired {len(journal.reconcile(self.ids)[1])} mismatches", self.replay_journal("--repair"))
+        self.assertEqual(journal.reconcile(self.ids), (5, []))
+        after = self.state(self.users)
+        self.assertEqual(after["balances"], before["balances"])
+        # Recreated rows come back with the journal's numbers.
+        self.assertEqual(
+            [p[:3] + p[4:] for p in after["positions"]],
+            [p[:3] + p[4:] for p in before["positions"]],
+        )
+
+    def test_incomplete_snapshots_are_rebased_not_repaired(self):
+        account = self.users[0].account
+        AccountSnapshot.objects.filter(account=account).update(complete=False)
+        Account.objects.filter(id=account.id).update(balance=Decimal("1.00"))
+        with self.assertRaisesMessage(CommandError, "refusing to repair"):
+            self.replay_journal("--repair")
+        self.assertEqual(Account.objects.get(id=account.id).balance, Decimal("1.00"))
+
+        self.assertIn("Rebased 1 accounts", self.replay_journal("--rebase"))
+        # The live rows are taken as correct from here on.
+        self.assertEqual(journal.incomplete_accounts(), [])
+        self.assertEqual(journal.reconcile(self.ids), (5, []))
+        self.assertEqual(Account.objects.get(id=account.id).balance, Decimal("1.00"))
+
+
+class MetricsTests(SettlementTestCase):
+
+    def histogram(self):
+        histogram = metrics.Histogram("test_seconds", "Test latency.", ["stage"], buckets=(0.01, 1))
+        self.addCleanup(metrics._registry.remove, histogram)
+        return histogram
+
+    def test_histogram_samples_are_cumulative(self):
+        histogram = self.histogram()
+        for value in (0.005, 0.01, 0.5, 7):
+            histogram.observe(value, stage="a")
+        lines = [line for line in metrics.render().splitlines() if "test_seconds" in line]
+        self.assertEqual(lines, [
+            "# HELP test_seconds Test latency.",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{stage="a",le="0.01"} 2.0',
+            'test_seconds_bucket{stage="a",le="1.0"} 3.0',
+            'test_seconds_bucket{stage="a",le="+Inf"} 4.0',
+            'test_seconds_sum{stage="a"} 7.515',
+            'test_seconds_count{stage="a"} 4.0',
+        ])
+
+    def test_flush_sends_only_the_changes(self):
+        histogram = self.histogram()
+        conn = mock.MagicMock()
+        pipe = conn.pipeline.return_value
+        metrics.flush(conn)
+        histogram.observe(0.5, stage="a")
+        pipe.reset_mock()
+        metrics.flush(conn)
+        self.assertEqual(
+            sorted(c.args for c in pipe.hincrbyfloat.call_args_list if c.args[0] == "metrics:test_seconds"),
+            [("metrics:test_seconds", '1:["a"]', 1.0), ("metrics:test_seconds", '3:["a"]', 0.5)],
+        )
+        pipe.reset_mock()
+        metrics.flush(conn)
+        self.assertFalse([c for c in pipe.hincrbyfloat.call_args_list if c.args[0] == "metrics:test_seconds"])
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_endpoint_reports_requests_by_route(self):
+        client = APIClient()
+        self.assertEqual(client.get("/metrics").status_code, 403)
+        client.get("/api/stocks/AAPL/bars/?interval=1m")
+        response = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        body = response.content.decode()
+        self.assertIn('http_request_seconds_count{route="api/stocks/<str:symbol>/bars/",method="GET"}', body)
+        queries = [line for line in body.splitlines() if line.startswith('http_request_queries_sum{route="api/stocks/')]
+        self.assertGreater(float(queries[0].split()[-1]), 0)
+
+
+class AsyncViewTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, other = self.make_users("async", count=2)
+        for symbol in ("AAPL", "TSLA", "GOOG"):
+            self.settle(self.user, symbol, "1", "buy")
+        self.settle(self.user, "GOOG", "1", "sell")
+        self.settle(other, "AAPL", "1", "buy")
+        self.account, self.other = self.user.account.id, other.account.id
+        self.token = f"Bearer {AccessToken.for_user(self.user)}"
+
+    def both(self, path, token=None):
+        # The DRF view's and its async twin's answers, with the async links
+        # pointed back at the DRF paths.
+        headers = {"Authorization": token} if token else None
+        answers = []
+        for prefix in ("/api/", "/api/async/"):
+            response = self.client.get(prefix + path, headers=headers)
+            answers.append((response.status_code, json.loads(response.content.decode().replace("/api/async/", "/api/"))))
+        return answers
+
+    def test_async_views_answer_like_drf(self):
+        base = f"auth/protect/{self.account}"
+        paths = [
+            "auth/protect/",
+            f"{base}/positions/",
+            f"{base}/positions/?closed=true&page_size=2",
+            f"{base}/positions/?symbol=TSLA",
+            f"{base}/positions/?page_size=0",
+            f"{base}/ledger/?page_size=2",
+            f"{base}/ledger/?transaction_type=withdraw",
+            f"{base}/ledger/?start=2000-01-01&end=2999-01-01",
+            f"{base}/ledger/?start=yesterday",
+            f"{base}/portfolio/",
+            f"auth/protect/{self.other}/positions/",
+            f"auth/protect/{self.other}/ledger/",
+            f"auth/protect/{self.other}/portfolio/",
+        ]
+        for path in paths:
+            drf, answer = self.both(path, self.token)
+            self.assertEqual(answer, drf, path)
+        stocks = ("stocks/", "stocks/?page=2", "stocks/?page=last", "stocks/?page=9", "stocks/?symbol=TSLA", "stocks/AAPL/", "stocks/NOPE/")
+        for path in stocks:
+            drf, answer = self.both(path)
+            self.assertEqual(answer, drf, path)
+
+    def test_keyset_cursor_works_on_both(self):
+        path = f"auth/protect/{self.account}/positions/?closed=true&page_size=2"
+        (_, first), _ = self.both(path, self.token)
+        drf, answer = self.both(first["next"].split("/api/", 1)[1], self.token)
+        self.assertEqual(answer, drf)
+        self.assertEqual(len(answer[1]["results"]), 1)
+
+    def test_authentication_errors_match(self):
+        path = f"auth/protect/{self.account}/positions/"
+        for token in (None, "Bearer nope", "Basic abc"):
+            drf, answer = self.both(path, token)
+            self.assertEqual(answer, drf, token)
+            self.assertEqual(answer[0], 401)
+
+
+class LeanSerializerTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.make_users("lean", count=1)[0]
+        for symbol, quantity in (("AAPL", "1.5"), ("TSLA", "3"), ("GOOG", "2")):
+            self.settle(self.user, symbol, quantity, "buy")
+        self.settle(self.user, "GOOG", "2", "sell")
+        Position.objects.filter(symbol="TSLA").update(average_price=Decimal("13.1"))
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_rows_render_like_the_drf_serializers(self):
+        account = self.user.account
+        for serializer_class, queryset in (
+            (PositionSerializer, Position.objects.filter(account=account).order_by("id")),
+            (LedgerSerializer, Ledger.objects.filter(account=account).order_by("id")),
+            (AccountSerializer, Account.objects.filter(id=account.id)),
+            (StockSerializer, Stock.objects.order_by("id")),
+        ):
+            lean = fastjson.LeanSerializer(serializer_class)
+            # With orjson (when installed) and with the standard library.
+            for encoder in {fastjson.orjson, None}:
+                for zone in ("UTC", "America/New_York"):
+                    with timezone.override(zone), mock.patch.object(fastjson, "orjson", encoder):
+                        self.assertEqual(
+                            fastjson.dumps(lean.data(lean.values_list(queryset))),
+                            JSONRenderer().render(serializer_class(queryset, many=True).data),
+                            (serializer_class.__name__, encoder, zone),
+                        )
+
+    def body(self, path, **overrides):
+        with override_settings(**overrides):
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200, path)
+        return b"".join(response.streaming_content) if response.streaming else response.content
+
+    def test_endpoints_send_the_same_bytes(self):
+        base = f"/api/auth/protect/{self.user.account.id}"
+        for path in (f"{base}/positions/?closed=true", f"{base}/ledger/?page_size=2", "/api/stocks/", "/api/stocks/?page=2"):
+            drf = self.body(path, LEAN_SERIALIZATION=False)
+            self.assertEqual(self.body(path), drf, path)
+            self.assertEqual(self.body(path, JSON_STREAM_THRESHOLD=1), drf, path)
+
+
+def add_replica(test):
+    # The alias only has to be configured; nothing queries it, so Django's
+    # warning about overriding DATABASES does not apply.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        overrides = override_settings(DATABASES={**settings.DATABASES, db_router.REPLICA: settings.DATABASES["default"]})
+        overrides.enable()
+    test.addCleanup(overrides.disable)
+
+
+class ReplicaRoutingTests(SettlementTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user, self.idle = self.make_users("replica", count=2)
+        add_replica(self)
+
+    def routes(self, account_id):
+        return db_router.replica_for(account_id), async_to_sync(db_router.areplica_for)(account_id)
+
+    def test_accounts_read_from_the_primary_after_a_fill(self):
+        account, idle = self.user.account.id, self.idle.account.id
+        self.assertEqual(self.routes(account), (db_router.REPLICA, db_router.REPLICA))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.settle(self.user, "AAPL", "1", "buy")
+        self.assertEqual(self.routes(account), ("default", "default"))
+        self.assertEqual(self.routes(idle), (db_router.REPLICA, db_router.REPLICA))
+        # A rejected order wrote nothing worth reading back.
+        with self.captureOnCommitCallbacks(execute=True):
+            self.settle(self.idle, "NOPE", "1", "buy")
+        self.assertEqual(self.routes(idle), (db_router.REPLICA, db_router.REPLICA))
+        # Once the sticky window has passed.
+        cache.delete(db_router.sticky_key(account))
+        self.assertEqual(self.routes(account), (db_router.REPLICA, db_router.REPLICA))
+
+    def test_views_pick_the_database_by_stickiness(self):
+        account = self.user.account.id
+        client = APIClient()
+        client.force_authenticate(self.user)
+        token = {"Authorization": f"Bearer {AccessToken.for_user(self.user)}"}
+
+        def chosen():
+            aliases = []
+
+            def reads_from(alias):
+                aliases.append(alias)
+                return contextlib.nullcontext()
+
+            with mock.patch.object(db_router, "reads_from", side_effect=reads_from):
+                client.get(f"/api/auth/protect/{account}/positions/")
+                self.client.get(f"/api/async/auth/protect/{account}/positions/", headers=token)
+            return aliases
+
+        self.assertEqual(chosen(), [db_router.REPLICA, db_router.REPLICA])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.settle(self.user, "AAPL", "1", "buy")
+        self.assertEqual(chosen(), ["default", "default"])
+
+
+class ReplicaRouterTests(SimpleTestCase):
+    # Not a TestCase: reads inside a transaction always stay on the primary.
+    databases = {"default"}
+
+    def test_reads_follow_the_context(self):
+        add_replica(self)
+        router = db_router.ReplicaRouter()
+        self.assertEqual(router.db_for_read(Account), "default")
+        with db_router.reads_from(db_router.REPLICA):
+            self.assertEqual(router.db_for_read(Account), db_router.REPLICA)
+            self.assertEqual(router.db_for_write(Account), "default")
+            self.assertEqual(db_router.on_primary(router.db_for_read)(Account), "default")
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Account), "default")
+
+
+class PartitionTests(SettlementTestCase):
+
+    def test_month_arithmetic(self):
+        self.assertEqual(partitions.add_months(date(2025, 11, 1), 3), date(2026, 2, 1))
+        self.assertEqual(partitions.add_months(date(2026, 1, 1), -1), date(2025, 12, 1))
+        self.assertEqual(partitions.partition_name("accounts_trade", date(2026, 3, 1)), "accounts_trade_2026_03")
+        self.assertEqual(partitions.bound(date(2026, 3, 1)), "2026-03-01 00:00:00+00")
+
+    @skipIf(connection.vendor == "postgresql", "partitioning is Postgres only")
+    def test_other_databases_are_left_alone(self):
+        self.assertEqual(partitions.ensure_partitions(), [])
+
+    @skipUnless(connection.vendor == "postgresql", "partitioning is Postgres only")
+    def test_stranded_rows_move_into_their_new_partition(self):
+        account = self.make_users("partition", count=1)[0].account
+        table = Trade._meta.db_table
+        # No partition covers February 2001, so these land in the default one.
+        for day in (1, 28):
+            Trade.objects.create(
+                account=account, symbol="AAPL", transaction_type="buy", price=Decimal("1.00"),
+                quantity=Decimal("1.00"), timestamp=datetime(2001, 2, day, 23, 59, tzinfo=dt_timezone.utc),
+            )
+        Trade.objects.create(
+            account=account, symbol="AAPL", transaction_type="buy", price=Decimal("1.00"),
+            quantity=Decimal("1.00"), timestamp=datetime(2001, 3, 1, tzinfo=dt_timezone.utc),
+        )
+
+        created = partitions.ensure_partitions(months_ahead=0)
+        self.assertIn(f"{table}_2001_02", created)
+        self.assertIn(f"{table}_2001_03", created)
+        self.assertEqual(partitions.ensure_partitions(months_ahead=0), [])
+        with connection.cursor() as cursor:
+            counts = []
+            for name in (f"{table}_2001_02", f"{table}_2001_03", f"{table}_default"):
+                cursor.execute(f"SELECT COUNT(*) FROM {name}")
+                counts.append(cursor.fetchone()[0])
+        self.assertEqual(counts, [2, 1, 0])
+        self.assertEqual(Trade.objects.filter(account=account).count(), 3)
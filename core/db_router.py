@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICA = "replica"
+
+# Reads go to the primary unless the code opts in with reads_from(REPLICA), as
+# the read-only account and stock views and the daily report do. Settlement
+# and book fills are pinned with on_primary, nothing else that reads before it
+# writes opts in, and a read inside a transaction on the primary stays there
+# regardless. Writes always go to the primary. Context variables follow the
+# caller into sync_to_async threads, so async views opt in the same way.
+_reads = ContextVar("db_reads", default=DEFAULT_DB_ALIAS)
+
+
+def sticky_key(account_id):
+    return f"db:primary:{account_id}"
+
+
+def has_replica():
+    return REPLICA in settings.DATABASES
+
+
+@contextmanager
+def reads_from(alias):
+    token = _reads.set(alias)
+    try:
+        yield
+    finally:
+        _reads.reset(token)
+
+
+def on_primary(func):
+    # Every read `func` makes goes to the primary, including those of the
+    # on_commit hooks it runs, whatever block it is called from.
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with reads_from(DEFAULT_DB_ALIAS):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def replica_for(account_id=None):
+    # REPLICA, or the primary for an account that wrote in the last
+    # REPLICA_STICKY_SECONDS, so it reads its own writes while the replica
+    # catches up.
+    if not has_replica():
+        return DEFAULT_DB_ALIAS
+    if account_id is not None and cache.get(sticky_key(account_id)) is not None:
+        return DEFAULT_DB_ALIAS
+    return REPLICA
+
+
+async def areplica_for(account_id=None):
+    if not has_replica():
+        return DEFAULT_DB_ALIAS
+    if account_id is not None and await cache.aget(sticky_key(account_id)) is not None:
+        return DEFAULT_DB_ALIAS
+    return REPLICA
+
+
+def stick_to_primary(account_ids):
+    if has_replica() and account_ids:
+        cache.set_many(
+            {sticky_key(account_id): 1 for account_id in account_ids}, timeout=settings.REPLICA_STICKY_SECONDS,
+        )
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = _reads.get()
+        if alias == DEFAULT_DB_ALIAS or alias not in settings.DATABASES:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,56 @@
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import sys
+import threading
+
+
+class AsyncHandler(QueueHandler):
+    # Formats records on the calling thread and hands them to a background
+    # thread that writes them to stderr and `filename`, so a slow disk never
+    # holds up a trade. A full queue makes callers wait instead of dropping
+    # records, so the log stays complete and in order.
+
+    def __init__(self, filename=None, stream=True, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.targets = []
+        if stream:
+            self.targets.append(logging.StreamHandler(sys.stderr))
+        if filename:
+            self.targets.append(logging.FileHandler(filename))
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+        atexit.register(self.stop)
+
+    def _ensure_listener(self):
+        # Threads do not survive a fork, so each web or Celery worker process
+        # starts its own listener on its first record.
+        if self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.queue.maxsize)
+            self.listener = QueueListener(self.queue, *self.targets)
+            self.listener.start()
+            self.pid = os.getpid()
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        self.queue.put(record)
+
+    def stop(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.pid = None
+        for target in self.targets:
+            target.flush()
+
+    def close(self):
+        self.stop()
+        for target in self.targets:
+            target.close()
+        super().close()
@@ -52,6 +52,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'accounts.api.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -84,6 +85,13 @@ WSGI_APPLICATION = 'core.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Web and Celery processes keep their connections: each thread reuses one for
+# DATABASE_CONN_MAX_AGE seconds, checked before reuse so a connection the
+# server dropped is replaced instead of failing a request. DATABASE_POOL gives
+# each process a psycopg pool instead (needs psycopg[pool]); use it under ASGI,
+# where requests do not keep to one thread.
+DATABASE_POOL = env.bool("DATABASE_POOL", default=False)
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -92,9 +100,33 @@ DATABASES = {
         'PASSWORD': env("DATABASE_PASSWORD"),
         'HOST': env("DATABASE_HOST"),
         'PORT':env.int("DATABASE_PORT", default=5432),
+        'CONN_MAX_AGE': 0 if DATABASE_POOL else env.int("DATABASE_CONN_MAX_AGE", default=60),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            "pool": {
+                "min_size": env.int("DATABASE_POOL_MIN_SIZE", default=2),
+                "max_size": env.int("DATABASE_POOL_MAX_SIZE", default=10),
+                "timeout": env.float("DATABASE_POOL_TIMEOUT", default=10.0),
+            },
+        } if DATABASE_POOL else {},
     }
 }
 
+# Optional read replica for the read-only account and stock views and the
+# daily report (see core.db_router). An account that traded in the last
+# REPLICA_STICKY_SECONDS reads from the primary, so it always sees its fills.
+DATABASE_REPLICA_HOST = env("DATABASE_REPLICA_HOST", default="")
+if DATABASE_REPLICA_HOST:
+    DATABASES["replica"] = {
+        **DATABASES["default"],
+        "HOST": DATABASE_REPLICA_HOST,
+        "PORT": env.int("DATABASE_REPLICA_PORT", default=DATABASES["default"]["PORT"]),
+        "OPTIONS": dict(DATABASES["default"]["OPTIONS"]),
+        "TEST": {"MIRROR": "default"},
+    }
+DATABASE_ROUTERS = ["core.db_router.ReplicaRouter"]
+REPLICA_STICKY_SECONDS = env.int("REPLICA_STICKY_SECONDS", default=10)
+
 
 
 # Password validation
@@ -156,6 +188,28 @@ REST_FRAMEWORK = {
     "PAGE_SIZE": 1,
 }
 
+# Keyset pagination for the account ledger and positions endpoints
+# (?page_size= is capped at ACCOUNT_MAX_PAGE_SIZE).
+ACCOUNT_PAGE_SIZE = env.int("ACCOUNT_PAGE_SIZE", default=100)
+ACCOUNT_MAX_PAGE_SIZE = env.int("ACCOUNT_MAX_PAGE_SIZE", default=1000)
+
+# The stock, positions and ledger lists skip DRF serializers and encode
+# values_list() rows directly (with orjson when installed); bodies with more
+# than JSON_STREAM_THRESHOLD rows are streamed. The JSON is the same either way.
+LEAN_SERIALIZATION = env.bool("LEAN_SERIALIZATION", default=True)
+JSON_STREAM_THRESHOLD = env.int("JSON_STREAM_THRESHOLD", default=500)
+
+# Price history: /api/stocks/<symbol>/bars/ returns BAR_PAGE_SIZE bars by
+# default (?limit= is capped at BAR_MAX_PAGE_SIZE). Raw ticks older than
+# PRICE_TICK_RETENTION_DAYS are pruned nightly; bars are kept.
+BAR_PAGE_SIZE = env.int("BAR_PAGE_SIZE", default=500)
+BAR_MAX_PAGE_SIZE = env.int("BAR_MAX_PAGE_SIZE", default=5000)
+PRICE_TICK_RETENTION_DAYS = env.int("PRICE_TICK_RETENTION_DAYS", default=30)
+
+# On Postgres, trades and ledger entries are partitioned by month; a nightly
+# task keeps PARTITION_MONTHS_AHEAD months of partitions ready ahead of now.
+PARTITION_MONTHS_AHEAD = env.int("PARTITION_MONTHS_AHEAD", default=3)
+
 
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=50),
@@ -174,11 +228,117 @@ CACHES = {
     }
 }
 
+# Stock quotes are cached as one canonical dict under stock:v<version>:<symbol>.
+PRICE_CACHE_VERSION = env.int("PRICE_CACHE_VERSION", default=1)
+PRICE_CACHE_TIMEOUT = env.int("PRICE_CACHE_TIMEOUT", default=60*10)
+PRICE_CACHE_LOCK_TIMEOUT = env.float("PRICE_CACHE_LOCK_TIMEOUT", default=2.0)
+# Per-process L1 in front of Redis for quote reads, invalidated over pub/sub.
+PRICE_L1_SIZE = env.int("PRICE_L1_SIZE", default=2048)
+PRICE_L1_TTL = env.float("PRICE_L1_TTL", default=1.0)
+
+# Idempotent order submission: a client_order_id is remembered in the cache
+# for ORDER_DEDUP_TTL seconds (the unique constraint covers the rest), and a
+# submission still being placed holds its key for ORDER_DEDUP_PENDING_TTL.
+ORDER_DEDUP_TTL = env.int("ORDER_DEDUP_TTL", default=86400)
+ORDER_DEDUP_PENDING_TTL = env.int("ORDER_DEDUP_PENDING_TTL", default=30)
+
+# Pre-trade risk checks (accounts.api.risk) on market orders: buying power,
+# sellable quantity, at most RISK_MAX_ORDERS_PER_WINDOW orders per account
+# every RISK_RATE_WINDOW seconds, and, when set, a cap on the value of one
+# symbol an account may hold. Cached state is rebuilt after RISK_STATE_TTL.
+RISK_CHECKS = env.bool("RISK_CHECKS", default=True)
+RISK_MAX_ORDERS_PER_WINDOW = env.int("RISK_MAX_ORDERS_PER_WINDOW", default=20)
+RISK_RATE_WINDOW = env.int("RISK_RATE_WINDOW", default=1)
+RISK_MAX_SYMBOL_EXPOSURE = env.float("RISK_MAX_SYMBOL_EXPOSURE", default=0)
+RISK_STATE_TTL = env.int("RISK_STATE_TTL", default=3600)
+
+# Position cost accounting: "average" (weighted average cost) or "fifo"
+# (realized P&L against the oldest open lots, kept in PositionLot).
+POSITION_COST_METHOD = env("POSITION_COST_METHOD", default="average")
+
+# Trade journal: accounts per replay / snapshot chunk. Snapshots are taken
+# hourly so a replay only reads the last hour of events per account.
+JOURNAL_CHUNK_SIZE = env.int("JOURNAL_CHUNK_SIZE", default=1000)
+
+# Rows per bulk upsert when loading listings through /api/stock/ingest/.
+STOCK_INGEST_CHUNK_SIZE = env.int("STOCK_INGEST_CHUNK_SIZE", default=1000)
+
+# Server-sent price and fill streams at /api/stream/ (served through core.asgi).
+# "memory" keeps pub/sub inside one process, for tests and local runs. A stream
+# may follow at most STREAM_MAX_SYMBOLS symbols.
+STREAM_BROKER = env("STREAM_BROKER", default="redis")
+STREAM_REDIS_URL = env("STREAM_REDIS_URL", default=CACHES["default"]["LOCATION"])
+STREAM_MAX_PENDING = env.int("STREAM_MAX_PENDING", default=1000)
+STREAM_HEARTBEAT = env.float("STREAM_HEARTBEAT", default=15.0)
+STREAM_MAX_SYMBOLS = env.int("STREAM_MAX_SYMBOLS", default=50)
+
 CELERY_BROKER_URL = env("REDIS_URL")
 CELERY_RESULT_BACKEND = env("REDIS_URL")
 
+# Trades are hashed by account onto TRADE_SHARD_COUNT queues named
+# "<prefix>.<n>", each consumed by one worker so an account's orders settle in
+# order. The order book lives in the memory of a single worker consuming the
+# "matching" queue (celery -A core worker -Q matching -P solo).
+TRADE_SHARD_COUNT = env.int("TRADE_SHARD_COUNT", default=4)
+TRADE_QUEUE_PREFIX = env("TRADE_QUEUE_PREFIX", default="trades")
+
+CELERY_TASK_ROUTES = (
+    "accounts.api.routing.route_task",
+    {
+        "accounts.api.tasks.submit_order": {"queue": "matching"},
+        "accounts.api.tasks.cancel_order": {"queue": "matching"},
+        "accounts.api.tasks.flush_fills": {"queue": "matching"},
+    },
+)
+
+MATCHING_FLUSH_SIZE = env.int("MATCHING_FLUSH_SIZE", default=500)
+MATCHING_FLUSH_INTERVAL = env.float("MATCHING_FLUSH_INTERVAL", default=1.0)
+# A book fill that fails to persist this many times (other than for the
+# database being unreachable) is set aside on the matching:quarantine list.
+MATCHING_FILL_ATTEMPTS = env.int("MATCHING_FILL_ATTEMPTS", default=3)
+
+# Queued orders: "task" settles each order in its own process_trade task,
+# "batch" queues them for the run_settlement command to settle in micro-batches.
+TRADE_SETTLEMENT_MODE = env("TRADE_SETTLEMENT_MODE", default="task")
+SETTLEMENT_BATCH_SIZE = env.int("SETTLEMENT_BATCH_SIZE", default=500)
+SETTLEMENT_BATCH_INTERVAL = env.float("SETTLEMENT_BATCH_INTERVAL", default=0.05)
+
+# With TRADE_SYNC_MODE, TradeView settles in the request and answers with the
+# fill or rejection. It falls back to the queue when TRADE_SYNC_MAX_INFLIGHT
+# requests in this process are already settling, or when the account lock is
+# not granted within TRADE_SYNC_LOCK_TIMEOUT_MS.
+TRADE_SYNC_MODE = env.bool("TRADE_SYNC_MODE", default=False)
+TRADE_SYNC_MAX_INFLIGHT = env.int("TRADE_SYNC_MAX_INFLIGHT", default=8)
+TRADE_SYNC_LOCK_TIMEOUT_MS = env.int("TRADE_SYNC_LOCK_TIMEOUT_MS", default=50)
+
+# Price ingestion: the symbol universe is the Stock table. Prices are fetched
+# through PRICE_SOURCE by a bounded thread pool; symbols still outstanding
+# after PRICE_FETCH_TIMEOUT seconds are reported as failed for that run.
+PRICE_SOURCE = env("PRICE_SOURCE", default="accounts.api.prices.YFinanceSource")
+PRICE_FETCH_WORKERS = env.int("PRICE_FETCH_WORKERS", default=32)
+PRICE_FETCH_TIMEOUT = env.float("PRICE_FETCH_TIMEOUT", default=45.0)
+
+# Trade reports stream rows from a server-side cursor in chunks of this size.
+REPORT_CHUNK_SIZE = env.int("REPORT_CHUNK_SIZE", default=5000)
+REPORT_COMPRESS = env.bool("REPORT_COMPRESS", default=False)
+
+# Columnar analytics export (needs pyarrow). Trades and ledger are appended
+# incrementally by primary key; a run stops at the first row younger than
+# EXPORT_LAG_SECONDS, which waits for the next run with every row after it.
+EXPORT_DIR = env("EXPORT_DIR", default=os.path.join(BASE_DIR, "exports"))
+EXPORT_BATCH_SIZE = env.int("EXPORT_BATCH_SIZE", default=50000)
+EXPORT_LAG_SECONDS = env.int("EXPORT_LAG_SECONDS", default=60)
+
 import os
 
+LOG_QUEUE_SIZE = env.int("LOG_QUEUE_SIZE", default=10000)
+
+# Prometheus metrics on /metrics. Each process adds its numbers to the shared
+# totals in Redis this often; set METRICS_TOKEN to require
+# "Authorization: Bearer <token>" from the scraper.
+METRICS_FLUSH_INTERVAL = env.float("METRICS_FLUSH_INTERVAL", default=5.0)
+METRICS_TOKEN = env("METRICS_TOKEN", default="")
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -189,19 +349,17 @@ LOGGING = {
         },
     },
     "handlers": {
-        "console": {
-            "class": "logging.StreamHandler",
-            "formatter": "detailed",
-        },
-        "file": {
-            "class": "logging.FileHandler",
+        # Console and logs/trades.log, written by a background thread.
+        "async": {
+            "()": "core.log_handlers.AsyncHandler",
             "filename": os.path.join(BASE_DIR, "logs/trades.log"),
+            "maxsize": LOG_QUEUE_SIZE,
             "formatter": "detailed",
         },
     },
     "loggers": {
         "trade_logger": {  
-            "handlers": ["console", "file"],
+            "handlers": ["async"],
             "level": "INFO",
             "propagate": False,
         },
@@ -220,8 +378,28 @@ CELERY_BEAT_SCHEDULE = {
     "task": "accounts.api.tasks.update_stock_prices",
     "schedule": 60.0, 
   },
+  "flush_book_fills":{
+    "task": "accounts.api.tasks.flush_fills",
+    "schedule": MATCHING_FLUSH_INTERVAL,
+  },
   "daily_trade_report":{
       "task":"accounts.api.tasks.generate_daily_report",
       "schedule": crontab(hour=0, minute=0),
   },
+  "hourly_analytics_export":{
+      "task":"accounts.api.tasks.export_analytics",
+      "schedule": crontab(minute=5),
+  },
+  "hourly_account_snapshots":{
+      "task":"accounts.api.tasks.snapshot_journal",
+      "schedule": crontab(minute=15),
+  },
+  "nightly_tick_prune":{
+      "task":"accounts.api.tasks.prune_price_ticks",
+      "schedule": crontab(hour=0, minute=30),
+  },
+  "nightly_partition_maintenance":{
+      "task":"accounts.api.tasks.maintain_partitions",
+      "schedule": crontab(hour=0, minute=45),
+  },
 }